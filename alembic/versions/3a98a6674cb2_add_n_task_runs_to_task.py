@@ -0,0 +1,31 @@
+"""add n_task_runs to task
+
+Revision ID: 3a98a6674cb2
+Revises: 151b2f642877
+Create Date: 2015-07-02 10:12:31.640711
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a98a6674cb2'
+down_revision = '151b2f642877'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('task', sa.Column('n_task_runs', sa.Integer, default=0,
+                                    server_default='0', nullable=False))
+    query = '''UPDATE task SET n_task_runs=counts.n_task_runs
+               FROM (SELECT task_id, COUNT(id) AS n_task_runs FROM task_run
+                     GROUP BY task_id) AS counts
+               WHERE task.id=counts.task_id;'''
+    op.execute(query)
+    op.create_index('task_project_id_n_task_runs_idx', 'task',
+                    ['project_id', 'n_task_runs', 'id'])
+
+
+def downgrade():
+    op.drop_index('task_project_id_n_task_runs_idx')
+    op.drop_column('task', 'n_task_runs')
@@ -0,0 +1,61 @@
+"""unique task run per volunteer
+
+Revision ID: 4c5ab8a2e1f7
+Revises: 3a98a6674cb2
+Create Date: 2015-07-20 11:04:52.310274
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c5ab8a2e1f7'
+down_revision = '3a98a6674cb2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# Recompute the counters and the state of the tasks with duplicates
+UPDATE_TASKS = '''
+    UPDATE task SET n_task_runs=COALESCE(counts.n_task_runs, 0),
+    state=CASE WHEN COALESCE(counts.n_task_runs, 0) >= task.n_answers
+               THEN 'completed' ELSE 'ongoing' END
+    FROM (SELECT DISTINCT task_id FROM task_run_duplicate) AS affected
+    LEFT JOIN (SELECT task_id, COUNT(id) AS n_task_runs FROM task_run
+               GROUP BY task_id) AS counts
+    ON counts.task_id=affected.task_id
+    WHERE task.id=affected.task_id;'''
+
+
+def upgrade():
+    # Keep the first answer of every volunteer (duplicates could only be
+    # created by concurrent submissions). The others are moved to
+    # task_run_duplicate, and restored by the downgrade.
+    query = '''CREATE TABLE task_run_duplicate AS
+               SELECT * FROM task_run
+               WHERE EXISTS (
+                   SELECT 1 FROM task_run AS first
+                   WHERE first.task_id=task_run.task_id
+                   AND first.id < task_run.id
+                   AND ((task_run.user_id IS NOT NULL
+                         AND first.user_id=task_run.user_id)
+                        OR (task_run.user_id IS NULL
+                            AND first.user_id IS NULL
+                            AND first.user_ip=task_run.user_ip)));'''
+    op.execute(query)
+    op.execute('''DELETE FROM task_run
+                  WHERE id IN (SELECT id FROM task_run_duplicate);''')
+    op.execute(UPDATE_TASKS)
+    op.create_index('task_run_task_id_user_id_key', 'task_run',
+                    ['task_id', 'user_id'], unique=True,
+                    postgresql_where=sa.text('user_id IS NOT NULL'))
+    op.create_index('task_run_task_id_user_ip_key', 'task_run',
+                    ['task_id', 'user_ip'], unique=True,
+                    postgresql_where=sa.text('user_id IS NULL'))
+
+
+def downgrade():
+    op.drop_index('task_run_task_id_user_ip_key')
+    op.drop_index('task_run_task_id_user_id_key')
+    op.execute('INSERT INTO task_run SELECT * FROM task_run_duplicate;')
+    op.execute(UPDATE_TASKS)
+    op.drop_table('task_run_duplicate')
@@ -374,8 +374,7 @@ def resize_project_avatars():
         from PIL import Image
         import time
         import pybossa.cache.projects as cached_apps
-        # Disable cache to update the data in it :-)
-        os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = '1'
+        from pybossa.cache import refreshing
         pyrax.set_setting("identity_type", "rackspace")
         pyrax.set_credentials(username=app.config['RACKSPACE_USERNAME'],
                               api_key=app.config['RACKSPACE_API_KEY'],
@@ -436,7 +435,9 @@ def resize_project_avatars():
                        obj = cont.get_object(old_avatar)
                        obj.delete()
                        print "Done!"
-                       cached_apps.get_app(a.short_name)
+                       # Update the cached project :-)
+                       with refreshing():
+                           cached_apps.get_app(a.short_name)
                    else:
                        print "No Avatar found."
                 else:
@@ -481,6 +482,31 @@ def resize_project_avatars():
         #                print "Something failed, this project will use the placehoder."
 
 
+def rebuild_scheduler_indexes(project_id=None):
+    '''Rebuild the Redis indexes of the schedulers and project counters.'''
+    import pybossa.answered_tasks as answered_tasks
+    import pybossa.calibration as calibration
+    import pybossa.consensus as consensus
+    import pybossa.project_counters as project_counters
+    import pybossa.task_queue as task_queue
+    import pybossa.task_sampler as task_sampler
+    with app.app_context():
+        if project_id:
+            project_ids = [int(project_id)]
+        else:
+            project_ids = [p.id for p in db.session.query(Project.id)]
+        for _id in project_ids:
+            n_task_runs = answered_tasks.rebuild(_id)
+            n_tallies = consensus.rebuild(_id)
+            calibration.rebuild(_id)
+            # Rebuilt on demand
+            task_queue.invalidate(_id)
+            task_sampler.mark_as_stale(_id)
+            if project_counters.is_enabled():
+                project_counters.rebuild(_id)
+            print "Project %s: %s task runs indexed, %s tasks tallied" % (
+                _id, n_task_runs, n_tallies)
+
 
 
 ## ==================================================
@@ -0,0 +1,226 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Index of the tasks already answered by every volunteer of a project.
+
+For every (project, user_id or user_ip) pair there is a Redis set with the
+ids of the tasks the volunteer has submitted a task run for. The sets are
+updated on every task run insert (and delete), and can be rebuilt from the DB
+with the rebuild function (see the rebuild_scheduler_indexes CLI command). A
+rebuild writes new sets that replace the current ones at the end, and the
+answers added or deleted meanwhile are applied to both.
+
+A project index is only trusted once it is ready: either it has been rebuilt,
+or the project was created after this index was deployed.
+
+"""
+from pybossa.core import sentinel
+
+
+ANSWERED_KEY = 'pybossa:sched:answered:%s:%s'
+READY_KEY = 'pybossa:sched:answered:%s:ready'
+BUILDING_KEY = 'pybossa:sched:answered:%s:building'
+TMP_SUFFIX = ':tmp'
+BUILD_TIMEOUT = 30 * 60
+CHUNK_SIZE = 1000
+
+# KEYS[1]: building key, KEYS[2..]: sets, ARGV[1]: SADD or SREM, ARGV[2]: task
+# id. The sets being rebuilt get the same update.
+UPDATE_SCRIPT = """
+local building = redis.call('EXISTS', KEYS[1]) == 1
+for i = 2, #KEYS do
+    redis.call(ARGV[1], KEYS[i], ARGV[2])
+    if building then
+        redis.call(ARGV[1], KEYS[i] .. ARGV[3], ARGV[2])
+    end
+end
+"""
+
+# KEYS: sets of a project, ARGV[1]: tmp suffix. Replace every set with its
+# rebuilt one, or delete it if it has no answers left.
+REPLACE_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    local tmp = key .. ARGV[1]
+    if redis.call('EXISTS', tmp) == 1 then
+        redis.call('RENAME', tmp, key)
+    else
+        redis.call('DEL', key)
+    end
+end
+"""
+
+_update_script = sentinel.register_script(UPDATE_SCRIPT)
+_replace_script = sentinel.register_script(REPLACE_SCRIPT)
+
+
+def _volunteer(user_id=None, user_ip=None):
+    if user_id:
+        return 'user:%s' % user_id
+    return 'ip:%s' % (user_ip or '127.0.0.1')
+
+
+def _key(project_id, user_id=None, user_ip=None):
+    return ANSWERED_KEY % (project_id, _volunteer(user_id, user_ip))
+
+
+def _task_run_keys(project_id, user_id=None, user_ip=None):
+    """Return the keys a task run belongs to.
+
+    A task run can have both a user_id and a user_ip, and the schedulers look
+    it up by either of them.
+    """
+    keys = []
+    if user_id is not None:
+        keys.append(_key(project_id, user_id=user_id))
+    if user_ip is not None:
+        keys.append(_key(project_id, user_ip=user_ip))
+    return keys
+
+
+def _update(command, project_id, task_id, user_id, user_ip, pipeline):
+    keys = _task_run_keys(project_id, user_id, user_ip)
+    if not keys:
+        return
+    execute = pipeline is None
+    if execute:
+        pipeline = sentinel.master.pipeline()
+    _update_script(keys=[BUILDING_KEY % project_id] + keys,
+                   args=[command, task_id, TMP_SUFFIX], client=pipeline)
+    if execute:
+        pipeline.execute()
+
+
+def add(project_id, task_id, user_id=None, user_ip=None, pipeline=None):
+    """Add a task to the answered tasks of a volunteer.
+
+    If a pipeline is given, the commands are only added to it.
+    """
+    _update('SADD', project_id, task_id, user_id, user_ip, pipeline)
+
+
+def remove(project_id, task_id, user_id=None, user_ip=None, pipeline=None):
+    """Remove a task from the answered tasks of a volunteer.
+
+    If a pipeline is given, the commands are only added to it.
+    """
+    _update('SREM', project_id, task_id, user_id, user_ip, pipeline)
+
+
+def mark_as_ready(project_id, pipeline=None):
+    """Mark the index of a project as complete."""
+    redis = sentinel.master if pipeline is None else pipeline
+    redis.set(READY_KEY % project_id, 1)
+
+
+def invalidate(project_id):
+    """Stop trusting the index of a project until it is rebuilt."""
+    sentinel.master.delete(READY_KEY % project_id)
+
+
+def is_ready(project_id):
+    """Return True if the index of a project can be trusted."""
+    return bool(sentinel.master.get(READY_KEY % project_id))
+
+
+def get(project_id, user_id=None, user_ip=None):
+    """Return the set of task ids answered by a volunteer.
+
+    Returns None if the index of the project is not ready, so the caller
+    falls back to querying the DB.
+    """
+    pipeline = sentinel.master.pipeline()
+    pipeline.get(READY_KEY % project_id)
+    pipeline.smembers(_key(project_id, user_id, user_ip))
+    ready, members = pipeline.execute()
+    if not ready:
+        return None
+    return set(int(task_id) for task_id in members)
+
+
+def is_answered(project_id, task_id, user_id=None, user_ip=None):
+    """Return True if a volunteer has already answered a task.
+
+    Returns None if the index of the project is not ready.
+    """
+    pipeline = sentinel.master.pipeline()
+    pipeline.get(READY_KEY % project_id)
+    pipeline.sismember(_key(project_id, user_id, user_ip), task_id)
+    ready, answered = pipeline.execute()
+    if not ready:
+        return None
+    return bool(answered)
+
+
+def _project_keys(project_id):
+    """Return the sets of a project and the ones being rebuilt."""
+    status_keys = (READY_KEY % project_id, BUILDING_KEY % project_id)
+    pattern = ANSWERED_KEY % (project_id, '*')
+    keys = []
+    cursor = None
+    while cursor != 0:
+        cursor, chunk = sentinel.master.scan(cursor or 0, match=pattern,
+                                             count=CHUNK_SIZE)
+        cursor = int(cursor)
+        keys.extend(key for key in chunk if key not in status_keys)
+    return keys
+
+
+def _chunks(items):
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i:i + CHUNK_SIZE]
+
+
+def rebuild(project_id):
+    """Rebuild the index of a project from its task runs."""
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    sentinel.master.set(BUILDING_KEY % project_id, 1, ex=BUILD_TIMEOUT)
+    # Left behind by an interrupted rebuild
+    tmp_keys = [key for key in _project_keys(project_id)
+                if key.endswith(TMP_SUFFIX)]
+    for keys in _chunks(tmp_keys):
+        sentinel.master.delete(*keys)
+    sql = text('''SELECT task_id, user_id, user_ip FROM task_run
+               WHERE project_id=:project_id
+               AND (user_id IS NOT NULL OR user_ip IS NOT NULL);''')
+    results = db.slave_session.execute(sql, dict(project_id=project_id))
+    pipeline = sentinel.master.pipeline()
+    n_task_runs = 0
+    for row in results:
+        for key in _task_run_keys(project_id, row.user_id, row.user_ip):
+            pipeline.sadd(key + TMP_SUFFIX, row.task_id)
+        n_task_runs += 1
+        if n_task_runs % CHUNK_SIZE == 0:
+            pipeline.execute()
+    pipeline.execute()
+    keys = set(key[:-len(TMP_SUFFIX)] if key.endswith(TMP_SUFFIX) else key
+               for key in _project_keys(project_id))
+    for chunk in _chunks(sorted(keys)):
+        _replace_script(keys=chunk, args=[TMP_SUFFIX], client=pipeline)
+    pipeline.set(READY_KEY % project_id, 1)
+    pipeline.delete(BUILDING_KEY % project_id)
+    pipeline.execute()
+    return n_task_runs
+
+
+def delete(project_id):
+    """Delete the index of a (deleted) project."""
+    keys = _project_keys(project_id)
+    keys.extend([READY_KEY % project_id, BUILDING_KEY % project_id])
+    for chunk in _chunks(keys):
+        sentinel.master.delete(*chunk)
@@ -32,17 +32,21 @@ This package adds GET, POST, PUT and DELETE methods for:
 import json
 from flask import Blueprint, request, abort, Response, make_response
 from flask.ext.login import current_user
-from werkzeug.exceptions import NotFound
-from pybossa.util import jsonpify, crossdomain, get_user_id_or_ip
+from werkzeug.exceptions import (NotFound, BadRequest, Forbidden,
+                                 Unauthorized)
+from pybossa.util import (jsonpify, crossdomain, get_user_id_or_ip,
+                          get_user_ip)
 import pybossa.model as model
 from pybossa.core import csrf, ratelimits, sentinel
 from pybossa.ratelimit import ratelimit
 from pybossa.cache.projects import n_tasks
 import pybossa.sched as sched
+import pybossa.calibration as calibration
+import pybossa.ingestion as ingestion
 from pybossa.error import ErrorStatus
 from global_stats import GlobalStatsAPI
 from task import TaskAPI
-from task_run import TaskRunAPI
+from task_run import TaskRunAPI, create_task_runs
 from app import AppAPI
 from project import ProjectAPI
 from category import CategoryAPI
@@ -57,6 +61,11 @@ cors_headers = ['Content-Type', 'Authorization']
 
 error = ErrorStatus()
 
+# Maximum number of tasks returned by the newtasks endpoint
+MAX_NEW_TASKS = 20
+# Maximum number of task runs accepted by the taskrun bulk endpoint
+MAX_BULK_TASK_RUNS = 100
+
 
 @blueprint.route('/')
 @crossdomain(origin='*', headers=cors_headers)
@@ -110,53 +119,147 @@ def new_task(project_id):
         # If there is a task for the user, return it
         if task is not None:
             mark_task_as_requested_by_user(task, sentinel.master)
-            response = make_response(json.dumps(task.dictize()))
+            task_data = calibration.hide_gold_answer(task.dictize())
+            response = make_response(json.dumps(task_data))
             response.mimetype = "application/json"
             return response
         return Response(json.dumps({}), mimetype="application/json")
     except Exception as e:
         return error.format_exception(e, target='project', action='GET')
 
-def _retrieve_new_task(project_id):
-    project = project_repo.get(project_id)
+
+@jsonpify
+@blueprint.route('/app/<project_id>/newtasks')
+@blueprint.route('/project/<project_id>/newtasks')
+@crossdomain(origin='*', headers=cors_headers)
+@ratelimit(limit=ratelimits.get('LIMIT'), per=ratelimits.get('PER'))
+def new_tasks(project_id):
+    """Return up to limit (arg) new distinct tasks for a project."""
+    try:
+        limit = min(int(request.args.get('limit', 1)), MAX_NEW_TASKS)
+        tasks = _retrieve_new_tasks(project_id, max(limit, 1))
+        mark_tasks_as_requested_by_user(tasks, sentinel.master)
+        tasks_data = [calibration.hide_gold_answer(t.dictize())
+                      for t in tasks]
+        response = make_response(json.dumps(tasks_data))
+        response.mimetype = "application/json"
+        return response
+    except Exception as e:
+        return error.format_exception(e, target='project', action='GET')
+
+
+@jsonpify
+@csrf.exempt
+@blueprint.route('/taskrun/bulk', methods=['POST', 'OPTIONS'])
+@crossdomain(origin='*', headers=cors_headers)
+@ratelimit(limit=ratelimits.get('LIMIT'), per=ratelimits.get('PER'))
+def bulk_taskruns():
+    """Save a list of task runs (e.g. collected offline) at once.
+
+    Returns the status of every task run, in the same order.
+    """
+    try:
+        items = json.loads(request.data)
+        if not isinstance(items, list):
+            raise BadRequest('Expected a list of task runs')
+        if len(items) > MAX_BULK_TASK_RUNS:
+            raise BadRequest('At most %s task runs per request'
+                             % MAX_BULK_TASK_RUNS)
+        statuses = create_task_runs(items)
+        return Response(json.dumps(statuses), mimetype="application/json")
+    except Exception as e:
+        return error.format_exception(e, target='taskrun', action='POST')
+
+
+@jsonpify
+@blueprint.route('/taskrun/ingestion')
+@crossdomain(origin='*', headers=cors_headers)
+@ratelimit(limit=ratelimits.get('LIMIT'), per=ratelimits.get('PER'))
+def task_run_ingestion():
+    """Return the state of the write-behind ingestion of task runs.
+
+    With a key argument, return the state of that submission instead, which
+    is only available to its volunteer and the admins.
+    """
+    try:
+        key = request.args.get('key')
+        if key:
+            volunteer = get_user_id_or_ip()
+            if not (ingestion.is_submitted_by(key, **volunteer) or
+                    (current_user.is_authenticated() and current_user.admin)):
+                if current_user.is_anonymous():
+                    raise Unauthorized()
+                raise Forbidden()
+            status = dict(key=key, state=ingestion.get_state(key))
+        else:
+            status = ingestion.get_status()
+        return Response(json.dumps(status), mimetype="application/json")
+    except Exception as e:
+        return error.format_exception(e, target='taskrun', action='GET')
+
+
+def _get_scheduling_args(project_id):
+    try:
+        project = sched.get_project_config(int(project_id))
+    except ValueError:
+        project = None
     if project is None:
         raise NotFound
-    if not project.allow_anonymous_contributors and current_user.is_anonymous():
-        info = dict(
-            error="This project does not allow anonymous contributors")
-        error = model.task.Task(info=info)
-        return error
     if request.args.get('offset'):
         offset = int(request.args.get('offset'))
     else:
         offset = 0
 
     user_id = None if current_user.is_anonymous() else current_user.id
-    user_ip = request.remote_addr if current_user.is_anonymous() else None
+    user_ip = get_user_ip()
+    return project, user_id, user_ip, offset
 
-    if request.headers.get('remote_mobile_addr') is not None :
-            user_ip = request.headers.get('remote_mobile_addr') if current_user.is_anonymous() else None
-    else:
-            if request.headers.getlist("X-Forwarded-For"):
-                user_ip = request.headers.getlist("X-Forwarded-For")[0]
 
-    if ',' in user_ip:
-            ips = user_ip.split(",")
-            for ip in ips:
-                user_ip = ip
+def _anonymous_not_allowed_error():
+    info = dict(
+        error="This project does not allow anonymous contributors")
+    return model.task.Task(info=info)
+
+
+def _retrieve_new_task(project_id):
+    project, user_id, user_ip, offset = _get_scheduling_args(project_id)
+    if not project['allow_anonymous_contributors'] and current_user.is_anonymous():
+        return _anonymous_not_allowed_error()
 
     print "_retrieve_new_task %s." % user_id
     print "_retrieve_new_task %s." % user_ip
-    print "project.info.get('sched') %s." % project.info.get('sched')
+    print "project sched %s." % project['sched']
 
-    task = sched.new_task(project_id, project.info.get('sched'), user_id, user_ip, offset)
+    task = sched.new_task(project['id'], project['sched'], user_id, user_ip, offset,
+                          lease=project['sched_lease'],
+                          calibration_frac=project['calibration_frac'])
     return task
 
+
+def _retrieve_new_tasks(project_id, limit):
+    project, user_id, user_ip, offset = _get_scheduling_args(project_id)
+    if not project['allow_anonymous_contributors'] and current_user.is_anonymous():
+        return [_anonymous_not_allowed_error()]
+    return sched.new_tasks(project['id'], project['sched'], user_id,
+                           user_ip, offset, limit,
+                           lease=project['sched_lease'],
+                           calibration_frac=project['calibration_frac'])
+
+
 def mark_task_as_requested_by_user(task, redis_conn):
+    mark_tasks_as_requested_by_user([task], redis_conn)
+
+
+def mark_tasks_as_requested_by_user(tasks, redis_conn):
     usr = get_user_id_or_ip()['user_id'] or get_user_id_or_ip()['user_ip']
-    key = 'pybossa:task_requested:user:%s:task:%s' % (usr, task.id)
     timeout = 60 * 60
-    redis_conn.setex(key, timeout, True)
+    pipeline = redis_conn.pipeline()
+    for task in tasks:
+        if task.id is None:
+            continue
+        key = 'pybossa:task_requested:user:%s:task:%s' % (usr, task.id)
+        pipeline.setex(key, timeout, True)
+    pipeline.execute()
 
 
 @jsonpify
@@ -192,6 +295,10 @@ def user_progress(project_id=None, short_name=None):
                 query_attrs['user_id'] = current_user.id
             taskrun_count = task_repo.count_task_runs_with(**query_attrs)
             tmp = dict(done=taskrun_count, total=n_tasks(project.id))
+            if project.calibration_frac:
+                tmp['calibration'] = calibration.get_accuracy(
+                    project.id, query_attrs.get('user_id'),
+                    query_attrs.get('user_ip'))
             return Response(json.dumps(tmp), mimetype="application/json")
         else:
             return abort(404)
@@ -188,17 +188,25 @@ class APIBase(MethodView):
             data = json.loads(request.data)
             self._forbidden_attributes(data)
             inst = self._create_instance_from_request(data)
-            repo = repos[self.__class__.__name__]['repo']
-            save_func = repos[self.__class__.__name__]['save']
-            getattr(repo, save_func)(inst)
-            self._log_changes(None, inst)
-            return json.dumps(inst.dictize())
+            return self._save_new_instance(inst)
         except Exception as e:
             return error.format_exception(
                 e,
                 target=self.__class__.__name__.lower(),
                 action='POST')
 
+    def _save_new_instance(self, inst):
+        """Save a new (validated) instance and return the response.
+
+        Method to be overriden in inheriting classes which may save it in a
+        different way.
+        """
+        repo = repos[self.__class__.__name__]['repo']
+        save_func = repos[self.__class__.__name__]['save']
+        getattr(repo, save_func)(inst)
+        self._log_changes(None, inst)
+        return json.dumps(inst.dictize())
+
     def _create_instance_from_request(self, data):
         data = self.hateoas.remove_links(data)
         inst = self.__class__(**data)
@@ -22,8 +22,11 @@ This package adds GET, POST, PUT and DELETE methods for:
     * tasks
 
 """
+from flask.ext.login import current_user
 from werkzeug.exceptions import BadRequest
 from pybossa.model.task import Task
+from pybossa.auth import is_authorized
+import pybossa.calibration as calibration
 from api_base import APIBase
 
 
@@ -32,7 +35,14 @@ class TaskAPI(APIBase):
     """Class for domain object Task."""
 
     __class__ = Task
-    reserved_keys = set(['id', 'created', 'state'])
+    reserved_keys = set(['id', 'created', 'state', 'n_task_runs'])
+
+    def _create_dict_from_model(self, model):
+        task_data = super(TaskAPI, self)._create_dict_from_model(model)
+        if (model.calibration and
+                not is_authorized(current_user, 'update', model)):
+            task_data = calibration.hide_gold_answer(task_data)
+        return task_data
 
     def _forbidden_attributes(self, data):
         for key in data.keys():
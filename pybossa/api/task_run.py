@@ -22,14 +22,24 @@ This package adds GET, POST, PUT and DELETE methods for:
     * task_runs
 
 """
-from flask import request
+import json
+from flask import request, current_app, Response
 from flask.ext.login import current_user
-from pybossa.model.task_run import TaskRun
-from werkzeug.exceptions import Forbidden, BadRequest
+from pybossa.model.task_run import (TaskRun, USER_ANSWER_INDEX,
+                                    ANONYMOUS_ANSWER_INDEX)
+from werkzeug.exceptions import Forbidden, BadRequest, Unauthorized
+from sqlalchemy.exc import SQLAlchemyError
 
 from api_base import APIBase
 from pybossa.util import get_user_id_or_ip
 from pybossa.core import task_repo, sentinel
+from pybossa.error import ErrorStatus
+from pybossa.exc import DBIntegrityError
+import pybossa.sched as sched
+import pybossa.ingestion as ingestion
+
+
+TASK_REQUESTED_KEY = 'pybossa:task_requested:user:%s:task:%s'
 
 
 class TaskRunAPI(APIBase):
@@ -49,41 +59,135 @@ class TaskRunAPI(APIBase):
             raise Forbidden('Invalid project_id')
         if _check_task_requested_by_user(taskrun, sentinel.master) is False:
             raise Forbidden('You must request a task first!')
+        taskrun.calibration = task.calibration
 
         # Add the user info so it cannot post again the same taskrun
-
-        if current_user.is_anonymous():
-            taskrun.user_ip = request.remote_addr
-        else:
-            taskrun.user_id = current_user.id
-
-        if request.headers.get('remote_mobile_addr') is not None :
-                taskrun.user_ip = request.headers.get('remote_mobile_addr') if current_user.is_anonymous() else None
-        else:
-                if request.headers.getlist("X-Forwarded-For"):
-                    user_ip = request.headers.getlist("X-Forwarded-For")[0]
-                    taskrun.user_ip = user_ip
-
-
-        print "user_ip %s." % user_ip
-        if ',' in user_ip:
-                ips = user_ip.split(",")
-                for ip in ips:
-                    taskrun.user_ip = ip
-
-        print "taskrun.user_ip %s." % taskrun.user_ip
+        volunteer = get_user_id_or_ip()
+        taskrun.user_id = volunteer['user_id']
+        taskrun.user_ip = volunteer['user_ip']
 
     def _forbidden_attributes(self, data):
         for key in data.keys():
             if key in self.reserved_keys:
                 raise BadRequest("Reserved keys in payload")
 
+    def _save_new_instance(self, taskrun):
+        """Queue the task run instead if the write-behind ingestion is
+        enabled."""
+        if not current_app.config.get('TASK_RUN_WRITE_BEHIND'):
+            try:
+                return super(TaskRunAPI, self)._save_new_instance(taskrun)
+            except DBIntegrityError as e:
+                if _is_repeated_answer(e):
+                    raise Forbidden()
+                raise
+        key = ingestion.push(taskrun, request.headers.get('Idempotency-Key'))
+        status = dict(status='accepted', key=key)
+        return Response(json.dumps(status), status=202,
+                        mimetype='application/json')
+
 
 def _check_task_requested_by_user(taskrun, redis_conn):
     user_id_ip = get_user_id_or_ip()
     usr = user_id_ip['user_id'] or user_id_ip['user_ip']
-    key = 'pybossa:task_requested:user:%s:task:%s' % (usr, taskrun.task_id)
+    key = TASK_REQUESTED_KEY % (usr, taskrun.task_id)
     task_requested = bool(redis_conn.get(key))
     if user_id_ip['user_id'] is not None:
         redis_conn.delete(key)
     return task_requested
+
+
+def _is_repeated_answer(e):
+    """Return True if an integrity error was raised by the indexes that keep
+    a volunteer from answering a task twice."""
+    message = str(e)
+    return USER_ANSWER_INDEX in message or ANONYMOUS_ANSWER_INDEX in message
+
+
+def create_task_runs(items):
+    """Validate and save many task runs of the current volunteer at once.
+
+    The tasks, the task requests and the previous answers of the volunteer
+    are checked with a query, a MGET and a query for the whole batch, and
+    the valid task runs are inserted with a single statement. If the
+    statement fails, they are inserted one by one, so only the task runs
+    rejected by the DB fail.
+
+    Returns the status of every item, in the same order. Errors not caused
+    by the items (e.g. Redis is down) fail the whole request.
+    """
+    volunteer = get_user_id_or_ip()
+    statuses = [None] * len(items)
+    task_runs = []
+    for i, data in enumerate(items):
+        try:
+            if not isinstance(data, dict):
+                raise BadRequest('Expected a task run object')
+            TaskRunAPI()._forbidden_attributes(data)
+            task_run = TaskRun(**TaskRunAPI.hateoas.remove_links(data))
+            task_run.user_id = volunteer['user_id']
+            task_run.user_ip = volunteer['user_ip']
+            task_runs.append((i, task_run))
+        except Exception as e:
+            statuses[i] = _failed_status(e)
+
+    task_ids = list(set(task_run.task_id for _, task_run in task_runs))
+    tasks = dict((task.id, task) for task in task_repo.get_tasks(task_ids))
+    usr = volunteer['user_id'] or volunteer['user_ip']
+    requested_keys = [TASK_REQUESTED_KEY % (usr, task_run.task_id)
+                      for _, task_run in task_runs]
+    requested = sentinel.master.mget(requested_keys) if task_runs else []
+    answered = task_repo.get_answered_task_ids(task_ids,
+                                               volunteer['user_id'],
+                                               volunteer['user_ip'])
+    valid = []
+    for (i, task_run), task_requested in zip(task_runs, requested):
+        try:
+            task = tasks.get(task_run.task_id)
+            if task is None:
+                raise Forbidden('Invalid task_id')
+            if task.project_id != task_run.project_id:
+                raise Forbidden('Invalid project_id')
+            if not task_requested:
+                raise Forbidden('You must request a task first!')
+            project = sched.get_project_config(task.project_id)
+            if (current_user.is_anonymous() and
+                    not project['allow_anonymous_contributors']):
+                raise Unauthorized()
+            if task.id in answered:
+                raise Forbidden()
+            answered.add(task.id)
+            task_run.calibration = task.calibration
+            valid.append((i, task_run))
+        except Exception as e:
+            statuses[i] = _failed_status(e)
+
+    try:
+        task_repo.save_task_runs([task_run for _, task_run in valid])
+    except (DBIntegrityError, SQLAlchemyError):
+        # e.g. a concurrent answer, a deleted task or an invalid value, so
+        # save them one by one
+        saved = []
+        for i, task_run in valid:
+            try:
+                task_repo.save_task_runs([task_run])
+                saved.append((i, task_run))
+            except (DBIntegrityError, SQLAlchemyError) as e:
+                statuses[i] = _failed_status(
+                    Forbidden() if _is_repeated_answer(e) else e)
+        valid = saved
+    if valid and volunteer['user_id'] is not None:
+        sentinel.master.delete(*[TASK_REQUESTED_KEY % (usr, task_run.task_id)
+                                 for _, task_run in valid])
+    for i, task_run in valid:
+        statuses[i] = dict(status='ok', id=task_run.id,
+                           task_id=task_run.task_id)
+    return statuses
+
+
+def _failed_status(e):
+    exception_cls = e.__class__.__name__
+    status_code = ErrorStatus.error_status.get(exception_cls, 500)
+    message = getattr(e, 'description', None) or str(e)
+    return dict(status='failed', status_code=status_code,
+                exception_cls=exception_cls, exception_msg=message)
@@ -17,6 +17,8 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 from flask import abort
+import pybossa.answered_tasks as answered_tasks
+import pybossa.sched as sched
 
 
 class TaskRunAuth(object):
@@ -30,19 +32,19 @@ class TaskRunAuth(object):
         return getattr(self, action)(user, taskrun)
 
     def _create(self, user, taskrun):
-        project_id = self.task_repo.get_task(taskrun.task_id).project_id
-        project = self.project_repo.get(project_id)
+        # The API has already checked that the task belongs to the project.
+        # A repeated answer that the answered index misses is rejected by
+        # the unique indexes of the task_run table when it is saved.
+        project = sched.get_project_config(taskrun.project_id)
+        if project is None:
+            return False
         if (user.is_anonymous() and
-                project.allow_anonymous_contributors is False):
+                project['allow_anonymous_contributors'] is False):
             return False
-        authorized = self.task_repo.count_task_runs_with(
-            project_id=taskrun.project_id,
-            task_id=taskrun.task_id,
-            user_id=taskrun.user_id,
-            user_ip=taskrun.user_ip) <= 0
-        if not authorized:
+        if answered_tasks.is_answered(taskrun.project_id, taskrun.task_id,
+                                      taskrun.user_id, taskrun.user_ip):
             raise abort(403)
-        return authorized
+        return True
 
     def _read(self, user, taskrun=None):
         return True
@@ -24,12 +24,50 @@ It exports:
     * memoize: for caching functions using its arguments as part of the key
     * delete_cached: to remove a cached value
     * delete_memoized: to remove a cached value from the memoize decorator
+    * delete_tagged: to remove the memoized values with a given tag
+    * refreshing: to recompute and store the cached values in a block
+    * metrics: the metrics of the cached functions
+
+Every memoized value is added to the tag of its function (and optionally to
+another one, e.g. for its project), a Redis sorted set of the cache keys
+scored by their expiration time, so they can be deleted without scanning
+the keyspace.
+
+Values are stored in an envelope with the version of the code that cached
+them, so values cached by another version (CACHE_VERSION) are ignored, and
+the time they took to compute. As the envelope is never empty, falsy values
+are cached as well. Large values of functions decorated with compress are
+compressed with zlib.
+
+Values of functions decorated as expensive are recomputed by a single
+caller at a time (the others wait for it), and refreshed at random before
+they expire, the likelier the closer they are to expire (XFetch). Values
+with a stale_ttl are kept stale_ttl seconds more, and returned while a job
+of the high queue refreshes them.
+
+If CACHE_LOCAL_SIZE is set, every process also keeps up to that number of
+values in memory, for at most CACHE_LOCAL_TIMEOUT seconds (see
+pybossa.cache.local).
+
+The hits, misses, computations and invalidations of every function are
+counted, and added to Redis every CACHE_METRICS_INTERVAL seconds (see
+pybossa.cache.metrics).
 
 """
 import os
+import math
+import zlib
+import time
+import uuid
+import random
 import hashlib
+import threading
+from contextlib import contextmanager
 from functools import wraps
+from pybossa import __version__
 from pybossa.core import sentinel
+from pybossa.cache.local import LocalCache, Invalidator
+from pybossa.cache.metrics import Metrics
 
 try:
     import cPickle as pickle
@@ -42,11 +80,74 @@ except ImportError:  # pragma: no cover
     import pybossa.default_settings as settings
     os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = '1'
 
+# Read once, at startup: with the cache disabled, the cached functions always
+# compute their values (and store them)
+disabled = os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is not None
+
+# Whether the cached functions recompute their values in the current thread
+# (or greenlet, with gevent), see refreshing
+_context = threading.local()
+
 ONE_DAY = 24 * 60 * 60
 ONE_HOUR = 60 * 60
 HALF_HOUR = 30 * 60
 FIVE_MINUTES = 5 * 60
 
+local_cache = LocalCache(getattr(settings, 'CACHE_LOCAL_SIZE', 0))
+invalidator = Invalidator(local_cache,
+                          '%s:invalidations' % settings.REDIS_KEYPREFIX)
+metrics = Metrics('%s:metrics' % settings.REDIS_KEYPREFIX,
+                  getattr(settings, 'CACHE_METRICS_INTERVAL', 60))
+# The options of every cached function, by its name in the metrics
+cached_functions = {}
+
+# Envelope: "pbc:<flags>:<delta>:<version>|<pickled value>"
+ENVELOPE_MARKER = 'pbc'
+CACHE_VERSION = getattr(settings, 'CACHE_VERSION', None) or __version__
+COMPRESSED = 'z'
+COMPRESS_MIN_SIZE = 1024
+
+# Expensive values: only the holder of the lock recomputes them
+LOCK_SUFFIX = ':lock'
+REFRESHING_SUFFIX = ':refreshing'
+LOCK_TIMEOUT = 5 * 60
+LOCK_WAIT = 5
+LOCK_POLL_INTERVAL = 0.05
+XFETCH_BETA = 1
+
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1]: tag, ARGV: now, expiration time, key, timeout
+ADD_TO_TAG_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[4]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+end
+"""
+
+# KEYS[1]: tag, ARGV[1]: now. Returns the number of deleted values followed
+# by the keys of the tag
+DELETE_TAG_SCRIPT = """
+local keys = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], '+inf')
+redis.call('DEL', KEYS[1])
+local deleted = 0
+for _, key in ipairs(keys) do
+    deleted = deleted + redis.call('DEL', key)
+end
+table.insert(keys, 1, deleted)
+return keys
+"""
+
+_unlock_script = sentinel.register_script(UNLOCK_SCRIPT)
+_add_to_tag_script = sentinel.register_script(ADD_TO_TAG_SCRIPT)
+_delete_tag_script = sentinel.register_script(DELETE_TAG_SCRIPT)
+
 
 def get_key_to_hash(*args, **kwargs):
     """Return key to hash for *args and **kwargs."""
@@ -67,62 +168,443 @@ def get_hash_key(prefix, key_to_hash):
     return key
 
 
-def cache(key_prefix, timeout=300):
+@contextmanager
+def refreshing():
+    """
+    Context manager for refreshing the cache.
+
+    Within it, the cached functions called by the current thread compute
+    their values and store them instead of reading them, while the other
+    threads keep reading them from the cache.
+
+    """
+    previous = is_refreshing()
+    _context.refreshing = True
+    try:
+        yield
+    finally:
+        _context.refreshing = previous
+
+
+def is_refreshing():
+    """Return True within a refreshing block."""
+    return getattr(_context, 'refreshing', False)
+
+
+def _recompute():
+    return disabled or is_refreshing()
+
+
+def _local_timeout(timeout):
+    # Always shorter than the Redis TTL
+    return min(getattr(settings, 'CACHE_LOCAL_TIMEOUT', 10), timeout // 2)
+
+
+def _encode(output, delta=None, compress=False):
+    """Return the envelope of a value."""
+    payload = pickle.dumps(output, pickle.HIGHEST_PROTOCOL)
+    flags = ''
+    if compress and len(payload) >= COMPRESS_MIN_SIZE:
+        payload = zlib.compress(payload)
+        flags = COMPRESSED
+    delta = '' if delta is None else '%.3f' % delta
+    return '%s:%s:%s:%s|%s' % (ENVELOPE_MARKER, flags, delta, CACHE_VERSION,
+                               payload)
+
+
+def _decode(envelope):
+    """Return the value in an envelope and the time it took to compute it,
+    or None if there is no envelope of this version of the code."""
+    if envelope is None:
+        return None
+    header, separator, payload = envelope.partition('|')
+    fields = header.split(':', 3)
+    if not separator or len(fields) != 4:
+        return None
+    marker, flags, delta, version = fields
+    if marker != ENVELOPE_MARKER or version != CACHE_VERSION:
+        return None
+    if COMPRESSED in flags:
+        payload = zlib.decompress(payload)
+    return pickle.loads(payload), (float(delta) if delta else None)
+
+
+def _get(key, timeout, with_ttl=False):
+    """Return the envelope of a key, from the local cache if it has it.
+
+    With with_ttl, return it with its remaining TTL in milliseconds, or None
+    if it is unknown.
+    """
+    output = None
+    if local_cache.enabled:
+        invalidator.ensure_listening(sentinel.master)
+        # Values are kept in their envelope, so callers cannot modify the
+        # cached copy
+        output = local_cache.get(key)
+    if output is not None:
+        return (output, None) if with_ttl else output
+    if with_ttl:
+        pipeline = sentinel.slave.pipeline(transaction=False)
+        pipeline.get(key)
+        pipeline.pttl(key)
+        output, ttl = pipeline.execute()
+    else:
+        output = sentinel.slave.get(key)
+    if output is not None and local_cache.enabled:
+        local_cache.set(key, output, _local_timeout(timeout))
+    return (output, ttl) if with_ttl else output
+
+
+def _get_many(keys, timeout):
+    """Return the envelopes of a list of keys, with one MGET for the ones
+    missing from the local cache."""
+    outputs = [None] * len(keys)
+    if local_cache.enabled:
+        invalidator.ensure_listening(sentinel.master)
+        outputs = [local_cache.get(key) for key in keys]
+    missing = [i for i, output in enumerate(outputs) if output is None]
+    if missing:
+        values = sentinel.slave.mget([keys[i] for i in missing])
+        for i, output in zip(missing, values):
+            outputs[i] = output
+            if output is not None and local_cache.enabled:
+                local_cache.set(keys[i], output, _local_timeout(timeout))
+    return outputs
+
+
+def _tag_key(tag):
+    return "%s:tag:%s" % (settings.REDIS_KEYPREFIX, tag)
+
+
+def _set(key, timeout, output, tags=(), local_timeout=None):
+    if tags:
+        _set_many([(key, output, tags)], timeout, local_timeout)
+        return
+    sentinel.master.setex(key, timeout, output)
+    if local_cache.enabled:
+        local_cache.set(key, output, _local_timeout(local_timeout or timeout))
+
+
+def _set_many(items, timeout, local_timeout=None):
+    """Store a list of (key, envelope, tags) with one pipeline."""
+    pipeline = sentinel.master.pipeline()
+    now = time.time()
+    for key, output, tags in items:
+        pipeline.setex(key, timeout, output)
+        for tag in tags:
+            _add_to_tag_script(keys=[_tag_key(tag)],
+                               args=[now, now + timeout, key, timeout],
+                               client=pipeline)
+    pipeline.execute()
+    if local_cache.enabled:
+        for key, output, tags in items:
+            local_cache.set(key, output,
+                            _local_timeout(local_timeout or timeout))
+
+
+def _invalidate(pattern):
+    """Drop a key (or the keys of a prefix followed by '*') from the local
+    cache of every process."""
+    if local_cache.enabled:
+        invalidator.handle(pattern)
+        invalidator.publish(sentinel.master, pattern)
+
+
+class _CachedFunction(object):
+
+    """The caching options of a function decorated with cache or memoize,
+    and the logic to get its values."""
+
+    def __init__(self, f, name, timeout, expensive=False, stale_ttl=None,
+                 compress=False, many=None):
+        self.f = f
+        # The name of the function in the metrics
+        self.name = name
+        self.many = many
+        self.timeout = timeout
+        self.expensive = expensive
+        self.stale_ttl = stale_ttl
+        self.compress = compress
+        # Stale values are kept in Redis for stale_ttl more seconds
+        self.redis_timeout = timeout + (stale_ttl or 0)
+
+    def compute(self, key, tags, args, kwargs):
+        """Call the function and store its value."""
+        start = time.time()
+        output = self.f(*args, **kwargs)
+        elapsed = time.time() - start
+        delta = elapsed if self.expensive else None
+        envelope = _encode(output, delta, self.compress)
+        _set(key, self.redis_timeout, envelope, tags,
+             local_timeout=self.timeout)
+        metrics.computed(self.name, elapsed, len(envelope))
+        if self.stale_ttl:
+            sentinel.master.delete(key + REFRESHING_SUFFIX)
+        return output
+
+    def compute_many(self, args_list):
+        """Call the function for a list of arguments tuples."""
+        if self.many is not None:
+            return self.many(args_list)
+        return [self.f(*args) for args in args_list]
+
+    def get_many(self, keys_and_tags, args_list):
+        """Return the cached values for a list of arguments tuples, reading
+        them at once and computing and storing the missing ones at once."""
+        if not args_list:
+            return []
+        outputs = [None] * len(args_list)
+        missing = range(len(args_list))
+        if not _recompute():
+            envelopes = _get_many([key for key, tags in keys_and_tags],
+                                  self.timeout)
+            missing = []
+            for i, envelope in enumerate(envelopes):
+                cached = _decode(envelope)
+                if cached is None:
+                    missing.append(i)
+                else:
+                    outputs[i] = cached[0]
+            metrics.hits(self.name, len(args_list) - len(missing))
+            metrics.misses(self.name, len(missing))
+            metrics.flush_if_due(sentinel.master)
+        if missing:
+            start = time.time()
+            computed = self.compute_many([args_list[i] for i in missing])
+            elapsed = time.time() - start
+            items = []
+            for i, output in zip(missing, computed):
+                outputs[i] = output
+                key, tags = keys_and_tags[i]
+                items.append((key, _encode(output, compress=self.compress),
+                              tags))
+            _set_many(items, self.redis_timeout, self.timeout)
+            metrics.computed(self.name, elapsed,
+                             sum(len(item[1]) for item in items),
+                             n=len(items))
+        return outputs
+
+    def _count(self, cached):
+        """Count a hit or a miss."""
+        if cached is None:
+            metrics.misses(self.name)
+        else:
+            metrics.hits(self.name)
+        metrics.flush_if_due(sentinel.master)
+
+    def get(self, function, key, tags, args, kwargs):
+        """Return the cached value, computing and storing it if needed.
+
+        function is the decorated function, to refresh stale values in the
+        background.
+        """
+        if _recompute():
+            return self.compute(key, tags, args, kwargs)
+        if not self.expensive and not self.stale_ttl:
+            cached = _decode(_get(key, self.timeout))
+            self._count(cached)
+            if cached is not None:
+                return cached[0]
+            return self.compute(key, tags, args, kwargs)
+        output, ttl = _get(key, self.timeout, with_ttl=True)
+        cached = _decode(output)
+        self._count(cached)
+        if cached is not None and self.stale_ttl and ttl is not None:
+            # Time left until the value is stale
+            ttl -= self.stale_ttl * 1000
+            if ttl < 0:
+                _enqueue_refresh(function, args, kwargs, key)
+                return cached[0]
+        if not self.expensive:
+            if cached is not None:
+                return cached[0]
+            return self.compute(key, tags, args, kwargs)
+        return self._get_expensive(key, tags, args, kwargs, cached, ttl)
+
+    def _get_expensive(self, key, tags, args, kwargs, cached, ttl):
+        # Only one caller recomputes a missing value while the others wait
+        # for it, and values are recomputed before they expire with a
+        # probability that grows as they are about to (XFetch)
+        if cached is not None:
+            output, delta = cached
+            if not _refresh_early(ttl, delta):
+                return output
+            token = _lock(key)
+            if token is None:
+                # Somebody else is already refreshing it
+                return output
+        else:
+            token = _lock(key)
+            if token is None:
+                cached = _decode(_wait_for(key))
+                if cached is not None:
+                    return cached[0]
+        try:
+            return self.compute(key, tags, args, kwargs)
+        finally:
+            if token is not None:
+                _unlock(key, token)
+
+
+def _refresh_early(ttl, delta):
+    if ttl is None or delta is None or ttl < 0:
+        return False
+    # -log(u) with u in (0, 1] is exponentially distributed, so the closer the
+    # expiration relative to the time the value takes to compute, the likelier
+    gap = -float(delta) * XFETCH_BETA * math.log(1 - random.random())
+    return gap * 1000 >= ttl
+
+
+def _lock(key):
+    """Take the lock to recompute a key. Returns its token, or None if
+    somebody else has it."""
+    token = uuid.uuid4().hex
+    if sentinel.master.set(key + LOCK_SUFFIX, token, ex=LOCK_TIMEOUT,
+                           nx=True):
+        return token
+    return None
+
+
+def _unlock(key, token):
+    _unlock_script(keys=[key + LOCK_SUFFIX], args=[token],
+                   client=sentinel.master)
+
+
+def _wait_for(key):
+    """Wait for somebody else to recompute a key, for LOCK_WAIT seconds at
+    most."""
+    deadline = time.time() + LOCK_WAIT
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        output = sentinel.slave.get(key)
+        if output:
+            return output
+    return None
+
+
+def _enqueue_refresh(function, args, kwargs, key):
+    """Enqueue a job to refresh a stale value, unless there is one."""
+    from rq import Queue
+    from pybossa.jobs import refresh_cached
+    if not sentinel.master.set(key + REFRESHING_SUFFIX, 1, ex=LOCK_TIMEOUT,
+                               nx=True):
+        return False
+    queue = Queue('high', connection=sentinel.master)
+    queue.enqueue_call(func=refresh_cached, args=(function, args, kwargs),
+                       timeout=LOCK_TIMEOUT)
+    return True
+
+
+def cache(key_prefix, timeout=300, expensive=False, stale_ttl=None,
+          compress=False):
     """
     Decorator for caching functions.
 
+    If expensive, the value is only recomputed by one caller at a time, and
+    it is refreshed before it expires. With stale_ttl, an expired value is
+    still returned for stale_ttl seconds, while a background job refreshes
+    it. With compress, large values are stored compressed.
+
+    The decorated function has a refresh method, to recompute and store its
+    value, and a cache_key method, that returns the key of its value.
+
     Returns the function value from cache, or the function if cache disabled
 
     """
     if timeout is None:
         timeout = 300
     def decorator(f):
+        cached = _CachedFunction(f, key_prefix, timeout, expensive, stale_ttl,
+                                 compress)
+        cached_functions[cached.name] = cached
+        key = "%s::%s" % (settings.REDIS_KEYPREFIX, key_prefix)
         @wraps(f)
         def wrapper(*args, **kwargs):
-            key = "%s::%s" % (settings.REDIS_KEYPREFIX, key_prefix)
-            if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-                output = sentinel.slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                output = f(*args, **kwargs)
-                sentinel.master.setex(key, timeout, pickle.dumps(output))
-                return output
-            output = f(*args, **kwargs)
-            sentinel.master.setex(key, timeout, pickle.dumps(output))
-            return output
+            return cached.get(wrapper, key, (), args, kwargs)
+        def refresh(*args, **kwargs):
+            return cached.compute(key, (), args, kwargs)
+        def cache_key(*args, **kwargs):
+            return key
+        wrapper.refresh = refresh
+        wrapper.cache_key = cache_key
+        wrapper.cached = cached
         return wrapper
     return decorator
 
 
-def memoize(timeout=300):
+def memoize(timeout=300, tag=None, expensive=False, stale_ttl=None,
+            compress=False, many=None):
     """
     Decorator for caching functions using its arguments as part of the key.
 
+    The values are tagged with the function, and with the tag returned by
+    calling tag with the same arguments, if given. The expensive, stale_ttl
+    and compress options, and the refresh method, are the same as for
+    cache.
+
+    The decorated function also has a get_many method, that takes a list of
+    arguments (tuples of them, or single arguments) and returns their values
+    reading them with a single MGET. The missing values are computed with
+    many, if given, a function taking the list of the missing arguments
+    tuples (e.g. to compute them with a single query), and stored with a
+    single pipeline.
+
     Returns the cached value, or the function if the cache is disabled
 
     """
     if timeout is None:
         timeout = 300
     def decorator(f):
-        @wraps(f)
-        def wrapper(*args, **kwargs):
+        cached = _CachedFunction(f, f.__name__, timeout, expensive, stale_ttl,
+                                 compress, many)
+        cached_functions[cached.name] = cached
+        def key_and_tags(args, kwargs):
             key = "%s:%s_args:" % (settings.REDIS_KEYPREFIX, f.__name__)
             key_to_hash = get_key_to_hash(*args, **kwargs)
             key = get_hash_key(key, key_to_hash)
-            if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-                output = sentinel.slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                output = f(*args, **kwargs)
-                sentinel.master.setex(key, timeout, pickle.dumps(output))
-                return output
-            output = f(*args, **kwargs)
-            sentinel.master.setex(key, timeout, pickle.dumps(output))
-            return output
+            tags = [_function_tag(f)]
+            if tag is not None:
+                tags.append(tag(*args, **kwargs))
+            return key, tags
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key, tags = key_and_tags(args, kwargs)
+            return cached.get(wrapper, key, tags, args, kwargs)
+        def refresh(*args, **kwargs):
+            key, tags = key_and_tags(args, kwargs)
+            return cached.compute(key, tags, args, kwargs)
+        def get_many(args_list):
+            args_list = [args if isinstance(args, tuple) else (args,)
+                         for args in args_list]
+            keys_and_tags = [key_and_tags(args, {}) for args in args_list]
+            return cached.get_many(keys_and_tags, args_list)
+        def cache_key(*args, **kwargs):
+            return key_and_tags(args, kwargs)[0]
+        wrapper.refresh = refresh
+        wrapper.get_many = get_many
+        wrapper.cache_key = cache_key
+        wrapper.cached = cached
         return wrapper
     return decorator
 
 
+def ttl_left(calls):
+    """Return how many seconds the cached value of every (function, args,
+    kwargs) of a list has before it has to be recomputed (negative if it is
+    missing), reading them with one pipeline."""
+    pipeline = sentinel.slave.pipeline(transaction=False)
+    for function, args, kwargs in calls:
+        pipeline.pttl(function.cache_key(*args, **kwargs))
+    ttls = pipeline.execute() if calls else []
+    return [float(ttl) / 1000 - (function.cached.stale_ttl or 0)
+            if ttl >= 0 else -1
+            for (function, args, kwargs), ttl in zip(calls, ttls)]
+
+
+def _function_tag(function):
+    return "%s_args" % function.__name__
+
+
 def delete_cached(key):
     """
     Delete a cached value from the cache.
@@ -130,8 +612,10 @@ def delete_cached(key):
     Returns True if success or no cache is enabled
 
     """
-    if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
+    if not disabled:
+        metrics.invalidated(key)
         key = "%s::%s" % (settings.REDIS_KEYPREFIX, key)
+        _invalidate(key)
         return bool(sentinel.master.delete(key))
     return True
 
@@ -143,14 +627,39 @@ def delete_memoized(function, *args, **kwargs):
     Returns True if success or no cache is enabled
 
     """
-    if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
+    if not disabled:
         key = "%s:%s_args:" % (settings.REDIS_KEYPREFIX, function.__name__)
         if args or kwargs:
             key_to_hash = get_key_to_hash(*args, **kwargs)
             key = get_hash_key(key, key_to_hash)
+            metrics.invalidated(function.__name__)
+            _invalidate(key)
             return bool(sentinel.master.delete(key))
-        keys_to_delete = sentinel.slave.keys(pattern=key + '*')
-        if not keys_to_delete:
-            return False
-        return bool(sentinel.master.delete(*keys_to_delete))
+        _invalidate(key + '*')
+        return _delete_tag(_function_tag(function))
+    return True
+
+
+def delete_tagged(tag):
+    """
+    Delete the memoized values with a tag.
+
+    Returns True if any value was deleted or no cache is enabled
+
+    """
+    if not disabled:
+        return _delete_tag(tag, publish=True)
     return True
+
+
+def _delete_tag(tag, publish=False):
+    result = _delete_tag_script(keys=[_tag_key(tag)], args=[time.time()],
+                                client=sentinel.master)
+    deleted, keys = result[0], result[1:]
+    prefix = "%s:" % settings.REDIS_KEYPREFIX
+    for key in keys:
+        # Keys look like <prefix>:<function>_args:<hash>
+        metrics.invalidated(key[len(prefix):].split('_args:')[0])
+        if publish and local_cache.enabled:
+            _invalidate(key)
+    return bool(deleted)
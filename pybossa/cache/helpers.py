@@ -21,9 +21,13 @@ from sqlalchemy.sql import text
 from pybossa.core import db
 from pybossa.cache import memoize, ONE_HOUR
 from pybossa.cache.projects import overall_progress
+import pybossa.answered_tasks as answered_tasks
 
 
 session = db.slave_session
+# Above this number of answered tasks, they are not sent to the DB (as
+# sched.MAX_ANSWERED_IN_MEMORY)
+MAX_ANSWERED_IN_QUERY = 1000
 
 
 @memoize(timeout=ONE_HOUR * 3)
@@ -33,6 +37,11 @@ def n_available_tasks(project_id, user_id=None, user_ip=None):
     based on the completion of the project tasks, and previous task_runs
     submitted by the user.
     """
+    answered = answered_tasks.get(project_id,
+                                  user_id=None if user_ip else user_id,
+                                  user_ip=user_ip)
+    if answered is not None and len(answered) <= MAX_ANSWERED_IN_QUERY:
+        return _n_available_tasks_from_index(project_id, answered)
     if user_id and not user_ip:
         query = text('''SELECT COUNT(id) AS n_tasks FROM task WHERE NOT EXISTS
                        (SELECT task_id FROM task_run WHERE
@@ -58,6 +67,20 @@ def n_available_tasks(project_id, user_id=None, user_ip=None):
     return n_tasks
 
 
+def _n_available_tasks_from_index(project_id, answered):
+    """Return the number of open tasks not in the answered task ids."""
+    query = text('''SELECT COUNT(id) AS n_tasks FROM task
+                 WHERE project_id=:project_id AND state !='completed';''')
+    n_tasks = session.execute(query, dict(project_id=project_id)).scalar()
+    if answered:
+        query = text('''SELECT COUNT(id) AS n_tasks FROM task
+                     WHERE id = ANY(:task_ids) AND project_id=:project_id
+                     AND state !='completed';''')
+        n_tasks -= session.execute(query, dict(project_id=project_id,
+                                               task_ids=list(answered))).scalar()
+    return n_tasks
+
+
 def check_contributing_state(project, user_id=None, user_ip=None):
     """Return the state of a given project for a given user.
 
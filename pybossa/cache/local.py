@@ -0,0 +1,151 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In-process cache in front of the Redis cache.
+
+Every process keeps the most recently used cache entries in memory, for a
+few seconds, so hot keys do not need a Redis round trip. Explicit deletions
+are published on a Redis channel, and every process listening on it drops
+its copy.
+
+"""
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+class LocalCache(object):
+
+    """Bounded LRU cache whose entries expire after their own TTL."""
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        """Return the value of a key, or None if it is missing or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return None
+            # Move it to the end, as the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        """Store a value for ttl seconds, evicting the least recently used
+        entries if the cache is full."""
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (time.time() + ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(prefix)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the size and the hit, miss and eviction counters."""
+        with self._lock:
+            return dict(size=len(self._entries), max_size=self.max_size,
+                        hits=self.hits, misses=self.misses,
+                        evictions=self.evictions)
+
+
+class Invalidator(object):
+
+    """Publishes the deleted keys, and drops them from the local cache of
+    this process when they are published by any other."""
+
+    RETRY_DELAY = 1
+
+    def __init__(self, local_cache, channel):
+        self.local_cache = local_cache
+        self.channel = channel
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def publish(self, redis, pattern):
+        """Publish a key, or a prefix followed by '*'."""
+        redis.publish(self.channel, pattern)
+
+    def handle(self, pattern):
+        if pattern.endswith('*'):
+            self.local_cache.delete_prefix(pattern[:-1])
+        else:
+            self.local_cache.delete(pattern)
+
+    def ensure_listening(self, redis):
+        """Start listening on this process, if it is not already (e.g. it is
+        a worker forked after the master started listening)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.local_cache.clear()
+            thread = threading.Thread(target=self._listen, args=(redis,))
+            thread.daemon = True
+            thread.start()
+
+    def _listen(self, redis):
+        while True:
+            try:
+                pubsub = redis.pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.handle(message['data'])
+            except Exception:
+                # It runs without an app context, so not current_app.logger
+                log.exception('Local cache invalidation listener failed')
+            # Deletions may have been missed while disconnected
+            self.local_cache.clear()
+            time.sleep(self.RETRY_DELAY)
@@ -0,0 +1,163 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Metrics of the cached functions.
+
+Every process counts the hits, misses, computations (and the time they
+took and the size of their values) and invalidations of every cached
+function in memory, and adds them to a Redis hash per function every few
+seconds, so they can be read from any process. The accesses to every project
+(or anything else with a tag) are counted the same way, in a sorted set, so
+the most accessed ones can be warmed first.
+
+"""
+import time
+import threading
+from collections import defaultdict
+
+
+FIELDS = ('hits', 'misses', 'computations', 'compute_time', 'size',
+          'invalidations')
+
+
+class Metrics(object):
+
+    """Counters of the cached functions, flushed to Redis every
+    flush_interval seconds (never, if 0)."""
+
+    def __init__(self, key, flush_interval=60):
+        self.key = key
+        self.flush_interval = flush_interval
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._accesses = defaultdict(int)
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.flush_interval > 0
+
+    def _function_key(self, name):
+        return '%s:%s' % (self.key, name)
+
+    @property
+    def accesses_key(self):
+        return '%s:accesses' % self.key
+
+    def incr(self, name, field, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name][field] += value
+
+    def hits(self, name, n=1):
+        self.incr(name, 'hits', n)
+
+    def misses(self, name, n=1):
+        self.incr(name, 'misses', n)
+
+    def computed(self, name, seconds, size, n=1):
+        """Count n computations, that took seconds and whose values take size
+        bytes in total."""
+        if not self.enabled:
+            return
+        with self._lock:
+            counters = self._counters[name]
+            counters['computations'] += n
+            # In milliseconds, to add them with HINCRBY
+            counters['compute_time'] += int(seconds * 1000)
+            counters['size'] += size
+
+    def invalidated(self, name, n=1):
+        self.incr(name, 'invalidations', n)
+
+    def accessed(self, tag):
+        """Count an access to a tag (e.g. a project)."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._accesses[tag] += 1
+
+    def flush_if_due(self, redis):
+        if not self.enabled:
+            return
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush(redis)
+
+    def flush(self, redis):
+        """Add the counters of this process to Redis."""
+        with self._lock:
+            counters, accesses = self._counters, self._accesses
+            self._counters = defaultdict(lambda: defaultdict(int))
+            self._accesses = defaultdict(int)
+            self._last_flush = time.time()
+        if not counters and not accesses:
+            return
+        pipeline = redis.pipeline()
+        for name, fields in counters.iteritems():
+            pipeline.sadd(self.key, name)
+            for field, value in fields.iteritems():
+                if value:
+                    pipeline.hincrby(self._function_key(name), field, value)
+        for tag, n in accesses.iteritems():
+            pipeline.zincrby(self.accesses_key, tag, n)
+        pipeline.execute()
+
+    def most_accessed(self, redis, n):
+        """Return the n most accessed tags, with their number of accesses."""
+        return redis.zrevrange(self.accesses_key, 0, n - 1, withscores=True)
+
+    def decay_accesses(self, redis, factor=0.5):
+        """Multiply the number of accesses of every tag by factor, so recent
+        accesses count more than older ones."""
+        redis.zunionstore(self.accesses_key, {self.accesses_key: factor})
+
+    def get_all(self, redis):
+        """Return the metrics of every function, sorted by name, with their
+        hit rate and their average computation time (in milliseconds) and
+        size (in bytes)."""
+        self.flush(redis)
+        names = sorted(redis.smembers(self.key))
+        pipeline = redis.pipeline()
+        for name in names:
+            pipeline.hgetall(self._function_key(name))
+        metrics = []
+        for name, fields in zip(names, pipeline.execute()):
+            function = dict((field, int(fields.get(field) or 0))
+                            for field in FIELDS)
+            function['name'] = name
+            reads = function['hits'] + function['misses']
+            computations = function['computations']
+            function['hit_rate'] = (float(function['hits']) / reads
+                                    if reads else None)
+            function['avg_compute_time'] = (
+                float(function['compute_time']) / computations
+                if computations else None)
+            function['avg_size'] = (function['size'] / computations
+                                    if computations else None)
+            metrics.append(function)
+        return metrics
+
+    def reset(self, redis):
+        """Delete the metrics of every function."""
+        with self._lock:
+            self._counters = defaultdict(lambda: defaultdict(int))
+            self._accesses = defaultdict(int)
+        names = redis.smembers(self.key)
+        redis.delete(self.key, self.accesses_key,
+                     *[self._function_key(name) for name in names])
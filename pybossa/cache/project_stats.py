@@ -19,7 +19,7 @@
 from flask import current_app
 from sqlalchemy.sql import text
 from pybossa.core import db
-from pybossa.cache import memoize, ONE_DAY
+from pybossa.cache import memoize, ONE_DAY, ONE_HOUR
 from flask.ext.babel import gettext
 
 import pygeoip
@@ -42,7 +42,7 @@ def n_tasks(project_id):
     return projects.n_tasks(project_id)
 
 
-@memoize(timeout=ONE_DAY)
+@memoize(timeout=ONE_DAY, expensive=True)
 def stats_users(project_id, period=None):
     """Return users's stats for a given project_id."""
     users = {}
@@ -158,7 +158,7 @@ def convert_period_to_days(period):
     return int_period
 
 
-@memoize(timeout=ONE_DAY)
+@memoize(timeout=ONE_DAY, expensive=True)
 def stats_dates(project_id, period='15 day'):
     """Return statistics with dates for a project."""
     dates = {}
@@ -250,7 +250,7 @@ def stats_dates(project_id, period='15 day'):
     return dates, dates_anon, dates_auth
 
 
-@memoize(timeout=ONE_DAY)
+@memoize(timeout=ONE_DAY, expensive=True)
 def stats_hours(project_id, period='2 week'):
     """Return statistics of a project per hours."""
     hours = {}
@@ -539,7 +539,8 @@ def stats_format_users(project_id, users, anon_users, auth_users, geo=False):
                 n_anon=users['n_anon'], n_auth=users['n_auth'])
 
 
-@memoize(timeout=ONE_DAY)
+@memoize(timeout=ONE_DAY, expensive=True, stale_ttl=ONE_HOUR,
+         compress=True)
 def get_stats(project_id, geo=False, period='2 week'):
     """Return the stats of a given project."""
     hours, hours_anon, hours_auth, max_hours, \
@@ -16,16 +16,70 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 """Cache module for projects."""
+from functools import wraps
+from operator import itemgetter
 from sqlalchemy.sql import text
-from pybossa.core import db, timeouts
+from pybossa.core import db, sentinel, timeouts
 from pybossa.model.project import Project
 from pybossa.util import pretty_date
-from pybossa.cache import memoize, cache, delete_memoized, delete_cached
+from pybossa.cache import (memoize, cache, delete_memoized, delete_cached,
+                           delete_tagged, metrics, ONE_HOUR, FIVE_MINUTES)
+import pybossa.project_counters as project_counters
 
 
 session = db.slave_session
 
 
+def maintained(get_value):
+    """Return get_value(counters) of the maintained project counters, if they
+    are enabled and ready, instead of calling the decorated function (or its
+    get_many method, for a list of projects)."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(project_id):
+            counters = project_counters.get(project_id)
+            if counters is not None:
+                return get_value(counters)
+            return f(project_id)
+        def get_many(project_ids):
+            all_counters = project_counters.get_many(project_ids)
+            missing = [project_id for project_id, counters
+                       in zip(project_ids, all_counters) if counters is None]
+            computed = dict(zip(missing, f.get_many(missing)))
+            return [get_value(counters) if counters is not None
+                    else computed[project_id]
+                    for project_id, counters in zip(project_ids, all_counters)]
+        wrapper.get_many = get_many
+        return wrapper
+    return decorator
+
+
+def project_tag(project_id):
+    """Return the cache tag of the values of a project."""
+    return 'project:%s' % project_id
+
+
+def accessed(project_id):
+    """Count an access to a project, so the most accessed are warmed first."""
+    metrics.accessed(project_tag(project_id))
+    metrics.flush_if_due(sentinel.master)
+
+
+def _by_project(sql, args_list, default=0):
+    """Return the value of a query grouped by project for the project ids of
+    a list of arguments tuples."""
+    project_ids = [args[0] for args in args_list]
+    results = session.execute(sql, dict(project_ids=project_ids))
+    values = dict((row.project_id, row.value) for row in results)
+    return [values.get(project_id, default) for project_id in project_ids]
+
+
+def _progress(counters):
+    if counters['n_tasks'] != 0:
+        return (counters['n_completed_tasks'] * 100) / counters['n_tasks']
+    return 0
+
+
 @memoize(timeout=timeouts.get('APP_TIMEOUT'))
 def get_project(short_name):
     """Get project by short_name."""
@@ -34,7 +88,8 @@ def get_project(short_name):
 
 
 @cache(timeout=timeouts.get('STATS_FRONTPAGE_TIMEOUT'),
-       key_prefix="front_page_top_projects")
+       key_prefix="front_page_top_projects", expensive=True,
+       stale_ttl=ONE_HOUR)
 def get_top(n=4):
     """Return top n=4 projects."""
     sql = text('''SELECT project.id, project.name, project.short_name, project.description,
@@ -42,27 +97,26 @@ def get_top(n=4):
                COUNT(project_id) AS total FROM task_run, project
                WHERE project_id IS NOT NULL AND project.id=project_id AND project.hidden=0
                GROUP BY project.id ORDER BY total DESC LIMIT :limit;''')
-    results = session.execute(sql, dict(limit=n))
+    results = session.execute(sql, dict(limit=n)).fetchall()
+    stats = get_stats_many([row.id for row in results],
+                           ('n_volunteers', 'n_completed_tasks'))
     top_projects = []
-    for row in results:
+    for row, project_stats in zip(results, stats):
         project = dict(id=row.id, name=row.name, short_name=row.short_name,
                        description=row.description,
                        info=row.info,
-                       n_volunteers=n_volunteers(row.id),
-                       n_completed_tasks=n_completed_tasks(row.id))
+                       n_volunteers=project_stats['n_volunteers'],
+                       n_completed_tasks=project_stats['n_completed_tasks'])
         top_projects.append(project)
     return top_projects
 
 
-@memoize(timeout=timeouts.get('BROWSE_TASKS_TIMEOUT'))
+@memoize(timeout=timeouts.get('BROWSE_TASKS_TIMEOUT'), tag=project_tag,
+         stale_ttl=FIVE_MINUTES, compress=True)
 def browse_tasks(project_id):
     """Cache browse tasks view for a project."""
     sql = text('''
-               SELECT task.id, coalesce(ct, 0) as n_task_runs, task.n_answers
-               FROM task LEFT OUTER JOIN
-               (SELECT task_id, COUNT(id) AS ct FROM task_run
-               WHERE project_id=:project_id GROUP BY task_id) AS log_counts
-               ON task.id=log_counts.task_id
+               SELECT task.id, task.n_task_runs, task.n_answers FROM task
                WHERE task.project_id=:project_id ORDER BY id ASC
                ''')
     results = session.execute(sql, dict(project_id=project_id))
@@ -86,7 +140,15 @@ def _pct_status(n_task_runs, n_answers):
     return float(0)
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+def _n_tasks_many(args_list):
+    sql = text('''SELECT project_id, COUNT(id) AS value FROM task
+               WHERE project_id=ANY(:project_ids) GROUP BY project_id''')
+    return _by_project(sql, args_list)
+
+
+@maintained(itemgetter('n_tasks'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag=project_tag,
+         many=_n_tasks_many)
 def n_tasks(project_id):
     """Return number of tasks of a project."""
     sql = text('''SELECT COUNT(task.id) AS n_tasks FROM task
@@ -98,7 +160,16 @@ def n_tasks(project_id):
     return n_tasks
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+def _n_completed_tasks_many(args_list):
+    sql = text('''SELECT project_id, COUNT(id) AS value FROM task
+               WHERE project_id=ANY(:project_ids) AND state=\'completed\'
+               GROUP BY project_id''')
+    return _by_project(sql, args_list)
+
+
+@maintained(itemgetter('n_completed_tasks'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag=project_tag,
+         many=_n_completed_tasks_many)
 def n_completed_tasks(project_id):
     """Return number of completed tasks of a project."""
     sql = text('''SELECT COUNT(task.id) AS n_completed_tasks FROM task
@@ -111,7 +182,16 @@ def n_completed_tasks(project_id):
     return n_completed_tasks
 
 
-@memoize(timeout=timeouts.get('REGISTERED_USERS_TIMEOUT'))
+def _n_registered_volunteers_many(args_list):
+    sql = text('''SELECT project_id, COUNT(DISTINCT(user_id)) AS value
+               FROM task_run WHERE user_id IS NOT NULL AND user_ip IS NULL
+               AND project_id=ANY(:project_ids) GROUP BY project_id''')
+    return _by_project(sql, args_list)
+
+
+@maintained(itemgetter('n_registered_volunteers'))
+@memoize(timeout=timeouts.get('REGISTERED_USERS_TIMEOUT'), tag=project_tag,
+         many=_n_registered_volunteers_many)
 def n_registered_volunteers(project_id):
     """Return number of registered users that have participated in a project."""
     sql = text('''SELECT COUNT(DISTINCT(task_run.user_id))
@@ -127,7 +207,16 @@ def n_registered_volunteers(project_id):
     return n_registered_volunteers
 
 
-@memoize(timeout=timeouts.get('ANON_USERS_TIMEOUT'))
+def _n_anonymous_volunteers_many(args_list):
+    sql = text('''SELECT project_id, COUNT(DISTINCT(user_ip)) AS value
+               FROM task_run WHERE user_ip IS NOT NULL AND user_id IS NULL
+               AND project_id=ANY(:project_ids) GROUP BY project_id''')
+    return _by_project(sql, args_list)
+
+
+@maintained(itemgetter('n_anonymous_volunteers'))
+@memoize(timeout=timeouts.get('ANON_USERS_TIMEOUT'), tag=project_tag,
+         many=_n_anonymous_volunteers_many)
 def n_anonymous_volunteers(project_id):
     """Return number of anonymous users that have participated in a project."""
     sql = text('''SELECT COUNT(DISTINCT(task_run.user_ip))
@@ -150,7 +239,15 @@ def n_volunteers(project_id):
     return total
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+def n_volunteers_many(project_ids):
+    """Return total number of volunteers of a list of projects."""
+    return [n_anonymous + n_registered for n_anonymous, n_registered in
+            zip(n_anonymous_volunteers.get_many(project_ids),
+                n_registered_volunteers.get_many(project_ids))]
+
+
+@maintained(itemgetter('n_task_runs'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag=project_tag)
 def n_task_runs(project_id):
     """Return number of task_runs of a project."""
     sql = text('''SELECT COUNT(task_run.id) AS n_task_runs FROM task_run
@@ -163,7 +260,17 @@ def n_task_runs(project_id):
     return n_task_runs
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+def _overall_progress_many(args_list):
+    project_ids = [args[0] for args in args_list]
+    return [_progress(dict(n_tasks=tasks, n_completed_tasks=completed))
+            for tasks, completed in
+            zip(n_tasks.get_many(project_ids),
+                n_completed_tasks.get_many(project_ids))]
+
+
+@maintained(_progress)
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag=project_tag,
+         many=_overall_progress_many)
 def overall_progress(project_id):
     """Return the percentage of completed tasks for a project."""
     if n_tasks(project_id) != 0:
@@ -172,7 +279,15 @@ def overall_progress(project_id):
         return 0
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+def _last_activity_many(args_list):
+    sql = text('''SELECT project_id, MAX(finish_time) AS value FROM task_run
+               WHERE project_id=ANY(:project_ids) GROUP BY project_id''')
+    return _by_project(sql, args_list, default=None)
+
+
+@maintained(itemgetter('last_activity'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), tag=project_tag,
+         many=_last_activity_many)
 def last_activity(project_id):
     """Return last activity, date, from a project."""
     sql = text('''SELECT finish_time FROM task_run WHERE project_id=:project_id
@@ -186,6 +301,22 @@ def last_activity(project_id):
             return None
 
 
+def get_stats_many(project_ids, fields=('last_activity', 'overall_progress',
+                                        'n_tasks', 'n_volunteers')):
+    """Return a dict with the given stats of every project of a list, reading
+    each of them for all the projects at once."""
+    get_many = dict(n_tasks=n_tasks.get_many,
+                    n_completed_tasks=n_completed_tasks.get_many,
+                    n_volunteers=n_volunteers_many,
+                    overall_progress=overall_progress.get_many,
+                    last_activity=last_activity.get_many)
+    stats = [dict() for project_id in project_ids]
+    for field in fields:
+        for project_stats, value in zip(stats, get_many[field](project_ids)):
+            project_stats[field] = value
+    return stats
+
+
 # This function does not change too much, so cache it for a longer time
 @cache(timeout=timeouts.get('STATS_FRONTPAGE_TIMEOUT'),
        key_prefix="number_featured_projects")
@@ -209,18 +340,20 @@ def get_all_featured(category=None):
                WHERE project.featured=true AND project.hidden=0
                AND "user".id=project.owner_id GROUP BY project.id, "user".id;''')
 
-    results = session.execute(sql)
+    results = session.execute(sql).fetchall()
+    stats = get_stats_many([row.id for row in results])
     projects = []
-    for row in results:
+    for row, project_stats in zip(results, stats):
         project = dict(id=row.id, name=row.name, short_name=row.short_name,
                        created=row.created, description=row.description,
                        updated=row.updated,
-                       last_activity=pretty_date(last_activity(row.id)),
-                       last_activity_raw=last_activity(row.id),
+                       last_activity=pretty_date(
+                           project_stats['last_activity']),
+                       last_activity_raw=project_stats['last_activity'],
                        owner=row.owner,
-                       overall_progress=overall_progress(row.id),
-                       n_tasks=n_tasks(row.id),
-                       n_volunteers=n_volunteers(row.id),
+                       overall_progress=project_stats['overall_progress'],
+                       n_tasks=project_stats['n_tasks'],
+                       n_volunteers=project_stats['n_volunteers'],
                        info=row.info)
         projects.append(project)
     return projects
@@ -279,19 +412,21 @@ def get_all_draft(category=None):
                AND project.hidden=0
                AND project.owner_id="user".id;''')
 
-    results = session.execute(sql)
+    results = session.execute(sql).fetchall()
+    stats = get_stats_many([row.id for row in results])
     projects = []
-    for row in results:
+    for row, project_stats in zip(results, stats):
         project = dict(id=row.id, name=row.name, short_name=row.short_name,
                        created=row.created,
                        updated=row.updated,
                        description=row.description,
                        owner=row.owner,
-                       last_activity=pretty_date(last_activity(row.id)),
-                       last_activity_raw=last_activity(row.id),
-                       overall_progress=overall_progress(row.id),
-                       n_tasks=n_tasks(row.id),
-                       n_volunteers=n_volunteers(row.id),
+                       last_activity=pretty_date(
+                           project_stats['last_activity']),
+                       last_activity_raw=project_stats['last_activity'],
+                       overall_progress=project_stats['overall_progress'],
+                       n_tasks=project_stats['n_tasks'],
+                       n_volunteers=project_stats['n_volunteers'],
                        info=row.info)
         projects.append(project)
     return projects
@@ -346,9 +481,10 @@ def get_all(category):
                AND task.project_id=project.id
                GROUP BY project.id, "user".id ORDER BY project.name;''')
 
-    results = session.execute(sql, dict(category=category))
+    results = session.execute(sql, dict(category=category)).fetchall()
+    stats = get_stats_many([row.id for row in results])
     projects = []
-    for row in results:
+    for row, project_stats in zip(results, stats):
         project = dict(id=row.id,
                        name=row.name, short_name=row.short_name,
                        created=row.created,
@@ -356,11 +492,12 @@ def get_all(category):
                        description=row.description,
                        owner=row.owner,
                        featured=row.featured,
-                       last_activity=pretty_date(last_activity(row.id)),
-                       last_activity_raw=last_activity(row.id),
-                       overall_progress=overall_progress(row.id),
-                       n_tasks=n_tasks(row.id),
-                       n_volunteers=n_volunteers(row.id),
+                       last_activity=pretty_date(
+                           project_stats['last_activity']),
+                       last_activity_raw=project_stats['last_activity'],
+                       overall_progress=project_stats['overall_progress'],
+                       n_tasks=project_stats['n_tasks'],
+                       n_volunteers=project_stats['n_volunteers'],
                        info=row.info)
         projects.append(project)
     return projects
@@ -459,12 +596,9 @@ def clean(project_id):
 
 def clean_project(project_id):
     """Clean cache for a specific project"""
-    delete_browse_tasks(project_id)
-    delete_n_tasks(project_id)
-    delete_n_completed_tasks(project_id)
-    delete_n_registered_volunteers(project_id)
-    delete_n_anonymous_volunteers(project_id)
-    delete_n_volunteers(project_id)
-    delete_last_activity(project_id)
-    delete_n_task_runs(project_id)
-    delete_overall_progress(project_id)
+    if (project_counters.is_enabled() and
+            project_counters.is_ready(project_id)):
+        # The other values are read from the maintained counters
+        delete_browse_tasks(project_id)
+        return
+    delete_tagged(project_tag(project_id))
@@ -26,7 +26,7 @@ from pybossa.cache import cache, ONE_DAY
 session = db.slave_session
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_n_auth_users")
+@cache(timeout=ONE_DAY, key_prefix="site_n_auth_users", expensive=True)
 def n_auth_users():
     """Return number of authenticated users."""
     sql = text('''SELECT COUNT("user".id) AS n_auth FROM "user";''')
@@ -36,7 +36,7 @@ def n_auth_users():
     return n_auth or 0
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_n_anon_users")
+@cache(timeout=ONE_DAY, key_prefix="site_n_anon_users", expensive=True)
 def n_anon_users():
     """Return number of anonymous users."""
     sql = text('''SELECT COUNT(DISTINCT(task_run.user_ip))
@@ -48,7 +48,7 @@ def n_anon_users():
     return n_anon or 0
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_n_tasks")
+@cache(timeout=ONE_DAY, key_prefix="site_n_tasks", expensive=True)
 def n_tasks_site():
     """Return number of tasks in the server."""
     sql = text('''SELECT COUNT(task.id) AS n_tasks FROM task''')
@@ -58,7 +58,7 @@ def n_tasks_site():
     return n_tasks or 0
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_n_total_tasks")
+@cache(timeout=ONE_DAY, key_prefix="site_n_total_tasks", expensive=True)
 def n_total_tasks_site():
     """Return number of total tasks based on redundancy."""
     sql = text('''SELECT SUM(n_answers) AS n_tasks FROM task''')
@@ -68,7 +68,7 @@ def n_total_tasks_site():
     return total or 0
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_n_task_runs")
+@cache(timeout=ONE_DAY, key_prefix="site_n_task_runs", expensive=True)
 def n_task_runs_site():
     """Return number of task runs in the server."""
     sql = text('''SELECT COUNT(task_run.id) AS n_task_runs FROM task_run''')
@@ -78,7 +78,7 @@ def n_task_runs_site():
     return n_task_runs or 0
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_top5_apps_24_hours")
+@cache(timeout=ONE_DAY, key_prefix="site_top5_apps_24_hours", expensive=True)
 def get_top5_projects_24_hours():
     """Return the top 5 projects more active in the last 24 hours."""
     # Top 5 Most active projects in last 24 hours
@@ -100,7 +100,7 @@ def get_top5_projects_24_hours():
     return top5_apps_24_hours
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_top5_users_24_hours")
+@cache(timeout=ONE_DAY, key_prefix="site_top5_users_24_hours", expensive=True)
 def get_top5_users_24_hours():
     """Return top 5 users in last 24 hours."""
     # Top 5 Most active users in last 24 hours
@@ -122,7 +122,7 @@ def get_top5_users_24_hours():
     return top5_users_24_hours
 
 
-@cache(timeout=ONE_DAY, key_prefix="site_locs")
+@cache(timeout=ONE_DAY, key_prefix="site_locs", expensive=True)
 def get_locs():
     """Return locations (latitude, longitude) for anonymous users."""
     # All IP addresses from anonymous users
@@ -18,16 +18,17 @@
 """Cache module for users."""
 from sqlalchemy.sql import text
 from pybossa.core import db, timeouts
-from pybossa.cache import cache, memoize, delete_memoized
+from pybossa.cache import cache, memoize, delete_memoized, FIVE_MINUTES
 from pybossa.util import pretty_date
 from pybossa.model.user import User
-from pybossa.cache.projects import overall_progress, n_tasks, n_volunteers
+from pybossa.cache.projects import get_stats_many
 
 
 session = db.slave_session
 
 
-@memoize(timeout=timeouts.get('USER_TIMEOUT'))
+@memoize(timeout=timeouts.get('USER_TIMEOUT'), expensive=True,
+         stale_ttl=FIVE_MINUTES)
 def get_leaderboard(n, user_id=None):
     """Return the top n users with their rank."""
     sql = text('''
@@ -170,15 +171,17 @@ def projects_contributed(user_id):
                project.description, project.info FROM project, apps_contributed
                WHERE project.id=apps_contributed.project_id ORDER BY project.name DESC;
                ''')
-    results = session.execute(sql, dict(user_id=user_id))
+    results = session.execute(sql, dict(user_id=user_id)).fetchall()
+    stats = get_stats_many([row.id for row in results],
+                           ('overall_progress', 'n_tasks', 'n_volunteers'))
     projects_contributed = []
-    for row in results:
+    for row, project_stats in zip(results, stats):
         project = dict(id=row.id, name=row.name, short_name=row.short_name,
                        owner_id=row.owner_id,
                        description=row.description,
-                       overall_progress=overall_progress(row.id),
-                       n_tasks=n_tasks(row.id),
-                       n_volunteers=n_volunteers(row.id),
+                       overall_progress=project_stats['overall_progress'],
+                       n_tasks=project_stats['n_tasks'],
+                       n_volunteers=project_stats['n_volunteers'],
                        info=row.info)
         projects_contributed.append(project)
     return projects_contributed
@@ -203,14 +206,16 @@ def published_projects(user_id):
                project.description;
                ''')
     projects_published = []
-    results = session.execute(sql, dict(user_id=user_id))
-    for row in results:
+    results = session.execute(sql, dict(user_id=user_id)).fetchall()
+    stats = get_stats_many([row.id for row in results],
+                           ('overall_progress', 'n_tasks', 'n_volunteers'))
+    for row, project_stats in zip(results, stats):
         project = dict(id=row.id, name=row.name, short_name=row.short_name,
                        owner_id=row.owner_id,
                        description=row.description,
-                       overall_progress=overall_progress(row.id),
-                       n_tasks=n_tasks(row.id),
-                       n_volunteers=n_volunteers(row.id),
+                       overall_progress=project_stats['overall_progress'],
+                       n_tasks=project_stats['n_tasks'],
+                       n_volunteers=project_stats['n_volunteers'],
                        info=row.info)
         projects_published.append(project)
     return projects_published
@@ -235,14 +240,16 @@ def draft_projects(user_id):
                project.description;
                ''')
     projects_draft = []
-    results = session.execute(sql, dict(user_id=user_id))
-    for row in results:
+    results = session.execute(sql, dict(user_id=user_id)).fetchall()
+    stats = get_stats_many([row.id for row in results],
+                           ('overall_progress', 'n_tasks', 'n_volunteers'))
+    for row, project_stats in zip(results, stats):
         project = dict(id=row.id, name=row.name, short_name=row.short_name,
                        owner_id=row.owner_id,
                        description=row.description,
-                       overall_progress=overall_progress(row.id),
-                       n_tasks=n_tasks(row.id),
-                       n_volunteers=n_volunteers(row.id),
+                       overall_progress=project_stats['overall_progress'],
+                       n_tasks=project_stats['n_tasks'],
+                       n_volunteers=project_stats['n_volunteers'],
                        info=row.info)
         projects_draft.append(project)
     return projects_draft
@@ -266,14 +273,16 @@ def hidden_projects(user_id):
                GROUP BY project.id, project.name, project.short_name,
                project.description;''')
     projects_published = []
-    results = session.execute(sql, dict(user_id=user_id))
-    for row in results:
+    results = session.execute(sql, dict(user_id=user_id)).fetchall()
+    stats = get_stats_many([row.id for row in results],
+                           ('overall_progress', 'n_tasks', 'n_volunteers'))
+    for row, project_stats in zip(results, stats):
         project = dict(id=row.id, name=row.name, short_name=row.short_name,
                        owner_id=row.owner_id,
                        description=row.description,
-                       overall_progress=overall_progress(row.id),
-                       n_tasks=n_tasks(row.id),
-                       n_volunteers=n_volunteers(row.id),
+                       overall_progress=project_stats['overall_progress'],
+                       n_tasks=project_stats['n_tasks'],
+                       n_volunteers=project_stats['n_volunteers'],
                        info=row.info)
         projects_published.append(project)
     return projects_published
@@ -0,0 +1,209 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Cache warming.
+
+A warm-up builds the list of the (function, args, kwargs) calls of the most
+visited pages: the front page, the first pages of the project lists and the
+leaderboard first, and then the pages of the projects, the most accessed
+first (see pybossa.cache.projects.accessed). The calls whose cached value
+still has more than half its timeout left are skipped, and the rest are
+split in chunks, refreshed in order by several jobs of the super queue.
+
+The progress of the last warm-up is kept in a Redis hash (see last_report).
+
+"""
+import time
+from flask import current_app
+from rq import Queue
+from sqlalchemy.sql import text
+from pybossa.core import db, sentinel
+from pybossa.util import rank
+from pybossa.cache import refreshing, ttl_left, metrics
+from pybossa.cache import projects as cached_projects
+from pybossa.cache import categories as cached_cat
+from pybossa.cache import users as cached_users
+from pybossa.cache import project_stats
+import pybossa.project_counters as project_counters
+
+
+REPORT_KEY = 'pybossa:cache:warm'
+CHUNK_SIZE = 100
+CHUNK_TIMEOUT = 10 * 60
+# Calls whose value has less than this fraction of its timeout left are
+# warmed
+MIN_TTL_FRACTION = 0.5
+# Projects with at least this number of task runs get their stats warmed
+STATS_MIN_TASK_RUNS = 1000
+PAGES = 3
+
+
+def _call(function, *args, **kwargs):
+    return (function, args, kwargs)
+
+
+def _projects(project_ids):
+    """Return the short name and number of task runs of a list of
+    projects, by id."""
+    if not project_ids:
+        return {}
+    # The task_project_id_n_task_runs_idx index covers the task columns
+    sql = text('''SELECT project.id, project.short_name,
+               COALESCE(SUM(task.n_task_runs), 0) AS n_task_runs FROM project
+               LEFT JOIN task ON task.project_id=project.id
+               WHERE project.id=ANY(:project_ids) GROUP BY project.id''')
+    results = db.slave_session.execute(sql, dict(project_ids=project_ids))
+    return dict((row.id, row) for row in results)
+
+
+def _project_calls(project, featured=False):
+    calls = [_call(cached_projects.get_project, project.short_name)]
+    if not project_counters.is_enabled():
+        # Otherwise, they are read from the maintained counters
+        for function in (cached_projects.n_tasks,
+                         cached_projects.n_task_runs,
+                         cached_projects.n_completed_tasks,
+                         cached_projects.n_registered_volunteers,
+                         cached_projects.n_anonymous_volunteers,
+                         cached_projects.overall_progress,
+                         cached_projects.last_activity):
+            calls.append(_call(function, project.id))
+    calls.append(_call(cached_projects.browse_tasks, project.id))
+    if featured or project.n_task_runs >= STATS_MIN_TASK_RUNS:
+        calls.append(_call(project_stats.get_stats, project.id,
+                           current_app.config.get('GEO'), period='2 week'))
+    return calls
+
+
+def get_calls(n_projects=None):
+    """Return the list of calls to warm, the most important first."""
+    config = current_app.config
+    n_projects = n_projects or config.get('CACHE_WARM_PROJECTS')
+    per_page = PAGES * config['APPS_PER_PAGE']
+    calls = [_call(cached_projects.get_top),
+             _call(cached_projects.get_all_featured),
+             _call(cached_projects.get_all_featured, 'featured'),
+             _call(cached_users.get_leaderboard, 10),
+             _call(cached_users.get_leaderboard, config['LEADERBOARD'],
+                   user_id=None)]
+
+    # The projects listed on the first pages, and the most accessed ones
+    listed = set(project['id'] for project in cached_projects.get_top())
+    projects = rank(cached_projects.get_all_featured('featured'))
+    featured = set(project['id'] for project in projects[:per_page])
+    for category in cached_cat.get_used():
+        calls.append(_call(cached_projects.get_all, category['short_name']))
+        projects = rank(cached_projects.get_all(category['short_name']))
+        listed.update(project['id'] for project in projects[:per_page])
+    accesses = {}
+    for tag, score in metrics.most_accessed(sentinel.master, n_projects):
+        accesses[int(tag.split(':')[1])] = score
+
+    users = cached_users.get_leaderboard(config['LEADERBOARD'])
+    for user in users:
+        calls.append(_call(cached_users.get_user_summary, user['name']))
+        calls.append(_call(cached_users.projects_contributed_cached,
+                           user['id']))
+        calls.append(_call(cached_users.published_projects_cached,
+                           user['id']))
+        calls.append(_call(cached_users.draft_projects_cached, user['id']))
+
+    project_ids = sorted(listed | featured | set(accesses),
+                         key=lambda project_id: -accesses.get(project_id, 0))
+    projects = _projects(project_ids)
+    for project_id in project_ids:
+        if project_id in projects:
+            calls.extend(_project_calls(projects[project_id],
+                                        featured=project_id in featured))
+    return calls
+
+
+def warm(enqueue=True):
+    """Warm the calls whose values are missing or about to expire.
+
+    They are split in chunks, refreshed by jobs of the super queue if
+    enqueue, or in this process otherwise. Returns the report of the
+    warm-up, as last_report.
+    """
+    started = time.time()
+    calls = get_calls()
+    ttls = ttl_left(calls)
+    pending = [call for call, ttl in zip(calls, ttls)
+               if ttl < call[0].cached.timeout * MIN_TTL_FRACTION]
+    chunks = [pending[i:i + CHUNK_SIZE]
+              for i in range(0, len(pending), CHUNK_SIZE)]
+    pipeline = sentinel.master.pipeline()
+    pipeline.delete(REPORT_KEY)
+    pipeline.hmset(REPORT_KEY, dict(started=started, calls=len(calls),
+                                    fresh=len(calls) - len(pending),
+                                    pending=len(pending), warmed=0, failed=0,
+                                    chunks=len(chunks)))
+    pipeline.execute()
+    # Older accesses count less in the next warm-ups
+    metrics.decay_accesses(sentinel.master)
+    if enqueue:
+        from pybossa.jobs import warm_cache_calls
+        queue = Queue('super', connection=sentinel.master)
+        for chunk in chunks:
+            queue.enqueue_call(func=warm_cache_calls, args=(chunk,),
+                               timeout=CHUNK_TIMEOUT)
+    else:
+        for chunk in chunks:
+            warm_calls(chunk)
+    return last_report()
+
+
+def warm_calls(calls):
+    """Refresh the cached values of a list of calls, and add them to the
+    report of the warm-up."""
+    warmed = failed = 0
+    with refreshing():
+        for function, args, kwargs in calls:
+            try:
+                function(*args, **kwargs)
+                warmed += 1
+            except Exception as e:
+                current_app.logger.error(e)
+                failed += 1
+    pipeline = sentinel.master.pipeline()
+    pipeline.hincrby(REPORT_KEY, 'warmed', warmed)
+    pipeline.hincrby(REPORT_KEY, 'failed', failed)
+    pipeline.hincrby(REPORT_KEY, 'pending', -len(calls))
+    pipeline.hset(REPORT_KEY, 'finished', time.time())
+    pipeline.execute()
+    return warmed
+
+
+def last_report():
+    """Return the report of the last warm-up: its number of calls, how many
+    were fresh, warmed, failed or are still pending, its coverage (the
+    fraction of fresh or warmed calls) and duration in seconds, once it has
+    finished."""
+    report = sentinel.master.hgetall(REPORT_KEY)
+    if not report:
+        return None
+    out = dict((field, int(report.get(field) or 0))
+               for field in ('calls', 'fresh', 'pending', 'warmed', 'failed',
+                             'chunks'))
+    out['coverage'] = (float(out['fresh'] + out['warmed']) / out['calls']
+                       if out['calls'] else 1.0)
+    out['duration'] = None
+    if out['pending'] <= 0:
+        finished = float(report.get('finished') or report['started'])
+        out['duration'] = finished - float(report['started'])
+    return out
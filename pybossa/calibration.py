@@ -0,0 +1,163 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Calibration (gold) tasks of the projects.
+
+Projects with a calibration_frac send that share of their tasks from the
+pool of open calibration tasks (task.calibration = 1), which is kept in a
+Redis set per project, so picking one is a single SRANDMEMBER. Completed
+tasks leave the pool.
+
+The answer of a calibration task is compared with task.info['gold_answer'],
+and the number of calibration tasks seen and answered correctly by every
+volunteer is kept in a Redis hash, updated as the task runs arrive. The
+gold answer is removed from the tasks served to the volunteers.
+
+"""
+from pybossa.core import sentinel
+
+
+POOL_KEY = 'pybossa:sched:calibration:%s'
+READY_KEY = 'pybossa:sched:calibration:%s:ready'
+BUILDING_KEY = 'pybossa:sched:calibration:%s:building'
+BUILD_TIMEOUT = 10 * 60
+ACCURACY_KEY = 'pybossa:calibration:accuracy:%s:%s'
+GOLD_ANSWER = 'gold_answer'
+
+
+def _volunteer(user_id=None, user_ip=None):
+    if user_id:
+        return 'user:%s' % user_id
+    return 'ip:%s' % (user_ip or '127.0.0.1')
+
+
+def add_task(project_id, task_id, pipeline=None):
+    """Add a calibration task to the pool of the project."""
+    redis = sentinel.master if pipeline is None else pipeline
+    redis.sadd(POOL_KEY % project_id, task_id)
+
+
+def remove_task(project_id, task_id, pipeline=None):
+    """Remove a task from the calibration pool of the project."""
+    redis = sentinel.master if pipeline is None else pipeline
+    redis.srem(POOL_KEY % project_id, task_id)
+
+
+def mark_as_ready(project_id, pipeline=None):
+    """Mark the pool of a project as complete."""
+    redis = sentinel.master if pipeline is None else pipeline
+    redis.set(READY_KEY % project_id, 1)
+
+
+def enqueue_rebuild(project_id):
+    """Enqueue a background rebuild of the pool, unless one is running."""
+    from rq import Queue
+    if not sentinel.master.set(BUILDING_KEY % project_id, 1,
+                               ex=BUILD_TIMEOUT, nx=True):
+        return False
+    queue = Queue('high', connection=sentinel.master)
+    queue.enqueue_call(func=rebuild, args=(project_id,),
+                       timeout=BUILD_TIMEOUT)
+    return True
+
+
+def rebuild(project_id):
+    """Rebuild the calibration pool of a project from the DB.
+
+    It only adds the open calibration tasks and removes the completed ones,
+    so calibration tasks created meanwhile are not lost.
+    """
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    sql = text('''SELECT id, state FROM task
+               WHERE project_id=:project_id AND calibration=1;''')
+    rows = db.slave_session.execute(sql, dict(project_id=project_id))
+    task_ids, completed = [], []
+    for row in rows:
+        if row.state == 'completed':
+            completed.append(row.id)
+        else:
+            task_ids.append(row.id)
+    pipeline = sentinel.master.pipeline()
+    if task_ids:
+        pipeline.sadd(POOL_KEY % project_id, *task_ids)
+    if completed:
+        pipeline.srem(POOL_KEY % project_id, *completed)
+    pipeline.set(READY_KEY % project_id, 1)
+    pipeline.delete(BUILDING_KEY % project_id)
+    pipeline.execute()
+    return len(task_ids)
+
+
+def sample_task_ids(project_id, n=1):
+    """Return up to n distinct random calibration task ids.
+
+    Returns None if the pool of the project is not ready.
+    """
+    pipeline = sentinel.master.pipeline()
+    pipeline.get(READY_KEY % project_id)
+    pipeline.srandmember(POOL_KEY % project_id, n)
+    ready, task_ids = pipeline.execute()
+    if not ready:
+        return None
+    return [int(task_id) for task_id in task_ids]
+
+
+def is_correct(answer, gold_answer):
+    """Return True if answer matches the gold answer.
+
+    If both are dicts, only the keys of the gold answer are compared.
+    """
+    if isinstance(answer, dict) and isinstance(gold_answer, dict):
+        return all(answer.get(key) == value
+                   for key, value in gold_answer.items())
+    return answer == gold_answer
+
+
+def record_answer(project_id, answer, gold_answer, user_id=None,
+                  user_ip=None, pipeline=None):
+    """Update the calibration accuracy of a volunteer with a new answer.
+
+    If a pipeline is given, the commands are only added to it.
+    """
+    key = ACCURACY_KEY % (project_id, _volunteer(user_id, user_ip))
+    execute = pipeline is None
+    if execute:
+        pipeline = sentinel.master.pipeline()
+    pipeline.hincrby(key, 'seen', 1)
+    pipeline.hincrby(key, 'correct', int(is_correct(answer, gold_answer)))
+    if execute:
+        pipeline.execute()
+
+
+def hide_gold_answer(task_data):
+    """Return the dictized task without its gold answer."""
+    info = task_data.get('info')
+    if isinstance(info, dict) and GOLD_ANSWER in info:
+        info = dict(info)
+        del info[GOLD_ANSWER]
+        task_data = dict(task_data, info=info)
+    return task_data
+
+
+def get_accuracy(project_id, user_id=None, user_ip=None):
+    """Return the calibration tasks seen and answered correctly by a
+    volunteer."""
+    key = ACCURACY_KEY % (project_id, _volunteer(user_id, user_ip))
+    seen, correct = sentinel.master.hmget(key, 'seen', 'correct')
+    return dict(seen=int(seen or 0), correct=int(correct or 0))
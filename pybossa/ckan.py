@@ -28,7 +28,8 @@ class Ckan(object):
 
     def _field_setup(self, obj):
         int_fields = ['id', 'project_id', 'task_id', 'user_id',
-                      'n_answers', 'timeout', 'calibration', 'quorum']
+                      'n_answers', 'n_task_runs', 'timeout', 'calibration',
+                      'quorum']
         text_fields = ['state', 'user_ip']
         float_fields = ['priority_0']
         timestamp_fields = ['created', 'finish_time']
@@ -0,0 +1,157 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Early completion of tasks once the volunteers agree on the answer.
+
+A project can set a completion policy in project.info['completion']:
+
+    * field: key of the task run info to compare (the whole info if not set).
+      Answers without it are not tallied.
+    * k: complete the task once k answers are identical, and/or
+    * agreement: complete the task once this share (e.g. 0.75) of the
+      answers are identical, after at least min_answers (default 3) answers.
+
+The answers of every task are tallied in a Redis hash on every task run
+insert, so the policy is evaluated without reading the previous task runs.
+The tally is read during the flush, but only updated once the task runs are
+committed (see pybossa.side_effects).
+
+"""
+import json
+from pybossa.core import sentinel
+
+
+TALLY_KEY = 'pybossa:completion:tally:%s'
+TOTAL_FIELD = 'total'
+# Tallies of tasks that stop receiving answers are eventually dropped.
+TALLY_TIMEOUT = 30 * 24 * 60 * 60
+DEFAULT_MIN_ANSWERS = 3
+
+# KEYS[1]: tally, ARGV[1]: answer. Tallies that expired are not recreated.
+REMOVE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+    redis.call('HINCRBY', KEYS[1], ARGV[2], -1)
+end
+"""
+
+_remove_script = sentinel.register_script(REMOVE_SCRIPT)
+
+
+def get_policy(project_info):
+    """Return the completion policy of a project, or None."""
+    policy = (project_info or {}).get('completion')
+    if not isinstance(policy, dict):
+        return None
+    if not (policy.get('k') or policy.get('agreement')):
+        return None
+    return policy
+
+
+def answer_field(policy, info):
+    """Return the tally field of an answer, or None if it has no value for
+    the field of the policy."""
+    field = policy.get('field')
+    if field:
+        if not isinstance(info, dict) or field not in info:
+            return None
+        answer = info[field]
+    else:
+        answer = info
+    return 'a:%s' % json.dumps(answer, sort_keys=True)
+
+
+def get_counts(task_id, answer):
+    """Return (identical answers, total answers) tallied for a task."""
+    count, total = sentinel.master.hmget(TALLY_KEY % task_id, answer,
+                                         TOTAL_FIELD)
+    return int(count or 0), int(total or 0)
+
+
+def add_answer(task_id, answer, pipeline=None):
+    """Tally a new answer (a field returned by answer_field)."""
+    key = TALLY_KEY % task_id
+    execute = pipeline is None
+    if execute:
+        pipeline = sentinel.master.pipeline()
+    pipeline.hincrby(key, answer, 1)
+    pipeline.hincrby(key, TOTAL_FIELD, 1)
+    pipeline.expire(key, TALLY_TIMEOUT)
+    if execute:
+        pipeline.execute()
+
+
+def remove_answer(task_id, answer, pipeline=None):
+    """Remove a deleted answer from the tally of a task."""
+    _remove_script(keys=[TALLY_KEY % task_id], args=[answer, TOTAL_FIELD],
+                   client=pipeline)
+
+
+def is_reached(policy, count, total):
+    """Return True if count identical answers out of total meet the policy."""
+    k = policy.get('k')
+    if k and count >= int(k):
+        return True
+    agreement = policy.get('agreement')
+    min_answers = int(policy.get('min_answers') or DEFAULT_MIN_ANSWERS)
+    if agreement and total >= min_answers:
+        return float(count) / total >= float(agreement)
+    return False
+
+
+def rebuild(project_id):
+    """Recompute the tallies of the open tasks of a project from the DB.
+
+    It is meant for maintenance (e.g. after task runs are deleted in bulk),
+    as the answers submitted meanwhile may be lost.
+    """
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    info = db.slave_session.execute(
+        text('SELECT info FROM project WHERE id=:project_id;'),
+        dict(project_id=project_id)).scalar()
+    policy = get_policy(info)
+    sql = text('''SELECT task.id AS task_id, task_run.info FROM task
+               LEFT JOIN task_run ON task_run.task_id=task.id
+               WHERE task.project_id=:project_id
+               AND task.state!='completed';''')
+    rows = db.slave_session.execute(sql, dict(project_id=project_id))
+    tallies = {}
+    for row in rows:
+        tally = tallies.setdefault(row.task_id, {})
+        if policy is None or row.info is None:
+            continue
+        answer = answer_field(policy, row.info)
+        if answer is not None:
+            tally[answer] = tally.get(answer, 0) + 1
+            tally[TOTAL_FIELD] = tally.get(TOTAL_FIELD, 0) + 1
+    pipeline = sentinel.master.pipeline()
+    for task_id, tally in tallies.items():
+        key = TALLY_KEY % task_id
+        pipeline.delete(key)
+        if tally:
+            pipeline.hmset(key, tally)
+            pipeline.expire(key, TALLY_TIMEOUT)
+    pipeline.execute()
+    return len(tallies)
+
+
+def clear(task_id, pipeline=None):
+    """Drop the tally of a completed task."""
+    redis = sentinel.master if pipeline is None else pipeline
+    redis.delete(TALLY_KEY % task_id)
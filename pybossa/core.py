@@ -65,6 +65,7 @@ def create_app(run_as_server=True):
     setup_newsletter(app)
     plugin_manager.init_app(app)
     plugin_manager.install_plugins()
+    setup_schedulers()
     import pybossa.model.event_listeners
     return app
 
@@ -90,6 +91,14 @@ def configure_app(app):
             dict(slave=app.config.get('SQLALCHEMY_DATABASE_URI'))
 
 
+def setup_schedulers():
+    """Register the plugin schedulers and offer them in the settings."""
+    from pybossa.sched import load_scheduler_plugins, sched_variants
+    from pybossa.forms.forms import TaskSchedulerForm
+    load_scheduler_plugins()
+    TaskSchedulerForm.update_sched_options(sched_variants())
+
+
 def setup_theme(app):
     """Configure theme for PyBossa app."""
     theme = app.config['THEME']
@@ -513,7 +522,7 @@ def setup_scheduled_jobs(app):  # pragma: no cover
     """Setup scheduled jobs."""
     from datetime import datetime
     from pybossa.jobs import enqueue_periodic_jobs, schedule_job, \
-        get_quarterly_date
+        get_quarterly_date, update_projects_timestamp
     from rq_scheduler import Scheduler
     redis_conn = sentinel.master
     scheduler = Scheduler(queue_name='scheduled_jobs', connection=redis_conn)
@@ -534,6 +543,10 @@ def setup_scheduled_jobs(app):  # pragma: no cover
             dict(name=enqueue_periodic_jobs, args=['quaterly'], kwargs={},
                  interval=(3 * MONTH), timeout=(30 * MINUTE),
                  scheduled_time=first_quaterly_execution)]
+    if app.config.get('PROJECT_UPDATED_INTERVAL'):
+        JOBS.append(dict(name=update_projects_timestamp, args=[], kwargs={},
+                         interval=app.config['PROJECT_UPDATED_INTERVAL'],
+                         timeout=(10 * MINUTE)))
 
     for job in JOBS:
         schedule_job(job, scheduler)
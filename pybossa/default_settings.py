@@ -81,6 +81,14 @@ CATEGORY_TIMEOUT = 24 * 60 * 60
 USER_TIMEOUT = 15 * 60
 USER_TOP_TIMEOUT = 24 * 60 * 60
 USER_TOTAL_TIMEOUT = 24 * 60 * 60
+# In-process cache in front of Redis (number of values, 0 to disable)
+CACHE_LOCAL_SIZE = 0
+CACHE_LOCAL_TIMEOUT = 10
+# Add the metrics of the cached functions to Redis every N seconds (0 to
+# disable them)
+CACHE_METRICS_INTERVAL = 60
+# Number of most accessed projects to warm
+CACHE_WARM_PROJECTS = 1000
 
 # Project Presenters
 PRESENTERS = ["basic", "image", "sound", "video", "map", "pdf"]
@@ -111,3 +119,14 @@ ACCOUNT_CONFIRMATION_DISABLED = True
 
 # Send emails weekly update every
 WEEKLY_UPDATE_STATS = 'Sunday'
+
+# Write project.updated at most every n seconds (None writes it on every
+# task and task run change)
+PROJECT_UPDATED_INTERVAL = None
+
+# Queue the posted task runs in Redis and save them in the background
+TASK_RUN_WRITE_BEHIND = False
+
+# Maintain the project counters (tasks, task runs, volunteers) in Redis
+# instead of counting them again after every task run
+PROJECT_COUNTERS_MAINTAINED = False
@@ -26,12 +26,18 @@ except ImportError:  # pragma: no cover
 
 FEED_KEY = 'pybossa_feed'
 
-def update_feed(obj):
-    """Add domain object to update feed in Redis."""
-    pipeline = sentinel.master.pipeline()
+def update_feed(obj, pipeline=None):
+    """Add domain object to update feed in Redis.
+
+    If a pipeline is given, the command is only added to it.
+    """
+    execute = pipeline is None
+    if execute:
+        pipeline = sentinel.master.pipeline()
     serialized_object = pickle.dumps(obj)
     pipeline.zadd(FEED_KEY, time(), serialized_object)
-    pipeline.execute()
+    if execute:
+        pipeline.execute()
 
 def get_update_feed():
     """Return update feed list."""
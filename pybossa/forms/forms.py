@@ -101,6 +101,18 @@ class TaskSchedulerForm(Form):
     _translate_names = lambda variant: (variant[0], lazy_gettext(variant[1]))
     _choices = map(_translate_names, sched_variants())
     sched = SelectField(lazy_gettext('Task Scheduler'), choices=_choices)
+    sched_lease = IntegerField(lazy_gettext('Task lease (seconds)'),
+                               [validators.Optional(),
+                                validators.NumberRange(
+                                    min=0, max=3600,
+                                    message=lazy_gettext('Task lease should be a \
+                                                         value between 0 and 3,600'))])
+    calibration_frac = DecimalField(lazy_gettext('Calibration tasks share'),
+                                    [validators.Optional(),
+                                     validators.NumberRange(
+                                         min=0, max=1,
+                                         message=lazy_gettext('Calibration share should be a \
+                                                              value between 0.0 and 1.0'))])
 
     @classmethod
     def update_sched_options(cls, new_options):
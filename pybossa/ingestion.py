@@ -0,0 +1,261 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Write-behind ingestion of task runs.
+
+If TASK_RUN_WRITE_BEHIND is enabled, the task runs posted to the API are
+validated and appended to a Redis list, and the API answers straight away
+with 202 Accepted. A background job drains the list in batches, inserting
+every batch with a single statement (see TaskRepository.save_task_runs), so
+the completion accounting, feed and webhooks run there.
+
+Every submission has an idempotency key (the Idempotency-Key header, or the
+task for a volunteer), so retries are only accepted once. A batch is moved
+to a processing list before it is saved, and it is saved again if the job
+dies (or fails) meanwhile: task runs already in the DB are skipped. After
+MAX_ATTEMPTS attempts, the batch is moved to a dead letter list, so it does
+not block the ones behind it, and its submissions are marked as failed.
+
+"""
+import json
+from time import time
+from flask import current_app
+from pybossa.core import sentinel
+from pybossa.model import make_timestamp
+
+
+QUEUE_KEY = 'pybossa:ingestion:task_runs'
+PROCESSING_KEY = 'pybossa:ingestion:task_runs:processing'
+DRAINING_KEY = 'pybossa:ingestion:task_runs:draining'
+ATTEMPTS_KEY = 'pybossa:ingestion:task_runs:attempts'
+DEAD_LETTER_KEY = 'pybossa:ingestion:task_runs:dead'
+IDEMPOTENCY_KEY = 'pybossa:ingestion:key:%s'
+IDEMPOTENCY_TIMEOUT = 24 * 60 * 60
+DRAIN_TIMEOUT = 10 * 60
+BATCH_SIZE = 500
+MAX_ATTEMPTS = 5
+PENDING = 'pending'
+FAILED = 'failed'
+
+# KEYS[1]: idempotency key, KEYS[2]: queue
+# ARGV[1]: pending state, ARGV[2]: idempotency timeout, ARGV[3]: item
+PUSH_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2], 'NX') then
+    redis.call('RPUSH', KEYS[2], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# KEYS[1]: queue, KEYS[2]: processing list, KEYS[3]: attempts
+# ARGV[1]: batch size
+TAKE_BATCH_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+    redis.call('SET', KEYS[3], 1)
+end
+return items
+"""
+
+# KEYS[1]: from list, KEYS[2]: to list, KEYS[3]: attempts (optional)
+MOVE_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+if #items > 0 then
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+redis.call('DEL', KEYS[1])
+if KEYS[3] then
+    redis.call('DEL', KEYS[3])
+end
+return items
+"""
+
+_push_script = sentinel.register_script(PUSH_SCRIPT)
+_take_batch_script = sentinel.register_script(TAKE_BATCH_SCRIPT)
+_move_script = sentinel.register_script(MOVE_SCRIPT)
+
+TASK_RUN_FIELDS = ('project_id', 'task_id', 'user_id', 'user_ip', 'info',
+                   'calibration', 'timeout', 'created', 'finish_time')
+
+
+def _volunteer(user_id=None, user_ip=None):
+    if user_id:
+        return 'user:%s' % user_id
+    return 'ip:%s' % (user_ip or '127.0.0.1')
+
+
+def push(task_run, idempotency_key=None):
+    """Append a validated task run to the queue, unless a submission with the
+    same idempotency key was already accepted.
+
+    Returns the idempotency key of the submission, which can be used to get
+    its state.
+    """
+    volunteer = _volunteer(task_run.user_id, task_run.user_ip)
+    key = '%s:%s' % (volunteer,
+                     idempotency_key or 'task:%s' % task_run.task_id)
+    task_run.created = task_run.created or make_timestamp()
+    task_run.finish_time = task_run.finish_time or make_timestamp()
+    item = dict(key=key, accepted=time(),
+                task_run=dict((field, getattr(task_run, field))
+                              for field in TASK_RUN_FIELDS))
+    # The key is only set if the task run is queued
+    if _push_script(keys=[IDEMPOTENCY_KEY % key, QUEUE_KEY],
+                    args=[PENDING, IDEMPOTENCY_TIMEOUT, json.dumps(item)]):
+        enqueue_drain()
+    return key
+
+
+def is_submitted_by(key, user_id=None, user_ip=None):
+    """Return True if the submission with that idempotency key was made by
+    the volunteer."""
+    return key.startswith('%s:' % _volunteer(user_id, user_ip))
+
+
+def get_state(key):
+    """Return the state of a submission: pending, failed, the id of the
+    saved task run or None if it is unknown."""
+    state = sentinel.master.get(IDEMPOTENCY_KEY % key)
+    if state not in (None, PENDING, FAILED):
+        return int(state)
+    return state
+
+
+def get_status():
+    """Return the number of queued, processing and dead task runs, and the
+    age in seconds of the oldest queued one."""
+    pipeline = sentinel.master.pipeline()
+    pipeline.llen(QUEUE_KEY)
+    pipeline.llen(PROCESSING_KEY)
+    pipeline.llen(DEAD_LETTER_KEY)
+    pipeline.lindex(QUEUE_KEY, 0)
+    pending, processing, dead, oldest = pipeline.execute()
+    lag = time() - json.loads(oldest)['accepted'] if oldest else 0
+    return dict(pending=pending, processing=processing, dead=dead, lag=lag)
+
+
+def enqueue_drain():
+    """Enqueue a drain job, unless one is queued or running."""
+    from rq import Queue
+    from pybossa.jobs import drain_task_runs
+    if not sentinel.master.set(DRAINING_KEY, 1, ex=DRAIN_TIMEOUT, nx=True):
+        return False
+    queue = Queue('high', connection=sentinel.master)
+    queue.enqueue_call(func=drain_task_runs, timeout=DRAIN_TIMEOUT)
+    return True
+
+
+def drain(batch_size=BATCH_SIZE):
+    """Save the queued task runs, batch by batch, and return how many were
+    saved."""
+    n_saved = 0
+    while True:
+        items = _take_batch(batch_size)
+        if not items:
+            break
+        n_saved += _save_batch([json.loads(item) for item in items])
+    sentinel.master.delete(DRAINING_KEY)
+    if sentinel.master.llen(QUEUE_KEY):
+        enqueue_drain()
+    return n_saved
+
+
+def _take_batch(batch_size):
+    # A non empty processing list is a batch left by a job that died or
+    # failed
+    if sentinel.master.llen(PROCESSING_KEY):
+        if sentinel.master.incr(ATTEMPTS_KEY) <= MAX_ATTEMPTS:
+            return sentinel.master.lrange(PROCESSING_KEY, 0, -1)
+        _dead_letter()
+    return _take_batch_script(keys=[QUEUE_KEY, PROCESSING_KEY, ATTEMPTS_KEY],
+                              args=[batch_size])
+
+
+def _dead_letter():
+    """Move the batch that keeps failing to the dead letter list, and mark
+    its submissions as failed."""
+    items = _move_script(keys=[PROCESSING_KEY, DEAD_LETTER_KEY,
+                               ATTEMPTS_KEY])
+    current_app.logger.error('%s queued task runs failed %s times, moved '
+                             'to %s' % (len(items), MAX_ATTEMPTS,
+                                        DEAD_LETTER_KEY))
+    _set_states(items, FAILED)
+
+
+def _set_states(items, state):
+    pipeline = sentinel.master.pipeline()
+    for item in items:
+        try:
+            key = json.loads(item)['key']
+        except (ValueError, KeyError, TypeError):
+            continue
+        pipeline.set(IDEMPOTENCY_KEY % key, state, ex=IDEMPOTENCY_TIMEOUT)
+    pipeline.execute()
+
+
+def requeue_dead():
+    """Queue the dead task runs again (e.g. once the cause of the failures
+    is fixed), and return how many they are."""
+    items = _move_script(keys=[DEAD_LETTER_KEY, QUEUE_KEY])
+    _set_states(items, PENDING)
+    if items:
+        enqueue_drain()
+    return len(items)
+
+
+def _save_batch(items):
+    from pybossa.core import task_repo
+    from pybossa.exc import DBIntegrityError
+    from pybossa.model.task_run import TaskRun
+    volunteers = set((item['task_run']['task_id'],
+                      item['task_run'].get('user_id'),
+                      item['task_run'].get('user_ip')) for item in items)
+    # Task runs saved before the job died, or answered meanwhile
+    answered = task_repo.get_task_run_ids_by_volunteer(volunteers)
+    states = {}
+    new = []
+    for item in items:
+        task_run = TaskRun(**item['task_run'])
+        volunteer = (task_run.task_id, task_run.user_id, task_run.user_ip)
+        if volunteer in answered:
+            states[item['key']] = answered[volunteer] or FAILED
+            continue
+        answered[volunteer] = None
+        new.append((item['key'], task_run))
+    try:
+        task_repo.save_task_runs([task_run for _, task_run in new])
+    except DBIntegrityError:
+        # e.g. the task was deleted, so save them one by one
+        saved = []
+        for key, task_run in new:
+            try:
+                task_repo.save_task_runs([task_run])
+                saved.append((key, task_run))
+            except DBIntegrityError:
+                states[key] = FAILED
+        new = saved
+    for key, task_run in new:
+        states[key] = task_run.id
+    pipeline = sentinel.master.pipeline()
+    for key, state in states.items():
+        pipeline.set(IDEMPOTENCY_KEY % key, state, ex=IDEMPOTENCY_TIMEOUT)
+    pipeline.delete(PROCESSING_KEY, ATTEMPTS_KEY)
+    pipeline.execute()
+    return len(new)
@@ -116,9 +116,10 @@ def get_periodic_jobs(queue):
         if queue == 'quaterly' else []
     dashboard_jobs = get_dashboard_jobs() if queue == 'low' else []
     weekly_update_jobs = get_weekly_stats_update_projects() if queue == 'low' else []
+    counters_jobs = get_project_counters_jobs() if queue == 'low' else []
     _all = [zip_jobs, jobs, project_jobs, autoimport_jobs,
             engage_jobs, non_contrib_jobs, dashboard_jobs,
-            weekly_update_jobs]
+            weekly_update_jobs, counters_jobs]
     return (job for sublist in _all for job in sublist if job['queue'] == queue)
 
 
@@ -169,6 +170,27 @@ def get_project_jobs(queue='super'):
                             queue=queue)
 
 
+def get_project_counters_jobs(queue='low'):
+    """Return the jobs that reconcile the maintained project counters."""
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    from pybossa import project_counters
+    if not project_counters.is_enabled():
+        return
+    results = db.slave_session.execute(text('SELECT id FROM project;'))
+    for row in results:
+        yield dict(name=reconcile_project_counters,
+                   args=[row.id], kwargs={},
+                   timeout=(10 * MINUTE),
+                   queue=queue)
+
+
+def reconcile_project_counters(project_id):
+    """Recompute the maintained counters of a project."""
+    from pybossa import project_counters
+    return project_counters.rebuild(project_id)
+
+
 def create_dict_jobs(data, function, timeout=(10 * MINUTE), queue='low'):
     """Create a dict job."""
     for d in data:
@@ -327,61 +349,16 @@ def warm_up_stats():  # pragma: no cover
     return True
 
 
-@with_cache_disabled
 def warm_cache():  # pragma: no cover
     """Background job to warm cache."""
-    from pybossa.core import create_app
-    app = create_app(run_as_server=False)
-    projects_cached = []
-    import pybossa.cache.projects as cached_projects
-    import pybossa.cache.categories as cached_cat
-    import pybossa.cache.users as cached_users
-    import pybossa.cache.project_stats as stats
-    from pybossa.util import rank
-
-    def warm_project(_id, short_name, featured=False):
-        if _id not in projects_cached:
-            cached_projects.get_project(short_name)
-            cached_projects.n_tasks(_id)
-            n_task_runs = cached_projects.n_task_runs(_id)
-            cached_projects.overall_progress(_id)
-            cached_projects.last_activity(_id)
-            cached_projects.n_completed_tasks(_id)
-            cached_projects.n_volunteers(_id)
-            cached_projects.browse_tasks(_id)
-            if n_task_runs >= 1000 or featured:
-                # print ("Getting stats for %s as it has %s task runs" %
-                #        (short_name, n_task_runs))
-                stats.get_stats(_id, app.config.get('GEO'))
-            projects_cached.append(_id)
-
-    # Cache top projects
-    projects = cached_projects.get_top()
-    for p in projects:
-        warm_project(p['id'], p['short_name'])
-
-    # Cache 3 pages
-    to_cache = 3 * app.config['APPS_PER_PAGE']
-    projects = rank(cached_projects.get_all_featured('featured'))[:to_cache]
-    for p in projects:
-        warm_project(p['id'], p['short_name'], featured=True)
-
-    # Categories
-    categories = cached_cat.get_used()
-    for c in categories:
-        projects = rank(cached_projects.get_all(c['short_name']))[:to_cache]
-        for p in projects:
-            warm_project(p['id'], p['short_name'])
-    # Users
-    users = cached_users.get_leaderboard(app.config['LEADERBOARD'])
-    for user in users:
-        # print "Getting stats for %s" % user['name']
-        cached_users.get_user_summary(user['name'])
-        cached_users.projects_contributed_cached(user['id'])
-        cached_users.published_projects_cached(user['id'])
-        cached_users.draft_projects_cached(user['id'])
+    from pybossa.cache import warm
+    return warm.warm()
 
-    return True
+
+def warm_cache_calls(calls):  # pragma: no cover
+    """Background job to warm a chunk of the cached calls."""
+    from pybossa.cache import warm
+    return warm.warm_calls(calls)
 
 
 def get_non_updated_projects():
@@ -456,6 +433,23 @@ def webhook(url, payload=None):
         return False
 
 
+def drain_task_runs():
+    """Save the task runs queued by the write-behind ingestion."""
+    from pybossa import ingestion
+    return ingestion.drain()
+
+
+def update_projects_timestamp():
+    """Write the coalesced project updates to project.updated."""
+    from pybossa import project_updated
+    return project_updated.flush()
+
+
+def refresh_cached(function, args, kwargs):
+    """Recompute and store the stale cached value of a function."""
+    return function.refresh(*args, **kwargs)
+
+
 def notify_blog_users(blog_id, project_id, queue='high'):
     """Send email with new blog post."""
     from sqlalchemy.sql import text
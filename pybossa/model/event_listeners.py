@@ -18,10 +18,11 @@
 from datetime import datetime
 
 from rq import Queue
-from sqlalchemy import event
+from sqlalchemy import event, inspect
+from sqlalchemy.sql import text
 
 from pybossa.feed import update_feed
-from pybossa.model import update_project_timestamp
+from pybossa.model import update_project_timestamp, make_timestamp
 from pybossa.model.blogpost import Blogpost
 from pybossa.model.project import Project
 from pybossa.model.task import Task
@@ -29,31 +30,50 @@ from pybossa.model.task_run import TaskRun
 from pybossa.model.user import User
 from pybossa.jobs import webhook, notify_blog_users
 from pybossa.core import sentinel
+import pybossa.sched as sched
+import pybossa.task_queue as task_queue
+import pybossa.answered_tasks as answered_tasks
+import pybossa.task_leases as task_leases
+import pybossa.task_sampler as task_sampler
+import pybossa.calibration as calibration
+import pybossa.consensus as consensus
+import pybossa.side_effects as side_effects
+import pybossa.project_updated as project_updated
+import pybossa.project_counters as project_counters
 
 webhook_queue = Queue('high', connection=sentinel.master)
 mail_queue = Queue('super', connection=sentinel.master)
 
 
+def get_project_feed_fields(conn, target):
+    """Return the name, short_name and info of the project of target.
+
+    They are read once per project and transaction.
+    """
+    memo = side_effects.memo(target)
+    key = ('project_feed_fields', target.project_id)
+    if key not in memo:
+        sql_query = ('select name, short_name, info from project \
+                     where id=%s') % target.project_id
+        fields = dict(name=None, short_name=None, info=None)
+        for r in conn.execute(sql_query):
+            fields['name'] = r.name
+            fields['short_name'] = r.short_name
+            fields['info'] = r.info
+        memo[key] = fields
+    return memo[key]
+
+
 @event.listens_for(Blogpost, 'after_insert')
 def add_blog_event(mapper, conn, target):
     """Update PyBossa feed with new blog post."""
-    sql_query = ('select name, short_name, info from project \
-                 where id=%s') % target.project_id
-    results = conn.execute(sql_query)
-    obj = dict(id=target.project_id,
-               name=None,
-               short_name=None,
-               info=None,
-               action_updated='Blog')
-    for r in results:
-        obj['name'] = r.name
-        obj['short_name'] = r.short_name
-        obj['info'] = r.info
-    update_feed(obj)
+    obj = dict(id=target.project_id, action_updated='Blog')
+    obj.update(get_project_feed_fields(conn, target))
+    side_effects.defer_write(target, update_feed, obj)
     # Notify volunteers
-    mail_queue.enqueue(notify_blog_users,
-                       blog_id=target.id,
-                       project_id=target.project_id)
+    side_effects.defer_call(target, mail_queue.enqueue, notify_blog_users,
+                            blog_id=target.id,
+                            project_id=target.project_id)
 
 
 @event.listens_for(Project, 'after_insert')
@@ -63,25 +83,139 @@ def add_project_event(mapper, conn, target):
                name=target.name,
                short_name=target.short_name,
                action_updated='Project')
-    update_feed(obj)
+    side_effects.defer_write(target, update_feed, obj)
+
+
+@event.listens_for(Project, 'after_insert')
+def init_answered_tasks(mapper, conn, target):
+    """New projects have no task runs, so their answered index is ready."""
+    side_effects.defer_write(target, answered_tasks.mark_as_ready, target.id)
+
+
+@event.listens_for(Project, 'after_delete')
+def delete_answered_tasks(mapper, conn, target):
+    """Drop the answered index of a deleted project."""
+    side_effects.defer_call(target, answered_tasks.delete, target.id)
+
+
+@event.listens_for(Project, 'after_insert')
+def init_calibration_pool(mapper, conn, target):
+    """New projects have no calibration tasks, so their pool is ready."""
+    side_effects.defer_write(target, calibration.mark_as_ready, target.id)
+
+
+@event.listens_for(Project, 'after_insert')
+@event.listens_for(Project, 'after_update')
+@event.listens_for(Project, 'after_delete')
+def invalidate_project_sched_config(mapper, conn, target):
+    """Forget the cached scheduling settings of the project."""
+    side_effects.defer_call_once(target, sched.invalidate_project_config,
+                                 target.id)
 
 
 @event.listens_for(Task, 'after_insert')
 def add_task_event(mapper, conn, target):
     """Update PyBossa feed with new task."""
-    sql_query = ('select name, short_name, info from project \
-                 where id=%s') % target.project_id
-    results = conn.execute(sql_query)
-    obj = dict(id=target.project_id,
-               name=None,
-               short_name=None,
-               info=None,
-               action_updated='Task')
-    for r in results:
-        obj['name'] = r.name
-        obj['short_name'] = r.short_name
-        obj['info'] = r.info
-    update_feed(obj)
+    obj = dict(id=target.project_id, action_updated='Task')
+    obj.update(get_project_feed_fields(conn, target))
+    side_effects.defer_write(target, update_feed, obj)
+
+
+@event.listens_for(Task, 'after_insert')
+@event.listens_for(Task, 'after_update')
+def update_task_queue(mapper, conn, target):
+    """Keep the precomputed task queue of the project up to date."""
+    if target.state == 'completed':
+        remove_from_queue(target, target.project_id, target.id)
+    else:
+        updates = side_effects.batch(target, task_queue.update_many)
+        if updates is None:
+            task_queue.push(target.project_id, target.id, target.priority_0)
+        else:
+            updates[(target.project_id, target.id)] = target.priority_0 or 0
+
+
+def remove_from_queue(target, project_id, task_id):
+    updates = side_effects.batch(target, task_queue.update_many)
+    if updates is None:
+        task_queue.remove(project_id, task_id)
+    else:
+        updates[(project_id, task_id)] = None
+
+
+@event.listens_for(Task, 'after_insert')
+def update_task_sampler(mapper, conn, target):
+    """New tasks are only drawn once the alias table is rebuilt."""
+    side_effects.defer_call_once(target, task_sampler.mark_as_stale,
+                                 target.project_id)
+
+
+@event.listens_for(Task, 'after_update')
+def update_task_sampler_weights(mapper, conn, target):
+    """New priorities are only used once the alias table is rebuilt."""
+    if inspect(target).attrs.priority_0.history.has_changes():
+        side_effects.defer_call_once(target, task_sampler.mark_as_stale,
+                                     target.project_id)
+
+
+@event.listens_for(Task, 'after_insert')
+@event.listens_for(Task, 'after_update')
+def update_calibration_pool(mapper, conn, target):
+    """Keep the calibration pool of the project up to date."""
+    if target.calibration and target.state != 'completed':
+        side_effects.defer_write(target, calibration.add_task,
+                                 target.project_id, target.id)
+    elif (target.calibration or
+          inspect(target).attrs.calibration.history.has_changes()):
+        side_effects.defer_write(target, calibration.remove_task,
+                                 target.project_id, target.id)
+
+
+@event.listens_for(Task, 'after_insert')
+def add_task_to_counters(mapper, conn, target):
+    """Count the new task in the project counters."""
+    if project_counters.is_enabled():
+        side_effects.defer_write(target, project_counters.add_tasks,
+                                 target.project_id, 1,
+                                 int(target.state == 'completed'))
+
+
+@event.listens_for(Task, 'after_update')
+def update_task_counters(mapper, conn, target):
+    """Count the tasks completed (or reopened) by an update."""
+    if not project_counters.is_enabled():
+        return
+    history = inspect(target).attrs.state.history
+    if not history.has_changes():
+        return
+    was_completed = 'completed' in (history.deleted or ())
+    is_completed = target.state == 'completed'
+    if is_completed != was_completed:
+        side_effects.defer_write(target, project_counters.complete_tasks,
+                                 target.project_id, 1 if is_completed else -1)
+
+
+@event.listens_for(Task, 'after_delete')
+def remove_task_from_counters(mapper, conn, target):
+    """Remove the deleted task from the project counters."""
+    if project_counters.is_enabled():
+        side_effects.defer_write(target, project_counters.add_tasks,
+                                 target.project_id, -1,
+                                 -int(target.state == 'completed'))
+
+
+@event.listens_for(Task, 'after_delete')
+def remove_from_calibration_pool(mapper, conn, target):
+    """Remove a deleted calibration task from the pool."""
+    if target.calibration:
+        side_effects.defer_write(target, calibration.remove_task,
+                                 target.project_id, target.id)
+
+
+@event.listens_for(Task, 'after_delete')
+def remove_from_task_queue(mapper, conn, target):
+    """Remove a deleted task from the precomputed task queue."""
+    remove_from_queue(target, target.project_id, target.id)
 
 
 @event.listens_for(User, 'after_insert')
@@ -89,86 +223,238 @@ def add_user_event(mapper, conn, target):
     """Update PyBossa feed with new user."""
     obj = target.dictize()
     obj['action_updated']='User'
-    update_feed(obj)
+    side_effects.defer_write(target, update_feed, obj)
 
 
-def add_user_contributed_to_feed(conn, user_id, project_obj):
+def add_user_contributed_to_feed(target, user_id, row):
     if user_id is not None:
-        sql_query = ('select fullname, name, info from "user" \
-                     where id=%s') % user_id
-        results = conn.execute(sql_query)
-        for r in results:
-            obj = dict(id=user_id,
-                       name=r.name,
-                       fullname=r.fullname,
-                       info=r.info,
-                       project_name=project_obj['name'],
-                       project_short_name=project_obj['short_name'],
-                       action_updated='UserContribution')
-        update_feed(obj)
+        obj = dict(id=user_id,
+                   name=row.user_name,
+                   fullname=row.user_fullname,
+                   info=row.user_info,
+                   project_name=row.name,
+                   project_short_name=row.short_name,
+                   action_updated='UserContribution')
+        side_effects.defer_write(target, update_feed, obj)
+
+
+ADD_TASK_RUNS_SQL = '''
+    WITH old_task AS (
+        SELECT id, state FROM task WHERE id=:task_id FOR UPDATE
+    ), updated_task AS (
+        UPDATE task SET n_task_runs=task.n_task_runs + :n_task_runs,
+        state=CASE WHEN task.n_task_runs + :n_task_runs >= task.n_answers
+                   OR :completed THEN 'completed' ELSE task.state END
+        FROM old_task WHERE task.id=old_task.id
+        RETURNING task.state, old_task.state AS old_state
+    ), updated_project AS (
+        %s
+    )
+    SELECT updated_task.state, updated_task.old_state,
+           updated_project.name, updated_project.short_name,
+           updated_project.webhook, updated_project.info,
+           "user".name AS user_name, "user".fullname AS user_fullname,
+           "user".info AS user_info
+    FROM updated_task CROSS JOIN updated_project
+    LEFT JOIN "user" ON "user".id=:user_id;
+    '''
+
+ADD_TASK_RUNS_TOUCH_PROJECT_SQL = text(ADD_TASK_RUNS_SQL % '''
+        UPDATE project SET updated=:updated WHERE id=:project_id
+        RETURNING name, short_name, webhook, info''')
+
+ADD_TASK_RUNS_READ_PROJECT_SQL = text(ADD_TASK_RUNS_SQL % '''
+        SELECT name, short_name, webhook, info FROM project
+        WHERE id=:project_id''')
+
 
+def add_task_runs(conn, task_id, project_id, user_id=None, n_task_runs=1,
+                  completed=False, touch_project=True):
+    """Account new task runs of a task with a single statement.
 
-def is_task_completed(conn, task_id):
-    sql_query = ('select count(id) from task_run \
-                 where task_run.task_id=%s') % task_id
-    n_answers = conn.scalar(sql_query)
-    sql_query = ('select n_answers from task \
-                 where task.id=%s') % task_id
-    task_n_answers = conn.scalar(sql_query)
-    return (n_answers) >= task_n_answers
+    It increments task.n_task_runs, completes the task if it has all its
+    answers (or completed is True), touches project.updated (unless
+    touch_project is False) and returns the old and new task state, the
+    project fields for the feed and webhooks, and the user fields for the
+    feed.
+    """
+    sql = (ADD_TASK_RUNS_TOUCH_PROJECT_SQL if touch_project
+           else ADD_TASK_RUNS_READ_PROJECT_SQL)
+    return conn.execute(sql, task_id=task_id,
+                        project_id=project_id, user_id=user_id,
+                        n_task_runs=n_task_runs, completed=completed,
+                        updated=make_timestamp()).first()
 
 
-def update_task_state(conn, task_id):
-    sql_query = ("UPDATE task SET state=\'completed\' \
-                 where id=%s") % task_id
-    conn.execute(sql_query)
+def increment_task_runs(conn, task_id, n=1):
+    sql = text('UPDATE task SET n_task_runs = n_task_runs + :n '
+               'WHERE id=:task_id')
+    conn.execute(sql, n=n, task_id=task_id)
 
 
-def push_webhook(project_obj, task_id):
+def count_consensus_answer(target, answer):
+    """Return the tally of the task of target with its new answer.
+
+    The tally is only updated after commit, so the answers to the same task
+    earlier in the transaction are added here.
+    """
+    pending = side_effects.memo(target).setdefault(
+        ('consensus', target.task_id), {})
+    pending[answer] = pending.get(answer, 0) + 1
+    pending[consensus.TOTAL_FIELD] = pending.get(consensus.TOTAL_FIELD, 0) + 1
+    count, total = consensus.get_counts(target.task_id, answer)
+    return count + pending[answer], total + pending[consensus.TOTAL_FIELD]
+
+
+def push_webhook(target, project_obj, task_id):
     if project_obj['webhook']:
         payload = dict(event="task_completed",
                        project_short_name=project_obj['short_name'],
                        project_id=project_obj['id'],
                        task_id=task_id,
                        fired_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"))
-        webhook_queue.enqueue(webhook, project_obj['webhook'], payload)
+        side_effects.defer_call(target, webhook_queue.enqueue, webhook,
+                                project_obj['webhook'], payload)
 
 @event.listens_for(TaskRun, 'after_insert')
 def on_taskrun_submit(mapper, conn, target):
     """Update the task.state when n_answers condition is met."""
-    # Get project details
-    sql_query = ('select name, short_name, webhook, info from project \
-                 where id=%s') % target.project_id
-    results = conn.execute(sql_query)
-    project_obj = dict(id=target.project_id,
-                   name=None,
-                   short_name=None,
-                   info=None,
-                   webhook=None,
-                   action_updated='TaskCompleted')
-    for r in results:
-        project_obj['name'] = r.name
-        project_obj['short_name'] = r.short_name
-        project_obj['info'] = r.info
-        project_obj['webhook'] = r.webhook
-        project_obj['id'] = target.project_id
-
-    add_user_contributed_to_feed(conn, target.user_id, project_obj)
-    if is_task_completed(conn, target.task_id):
-        update_task_state(conn, target.task_id)
-        update_feed(project_obj)
-        push_webhook(project_obj, target.task_id)
+    consensus_reached = False
+    project_config = sched.get_project_config(target.project_id) or {}
+    policy = consensus.get_policy(project_config)
+    answer = None
+    if policy is not None:
+        answer = consensus.answer_field(policy, target.info)
+    if answer is not None:
+        count, total = count_consensus_answer(target, answer)
+        consensus_reached = consensus.is_reached(policy, count, total)
+        side_effects.defer_write(target, consensus.add_answer,
+                                 target.task_id, answer)
+    coalesced = project_updated.is_coalesced()
+    row = add_task_runs(conn, target.task_id, target.project_id,
+                        target.user_id, completed=consensus_reached,
+                        touch_project=not coalesced)
+    if coalesced:
+        side_effects.defer_write(target, project_updated.touch,
+                                 target.project_id)
+    if row is None:  # pragma: no cover
+        return
+    add_user_contributed_to_feed(target, target.user_id, row)
+    if row.state == 'completed' and row.old_state != 'completed':
+        project_obj = dict(id=target.project_id,
+                           name=row.name,
+                           short_name=row.short_name,
+                           info=row.info,
+                           webhook=row.webhook,
+                           action_updated='TaskCompleted')
+        remove_from_queue(target, target.project_id, target.task_id)
+        side_effects.defer_write(target, calibration.remove_task,
+                                 target.project_id, target.task_id)
+        if project_counters.is_enabled():
+            side_effects.defer_write(target, project_counters.complete_tasks,
+                                     target.project_id)
+        if policy is not None:
+            side_effects.defer_write(target, consensus.clear, target.task_id)
+        side_effects.defer_write(target, update_feed, project_obj)
+        push_webhook(target, project_obj, target.task_id)
+
+
+@event.listens_for(TaskRun, 'after_insert')
+def add_answered_task(mapper, conn, target):
+    """Add the task to the answered tasks index of the volunteer."""
+    side_effects.defer_write(target, answered_tasks.add, target.project_id,
+                             target.task_id, target.user_id, target.user_ip)
+
+
+@event.listens_for(TaskRun, 'after_insert')
+def record_calibration_answer(mapper, conn, target):
+    """Update the calibration accuracy of the volunteer."""
+    if not target.calibration:
+        return
+    task_info = conn.scalar('select info from task where id=%s'
+                            % target.task_id) or {}
+    if calibration.GOLD_ANSWER in task_info:
+        side_effects.defer_write(target, calibration.record_answer,
+                                 target.project_id, target.info,
+                                 task_info[calibration.GOLD_ANSWER],
+                                 target.user_id, target.user_ip)
+
+
+@event.listens_for(TaskRun, 'after_insert')
+def release_task_lease(mapper, conn, target):
+    """The volunteer has answered the task, so its lease is not needed."""
+    side_effects.defer_write(target, task_leases.release, target.task_id,
+                             target.user_id, target.user_ip)
+
+
+@event.listens_for(TaskRun, 'after_insert')
+def add_task_run_to_counters(mapper, conn, target):
+    """Count the new task run and its volunteer in the project counters."""
+    if project_counters.is_enabled():
+        side_effects.defer_write(target, project_counters.add_task_run,
+                                 target.project_id, target.user_id,
+                                 target.user_ip, target.finish_time)
+
+
+def task_runs_inserted(session, conn, task_runs):
+    """Run the TaskRun after_insert listeners for task runs inserted without
+    the unit of work (e.g. with a multi-row INSERT).
+
+    They are dispatched as the unit of work does, so every registered
+    listener runs, and their side effects are buffered in session.
+    """
+    mapper = inspect(TaskRun)
+    with side_effects.buffered_in(session):
+        for task_run in task_runs:
+            mapper.dispatch.after_insert(mapper, conn, inspect(task_run))
+
+
+@event.listens_for(TaskRun, 'after_delete')
+def remove_answered_task(mapper, conn, target):
+    """Remove the task from the answered tasks index of the volunteer."""
+    side_effects.defer_write(target, answered_tasks.remove,
+                             target.project_id, target.task_id,
+                             target.user_id, target.user_ip)
+
+
+@event.listens_for(TaskRun, 'after_delete')
+def remove_consensus_answer(mapper, conn, target):
+    """Remove the answer from the completion tally of the task."""
+    policy = consensus.get_policy(sched.get_project_config(target.project_id))
+    if policy is None:
+        return
+    answer = consensus.answer_field(policy, target.info)
+    if answer is not None:
+        side_effects.defer_write(target, consensus.remove_answer,
+                                 target.task_id, answer)
+
+
+@event.listens_for(TaskRun, 'after_delete')
+def remove_task_run_from_counters(mapper, conn, target):
+    """Remove the deleted task run from the project counters."""
+    if project_counters.is_enabled():
+        side_effects.defer_write(target, project_counters.remove_task_run,
+                                 target.project_id)
+
+
+@event.listens_for(TaskRun, 'after_delete')
+def decrement_task_runs(mapper, conn, target):
+    """Keep task.n_task_runs in sync when a task run is deleted."""
+    increment_task_runs(conn, target.task_id, n=-1)
 
 
 @event.listens_for(Blogpost, 'after_insert')
 @event.listens_for(Blogpost, 'after_update')
 @event.listens_for(Task, 'after_insert')
 @event.listens_for(Task, 'after_update')
-@event.listens_for(TaskRun, 'after_insert')
 @event.listens_for(TaskRun, 'after_update')
 def update_project(mapper, conn, target):
     """Update project updated timestamp."""
-    update_project_timestamp(mapper, conn, target)
+    if project_updated.is_coalesced():
+        side_effects.defer_write(target, project_updated.touch,
+                                 target.project_id)
+    else:
+        update_project_timestamp(mapper, conn, target)
 
 
 @event.listens_for(User, 'before_insert')
@@ -17,7 +17,7 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 from sqlalchemy import Integer, Boolean, Float, UnicodeText, Text
-from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.schema import Column, ForeignKey, Index
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.dialects.postgresql import JSON
 
@@ -31,7 +31,8 @@ class Task(db.Model, DomainObject):
     associated to a project.
     '''
     __tablename__ = 'task'
-
+    __table_args__ = (Index('task_project_id_n_task_runs_idx', 'project_id',
+                            'n_task_runs', 'id'), )
 
     #: Task.ID
     id = Column(Integer, primary_key=True)
@@ -50,6 +51,8 @@ class Task(db.Model, DomainObject):
     info = Column(JSON)
     #: Number of answers to collect for this task.
     n_answers = Column(Integer, default=30)
+    #: Number of answers collected for this task (maintained on TaskRun insert)
+    n_task_runs = Column(Integer, default=0, nullable=False)
 
     task_runs = relationship(TaskRun, cascade='all, delete, delete-orphan', backref='task')
 
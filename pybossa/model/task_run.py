@@ -17,18 +17,29 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 from sqlalchemy import Integer, Text
-from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.schema import Column, ForeignKey, Index
+from sqlalchemy.sql import text
 from sqlalchemy.dialects.postgresql import JSON
 
 from pybossa.core import db
 from pybossa.model import DomainObject, make_timestamp
 
 
+#: Unique indexes that keep a volunteer from answering a task twice
+USER_ANSWER_INDEX = 'task_run_task_id_user_id_key'
+ANONYMOUS_ANSWER_INDEX = 'task_run_task_id_user_ip_key'
+
 
 class TaskRun(db.Model, DomainObject):
     '''A run of a given task by a specific user.
     '''
     __tablename__ = 'task_run'
+    __table_args__ = (Index(USER_ANSWER_INDEX, 'task_id', 'user_id',
+                            unique=True,
+                            postgresql_where=text('user_id IS NOT NULL')),
+                      Index(ANONYMOUS_ANSWER_INDEX, 'task_id', 'user_ip',
+                            unique=True,
+                            postgresql_where=text('user_id IS NULL')), )
 
     #: ID of the TaskRun
     id = Column(Integer, primary_key=True)
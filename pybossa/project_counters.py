@@ -0,0 +1,292 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Project counters maintained as the tasks and task runs change.
+
+If PROJECT_COUNTERS_MAINTAINED is enabled, every project has a Redis hash
+with its number of tasks, completed tasks and task runs and its last
+activity, and two sets with its registered and anonymous volunteers. The
+model event listeners apply deltas to them (after commit), and the
+pybossa.cache.projects getters read them instead of counting rows, so a new
+task run does not have to clean the project cache.
+
+The counters of a project are only trusted once they are ready, i.e. they
+have been rebuilt from the DB. They are rebuilt on demand, and every day
+by a reconciliation job, which corrects any drift. While a rebuild runs, the
+deltas are also queued, and replayed on the rebuilt counters when they
+replace the current ones.
+
+"""
+from flask import current_app
+from pybossa.core import sentinel
+
+
+COUNTERS_KEY = 'pybossa:project:counters:%s'
+REGISTERED_KEY = 'pybossa:project:counters:%s:registered'
+ANONYMOUS_KEY = 'pybossa:project:counters:%s:anonymous'
+BUILDING_KEY = 'pybossa:project:counters:%s:building'
+DELTA_KEY = 'pybossa:project:counters:%s:delta'
+TMP_SUFFIX = ':tmp'
+READY_FIELD = 'ready'
+BUILD_TIMEOUT = 10 * 60
+COUNTER_FIELDS = ('n_tasks', 'n_completed_tasks', 'n_task_runs')
+
+# KEYS[1]: counters, KEYS[2]: building key, KEYS[3]: delta, KEYS[4]: volunteer
+# set (optional), ARGV[1]: tmp suffix, ARGV[2]: volunteer, ARGV[3]: last
+# activity (or ''), ARGV[4..]: field and increment pairs. While building, the
+# delta and the volunteer set being rebuilt get the same update.
+UPDATE_SCRIPT = """
+local building = redis.call('EXISTS', KEYS[2]) == 1
+for i = 4, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    if building then
+        redis.call('HINCRBY', KEYS[3], ARGV[i], ARGV[i + 1])
+    end
+end
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[1], 'last_activity', ARGV[3])
+    if building then
+        redis.call('HSET', KEYS[3], 'last_activity', ARGV[3])
+    end
+end
+if KEYS[4] then
+    redis.call('SADD', KEYS[4], ARGV[2])
+    if building then
+        redis.call('SADD', KEYS[4] .. ARGV[1], ARGV[2])
+    end
+end
+"""
+
+# KEYS[1]: counters, KEYS[2]: delta, KEYS[3]: building key, KEYS[4..]:
+# volunteer sets, ARGV[1]: tmp suffix, ARGV[2..]: field and value pairs of the
+# rebuilt counters. Replace the counters with the rebuilt ones plus the queued
+# delta, and every volunteer set with its rebuilt one.
+REPLACE_SCRIPT = """
+redis.call('DEL', KEYS[1])
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+local delta = redis.call('HGETALL', KEYS[2])
+for i = 1, #delta, 2 do
+    if delta[i] == 'last_activity' then
+        redis.call('HSET', KEYS[1], delta[i], delta[i + 1])
+    else
+        redis.call('HINCRBY', KEYS[1], delta[i], delta[i + 1])
+    end
+end
+for i = 4, #KEYS do
+    local tmp = KEYS[i] .. ARGV[1]
+    if redis.call('EXISTS', tmp) == 1 then
+        redis.call('RENAME', tmp, KEYS[i])
+    else
+        redis.call('DEL', KEYS[i])
+    end
+end
+redis.call('DEL', KEYS[2], KEYS[3])
+"""
+
+_update_script = sentinel.register_script(UPDATE_SCRIPT)
+_replace_script = sentinel.register_script(REPLACE_SCRIPT)
+
+
+def is_enabled():
+    """Return True if the project counters are maintained."""
+    return bool(current_app.config.get('PROJECT_COUNTERS_MAINTAINED'))
+
+
+def _update(project_id, increments, last_activity=None, user_id=None,
+            user_ip=None, pipeline=None):
+    keys = [COUNTERS_KEY % project_id, BUILDING_KEY % project_id,
+            DELTA_KEY % project_id]
+    volunteer = _volunteer(project_id, user_id, user_ip)
+    if volunteer:
+        keys.append(volunteer[0])
+    args = [TMP_SUFFIX, volunteer[1] if volunteer else '',
+            last_activity or '']
+    for field, n in increments:
+        args.extend([field, n])
+    execute = pipeline is None
+    if execute:
+        pipeline = sentinel.master.pipeline()
+    _update_script(keys=keys, args=args, client=pipeline)
+    if execute:
+        pipeline.execute()
+
+
+def add_tasks(project_id, n=1, n_completed=0, pipeline=None):
+    """Add (or remove, if negative) tasks to the counters of a project."""
+    increments = [('n_tasks', n)]
+    if n_completed:
+        increments.append(('n_completed_tasks', n_completed))
+    _update(project_id, increments, pipeline=pipeline)
+
+
+def complete_tasks(project_id, n=1, pipeline=None):
+    """Count n more (or less, if negative) completed tasks."""
+    _update(project_id, [('n_completed_tasks', n)], pipeline=pipeline)
+
+
+def add_task_run(project_id, user_id=None, user_ip=None, finish_time=None,
+                 pipeline=None):
+    """Count a new task run, its volunteer and its finish time."""
+    _update(project_id, [('n_task_runs', 1)], finish_time, user_id, user_ip,
+            pipeline)
+
+
+def remove_task_run(project_id, pipeline=None):
+    """Count a deleted task run.
+
+    Its volunteer is kept until the counters are reconciled.
+    """
+    _update(project_id, [('n_task_runs', -1)], pipeline=pipeline)
+
+
+def _volunteer(project_id, user_id, user_ip):
+    # Same criteria as the n_registered_volunteers and n_anonymous_volunteers
+    # queries of pybossa.cache.projects
+    if user_id is not None and user_ip is None:
+        return REGISTERED_KEY % project_id, user_id
+    elif user_ip is not None and user_id is None:
+        return ANONYMOUS_KEY % project_id, user_ip
+    return None
+
+
+def _clean_fallbacks(project_id):
+    # The values pybossa.cache.projects memoizes while the counters are not
+    # ready would be stale the next time they are not
+    from pybossa.cache import delete_tagged
+    from pybossa.cache.projects import project_tag
+    delete_tagged(project_tag(project_id))
+
+
+def is_ready(project_id):
+    """Return True if the counters of a project are trusted."""
+    return bool(sentinel.master.hexists(COUNTERS_KEY % project_id,
+                                        READY_FIELD))
+
+
+def invalidate(project_id):
+    """Stop trusting the counters of a project until they are rebuilt."""
+    sentinel.master.hdel(COUNTERS_KEY % project_id, READY_FIELD)
+    _clean_fallbacks(project_id)
+
+
+def get(project_id):
+    """Return the counters of a project.
+
+    Returns None if they are not maintained or not ready, so the caller
+    counts the rows instead (a rebuild is enqueued).
+    """
+    return get_many([project_id])[0]
+
+
+def get_many(project_ids):
+    """Return the counters of a list of projects, with one pipeline.
+
+    Like get, the counters of a project are None if they are not maintained
+    or not ready.
+    """
+    if not is_enabled() or not project_ids:
+        return [None] * len(project_ids)
+    pipeline = sentinel.master.pipeline()
+    for project_id in project_ids:
+        pipeline.hgetall(COUNTERS_KEY % project_id)
+        pipeline.scard(REGISTERED_KEY % project_id)
+        pipeline.scard(ANONYMOUS_KEY % project_id)
+    results = pipeline.execute()
+    out = []
+    for i, project_id in enumerate(project_ids):
+        counters, n_registered, n_anonymous = results[3 * i:3 * i + 3]
+        if not counters.get(READY_FIELD):
+            enqueue_rebuild(project_id)
+            out.append(None)
+            continue
+        project = dict((field, int(counters.get(field) or 0))
+                       for field in COUNTER_FIELDS)
+        project['last_activity'] = counters.get('last_activity') or None
+        project['n_registered_volunteers'] = n_registered
+        project['n_anonymous_volunteers'] = n_anonymous
+        out.append(project)
+    return out
+
+
+def enqueue_rebuild(project_id):
+    """Enqueue a background rebuild of the counters, unless one is running."""
+    from rq import Queue
+    from pybossa.jobs import reconcile_project_counters
+    if not sentinel.master.set(BUILDING_KEY % project_id, 1,
+                               ex=BUILD_TIMEOUT, nx=True):
+        return False
+    queue = Queue('high', connection=sentinel.master)
+    queue.enqueue_call(func=reconcile_project_counters, args=(project_id,),
+                       timeout=BUILD_TIMEOUT)
+    return True
+
+
+def rebuild(project_id):
+    """Recompute the counters of a project from the DB.
+
+    The deltas applied while the DB is read are queued, and replayed on the
+    new counters when they replace the current ones. The master is read, as
+    a lagging slave would miss changes whose deltas are not queued.
+
+    The deltas are sent after commit, so the delta of a change committed
+    right before the DB is read may be queued too, and counted twice. This
+    skew is rare and small, and the next reconciliation corrects it.
+    """
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    keys = [REGISTERED_KEY % project_id, ANONYMOUS_KEY % project_id]
+    pipeline = sentinel.master.pipeline()
+    pipeline.set(BUILDING_KEY % project_id, 1, ex=BUILD_TIMEOUT)
+    pipeline.delete(DELTA_KEY % project_id,
+                    *[key + TMP_SUFFIX for key in keys])
+    pipeline.execute()
+    sql = text('''
+               SELECT
+               (SELECT COUNT(*) FROM task WHERE project_id=:project_id)
+               AS n_tasks,
+               (SELECT COUNT(*) FROM task WHERE project_id=:project_id
+               AND state='completed') AS n_completed_tasks,
+               (SELECT COUNT(*) FROM task_run WHERE project_id=:project_id)
+               AS n_task_runs,
+               (SELECT MAX(finish_time) FROM task_run
+               WHERE project_id=:project_id) AS last_activity;''')
+    row = db.session.execute(sql, dict(project_id=project_id)).first()
+    counters = dict(n_tasks=row.n_tasks,
+                    n_completed_tasks=row.n_completed_tasks,
+                    n_task_runs=row.n_task_runs)
+    counters[READY_FIELD] = 1
+    if row.last_activity:
+        counters['last_activity'] = row.last_activity
+    sql = text('''SELECT DISTINCT user_id, user_ip FROM task_run
+               WHERE project_id=:project_id;''')
+    volunteers = db.session.execute(sql, dict(project_id=project_id))
+    pipeline = sentinel.master.pipeline()
+    for row in volunteers:
+        volunteer = _volunteer(project_id, row.user_id, row.user_ip)
+        if volunteer:
+            pipeline.sadd(volunteer[0] + TMP_SUFFIX, volunteer[1])
+    pipeline.execute()
+    args = [TMP_SUFFIX]
+    for field, value in counters.items():
+        args.extend([field, value])
+    _replace_script(keys=[COUNTERS_KEY % project_id, DELTA_KEY % project_id,
+                          BUILDING_KEY % project_id] + keys, args=args)
+    _clean_fallbacks(project_id)
+    return counters
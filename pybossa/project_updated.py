@@ -0,0 +1,74 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Coalesced writes of project.updated.
+
+By default, every task, task run and blog post change updates the updated
+timestamp of its project. On busy projects, all the submissions then update
+the same project row. If PROJECT_UPDATED_INTERVAL (seconds) is set, the
+changes only record the project id and time in a Redis sorted set, and the
+flush job writes them to project.updated with a single statement every
+PROJECT_UPDATED_INTERVAL seconds.
+
+"""
+from datetime import datetime
+from time import time
+from flask import current_app
+from pybossa.core import sentinel
+
+
+TOUCHED_KEY = 'pybossa:project:updated'
+
+FLUSH_SQL = '''
+    UPDATE project SET updated=touched.updated
+    FROM (SELECT unnest(CAST(:project_ids AS integer[])) AS id,
+                 unnest(CAST(:updated AS text[])) AS updated) AS touched
+    WHERE project.id=touched.id
+    AND (project.updated IS NULL OR project.updated < touched.updated);
+    '''
+
+
+def is_coalesced():
+    """Return True if project.updated is written by the flush job."""
+    return bool(current_app.config.get('PROJECT_UPDATED_INTERVAL'))
+
+
+def touch(project_id, pipeline=None):
+    """Record that a project has been updated now."""
+    redis = sentinel.master if pipeline is None else pipeline
+    redis.zadd(TOUCHED_KEY, time(), project_id)
+
+
+def flush():
+    """Write the recorded updates to project.updated and return how many
+    projects were updated."""
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    pipeline = sentinel.master.pipeline()
+    pipeline.zrange(TOUCHED_KEY, 0, -1, withscores=True)
+    pipeline.delete(TOUCHED_KEY)
+    touched, _ = pipeline.execute()
+    if not touched:
+        return 0
+    project_ids = [int(project_id) for project_id, _ in touched]
+    updated = [datetime.utcfromtimestamp(score).isoformat()
+               for _, score in touched]
+    db.session.execute(text(FLUSH_SQL), dict(project_ids=project_ids,
+                                             updated=updated))
+    db.session.commit()
+    return len(project_ids)
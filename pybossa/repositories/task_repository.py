@@ -17,17 +17,21 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
-from sqlalchemy.sql import text, and_
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import text, and_, or_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm.base import _entity_descriptor
 from sqlalchemy import cast
 from sqlalchemy import Text
 
+from pybossa.model import make_timestamp
 from pybossa.model.task import Task
 from pybossa.model.task_run import TaskRun
 from pybossa.exc import WrongObjectError, DBIntegrityError
 from pybossa.cache import projects as cached_projects
 from pybossa.core import uploader
+import pybossa.task_queue as task_queue
+import pybossa.project_counters as project_counters
+import pybossa.consensus as consensus
 
 
 def generate_query_from_keywords(model, **kwargs):
@@ -40,6 +44,12 @@ def generate_query_from_keywords(model, **kwargs):
     return and_(*clauses) if len(clauses) != 1 else (and_(*clauses), )
 
 
+def _answer_key(task_run):
+    user_id = task_run.user_id
+    return (int(task_run.task_id), int(user_id) if user_id else None,
+            task_run.user_ip)
+
+
 class TaskRepository(object):
 
     def __init__(self, db):
@@ -71,6 +81,11 @@ class TaskRepository(object):
         query_args = generate_query_from_keywords(Task, **filters)
         return self.db.session.query(Task).filter(*query_args).count()
 
+    def get_tasks(self, ids):
+        if not ids:
+            return []
+        return self.db.session.query(Task).filter(Task.id.in_(ids)).all()
+
 
     # Methods for queries on TaskRun objects
     def get_task_run(self, id):
@@ -98,6 +113,31 @@ class TaskRepository(object):
         query_args = generate_query_from_keywords(TaskRun, **filters)
         return self.db.session.query(TaskRun).filter(*query_args).count()
 
+    def get_answered_task_ids(self, task_ids, user_id=None, user_ip=None):
+        """Return the subset of task_ids with a task run of the volunteer."""
+        if not task_ids:
+            return set()
+        query = self.db.session.query(TaskRun.task_id).filter(
+            TaskRun.task_id.in_(task_ids),
+            TaskRun.user_id == user_id,
+            TaskRun.user_ip == user_ip)
+        return set(row.task_id for row in query)
+
+    def get_task_run_ids_by_volunteer(self, volunteers):
+        """Return the ids of the task runs of the given (task_id, user_id,
+        user_ip) triples, by triple."""
+        if not volunteers:
+            return {}
+        clauses = [and_(TaskRun.task_id == task_id,
+                        TaskRun.user_id == user_id,
+                        TaskRun.user_ip == user_ip)
+                   for task_id, user_id, user_ip in volunteers]
+        query = self.db.session.query(TaskRun.id, TaskRun.task_id,
+                                      TaskRun.user_id, TaskRun.user_ip).filter(
+            or_(*clauses))
+        return dict(((row.task_id, row.user_id, row.user_ip), row.id)
+                    for row in query)
+
 
     # Methods for saving, deleting and updating both Task and TaskRun objects
     def save(self, element):
@@ -110,6 +150,49 @@ class TaskRepository(object):
             self.db.session.rollback()
             raise DBIntegrityError(e)
 
+    def save_task_runs(self, task_runs):
+        """Insert many task runs with a single multi-row INSERT.
+
+        The TaskRun after_insert listeners (completion accounting, indexes,
+        feed) run once per task run, in the same transaction, and the cache
+        of every project is cleaned once. A volunteer answers a task once
+        (see the unique indexes of task_run), so the ids are matched by task
+        and volunteer.
+        """
+        from pybossa.model.event_listeners import task_runs_inserted
+        if not task_runs:
+            return
+        for task_run in task_runs:
+            self._validate_can_be('saved', task_run)
+        table = TaskRun.__table__
+        columns = [column.name for column in table.c if column.name != 'id']
+        rows = []
+        for task_run in task_runs:
+            task_run.created = task_run.created or make_timestamp()
+            task_run.finish_time = task_run.finish_time or make_timestamp()
+            rows.append(dict((name, getattr(task_run, name))
+                             for name in columns))
+        try:
+            conn = self.db.session.connection()
+            sql = table.insert().values(rows).returning(
+                table.c.id, table.c.task_id, table.c.user_id,
+                table.c.user_ip)
+            # The returned rows are not guaranteed to be in VALUES order
+            ids = dict((_answer_key(row), row.id)
+                       for row in conn.execute(sql))
+            for task_run in task_runs:
+                task_run.id = ids[_answer_key(task_run)]
+            task_runs_inserted(self.db.session, conn, task_runs)
+            self.db.session.commit()
+        except IntegrityError as e:
+            self.db.session.rollback()
+            raise DBIntegrityError(e)
+        except SQLAlchemyError:
+            self.db.session.rollback()
+            raise
+        for project_id in set(task_run.project_id for task_run in task_runs):
+            cached_projects.clean_project(project_id)
+
     def update(self, element):
         self._validate_can_be('updated', element)
         try:
@@ -139,10 +222,16 @@ class TaskRepository(object):
 
     def update_tasks_redundancy(self, project, n_answer):
         """update the n_answer of every task from a project and their state.
-        Use raw SQL for performance"""
+        Use raw SQL for performance.
+
+        Tasks completed before getting all their answers were closed early by
+        the completion policy of the project, so they stay completed."""
         sql = text('''
                    UPDATE task SET n_answers=:n_answers,
-                   state='ongoing' WHERE project_id=:project_id''')
+                   state=CASE WHEN state='completed'
+                   AND n_task_runs < n_answers THEN 'completed'
+                   ELSE 'ongoing' END
+                   WHERE project_id=:project_id''')
         self.db.session.execute(sql, dict(n_answers=n_answer, project_id=project.id))
         # Update task.state according to their new n_answers value
         sql = text('''
@@ -160,6 +249,11 @@ class TaskRepository(object):
         self.db.session.execute(sql, dict(n_answers=n_answer, project_id=project.id))
         self.db.session.commit()
         cached_projects.clean_project(project.id)
+        task_queue.invalidate(project.id)
+        project_counters.invalidate(project.id)
+        if consensus.get_policy(project.info) is not None:
+            # The tallies of the reopened tasks were dropped on completion
+            consensus.rebuild(project.id)
 
     def _validate_can_be(self, action, element):
         if not isinstance(element, Task) and not isinstance(element, TaskRun):
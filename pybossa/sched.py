@@ -15,34 +15,278 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
-"""Scheduler module for PyBossa tasks."""
+"""Scheduler module for PyBossa tasks.
+
+Schedulers are registered by name with register_scheduler. Besides the
+built-in ones, Python packages can provide schedulers through the
+pybossa.schedulers entry point group (see load_scheduler_plugins), and
+pybossa plugins can call register_scheduler when they are set up.
+
+"""
+from collections import OrderedDict
 from sqlalchemy.sql import text
+from pybossa.model.project import Project
 from pybossa.model.task import Task
 from pybossa.model.task_run import TaskRun
-from pybossa.core import db
+from pybossa.core import db, sentinel
+from pybossa.cache.local import LocalCache, Invalidator
+import pybossa.task_queue as task_queue
+import pybossa.answered_tasks as answered_tasks
+import pybossa.task_leases as task_leases
+import pybossa.task_sampler as task_sampler
+import pybossa.calibration as calibration
 import random
 
 
 session = db.slave_session
 
+# Above this number of answered tasks, it is cheaper to let the DB exclude
+# them than fetching and filtering them in memory.
+MAX_ANSWERED_IN_MEMORY = 1000
+
+# Number of tasks tried before giving up on finding one that is not leased.
+MAX_LEASE_ATTEMPTS = 5
+
+# Draws of the weighted random scheduler per request, and the share of them
+# returning closed tasks that triggers a rebuild of the project alias table.
+N_WEIGHTED_DRAWS = 10
+MAX_STALE_DRAWS = 0.5
+
+# Extra calibration tasks drawn to skip the ones answered by the user, and
+# extra scheduled tasks read to skip the calibration ones.
+N_CALIBRATION_DRAWS = 10
+
+SCHEDULERS_ENTRY_POINT = 'pybossa.schedulers'
+
+# Seconds the scheduling settings of a project are kept in memory.
+PROJECT_CONFIG_TIMEOUT = 60
+MAX_PROJECT_CONFIGS = 10000
+PROJECT_CONFIG_CHANNEL = 'pybossa:sched:project_config:invalidations'
+
+_schedulers = OrderedDict()
+_project_configs = LocalCache(MAX_PROJECT_CONFIGS)
+_project_config_invalidator = Invalidator(_project_configs,
+                                          PROJECT_CONFIG_CHANNEL)
+
+
+def register_scheduler(name, get_task, label=None, get_task_ids=None):
+    """Register a scheduler.
 
-def new_task(project_id, sched, user_id=None, user_ip=None, offset=0):
-    """Get a new task by calling the appropriate scheduler function."""
+    get_task(project_id, user_id, user_ip, offset) returns a task for the
+    user (or None). If the scheduler sorts the tasks, get_task_ids(project_id,
+    user_id, user_ip, limit) should return the ids of the next limit tasks, so
+    several tasks can be handed out running the scheduler only once.
+
+    Only schedulers with a label are offered in the Task Scheduler settings.
+    """
+    _schedulers[name] = dict(get_task=get_task, get_task_ids=get_task_ids,
+                             label=label)
+
+
+def get_scheduler(name):
+    """Return the registered scheduler, or the default one if unknown."""
+    return _schedulers.get(name) or _schedulers['default']
+
+
+def load_scheduler_plugins():
+    """Register the schedulers of the pybossa.schedulers entry points.
+
+    The name of the entry point is the scheduler name, and the object it
+    points to is the get_task function. Its label and get_task_ids
+    attributes, if any, are registered too.
+    """
+    import pkg_resources
+    for entry_point in pkg_resources.iter_entry_points(SCHEDULERS_ENTRY_POINT):
+        get_task = entry_point.load()
+        register_scheduler(entry_point.name, get_task,
+                           label=getattr(get_task, 'label', entry_point.name),
+                           get_task_ids=getattr(get_task, 'get_task_ids',
+                                                None))
+
+
+def get_project_config(project_id):
+    """Return the scheduling settings of a project, or None if not found.
+
+    They are cached in memory for PROJECT_CONFIG_TIMEOUT seconds, so the
+    newtask endpoints do not query the project on every request. Updates to
+    the project are published on a Redis channel, and every process drops
+    its copy.
+    """
+    _project_config_invalidator.ensure_listening(sentinel.master)
+    cached = _project_configs.get(str(project_id))
+    if cached is not None:
+        return cached
+    row = session.query(Project.id, Project.allow_anonymous_contributors,
+                        Project.calibration_frac, Project.info)\
+        .filter(Project.id == project_id).first()
+    if row is None:
+        return None
+    info = row.info or {}
+    config = dict(id=row.id,
+                  allow_anonymous_contributors=row.allow_anonymous_contributors,
+                  calibration_frac=row.calibration_frac,
+                  completion=info.get('completion'),
+                  sched=info.get('sched'),
+                  sched_lease=info.get('sched_lease'))
+    _project_configs.set(str(project_id), config, PROJECT_CONFIG_TIMEOUT)
+    return config
+
+
+def invalidate_project_config(project_id):
+    """Forget the cached scheduling settings of a project, in every
+    process."""
+    _project_config_invalidator.handle(str(project_id))
+    _project_config_invalidator.publish(sentinel.master, str(project_id))
+
+
+def new_task(project_id, sched, user_id=None, user_ip=None, offset=0,
+             lease=None, calibration_frac=0):
+    """Get a new task by calling the appropriate scheduler function.
+
+    If lease is the number of seconds of a task lease, the task is leased
+    to the user and tasks fully leased to other users are skipped.
+
+    If calibration_frac is set, that share of the tasks are calibration
+    tasks not answered yet by the user, and the scheduler does not hand out
+    calibration tasks.
+    """
+    if calibration_frac:
+        if random.random() < calibration_frac:
+            tasks = get_calibration_tasks(project_id, user_id, user_ip)
+            if tasks:
+                return tasks[0]
+        tasks = _new_scheduled_tasks(project_id, sched, user_id, user_ip,
+                                     offset, 1, lease, skip_calibration=True)
+        return tasks[0] if tasks else None
 
     print "new_task project_id:  %s.", project_id
     print "new_task user_id:  %s.", user_id
     print "new_task user_ip:  %s.", user_ip
     print "new_task sched:  %s.", sched
 
-    sched_map = {
-        'default': get_depth_first_task,
-        'breadth_first': get_breadth_first_task,
-        'depth_first': get_depth_first_task,
-        'incremental': get_incremental_task}
+    if not lease:
+        scheduler = get_scheduler(sched)['get_task']
+        return scheduler(project_id, user_id, user_ip, offset=offset)
+    return get_leased_task(sched, project_id, user_id, user_ip, offset, lease)
 
 
-    scheduler = sched_map.get(sched, sched_map['default'])
-    return scheduler(project_id, user_id, user_ip, offset=offset)
+def new_tasks(project_id, sched, user_id=None, user_ip=None, offset=0,
+              limit=1, lease=None, calibration_frac=0):
+    """Get up to limit distinct new tasks for a user.
+
+    The scheduler query runs only once for the schedulers that sort the
+    tasks (the ones with get_task_ids). The others are called once per task.
+
+    If calibration_frac is set, every task has that chance of being a
+    calibration task, placed at a random position of the list, and the
+    scheduler does not hand out calibration tasks.
+    """
+    calibration_tasks = []
+    if calibration_frac:
+        n_calibration = len([i for i in range(limit)
+                             if random.random() < calibration_frac])
+        if n_calibration:
+            calibration_tasks = get_calibration_tasks(project_id, user_id,
+                                                      user_ip, n_calibration)
+    tasks = _new_scheduled_tasks(project_id, sched, user_id, user_ip, offset,
+                                 limit - len(calibration_tasks), lease,
+                                 skip_calibration=bool(calibration_frac))
+    for task in calibration_tasks:
+        tasks.insert(random.randint(0, len(tasks)), task)
+    return tasks
+
+
+def _new_scheduled_tasks(project_id, sched, user_id=None, user_ip=None,
+                         offset=0, limit=1, lease=None,
+                         skip_calibration=False):
+    """Get up to limit tasks from the scheduler.
+
+    If skip_calibration is True, the calibration tasks it returns are
+    skipped, as they are handed out from the calibration pool.
+    """
+    if limit <= 0:
+        return []
+    n_skipped = N_CALIBRATION_DRAWS if skip_calibration else 0
+    get_task_ids = get_scheduler(sched)['get_task_ids']
+    if get_task_ids is None:
+        tasks = []
+        for i in range(limit + n_skipped):
+            if len(tasks) == limit:
+                break
+            task = new_task(project_id, sched, user_id, user_ip, offset + i,
+                            lease)
+            if task is None or task in tasks:
+                continue
+            if not (skip_calibration and task.calibration):
+                tasks.append(task)
+        return tasks
+    n_candidates = (offset + limit + n_skipped +
+                    (MAX_LEASE_ATTEMPTS if lease else 0))
+    task_ids = get_task_ids(project_id, user_id, user_ip,
+                            limit=n_candidates)[offset:]
+    tasks = get_tasks(task_ids)
+    if skip_calibration:
+        tasks = [task for task in tasks if not task.calibration]
+    if lease:
+        leased = []
+        for task in tasks:
+            if len(leased) == limit:
+                break
+            if task_leases.acquire(task, lease, user_id, user_ip):
+                leased.append(task)
+        return leased or tasks[:1]
+    return tasks[:limit]
+
+
+def get_tasks(task_ids):
+    """Load the tasks with the given ids in one query, keeping their order."""
+    if not task_ids:
+        return []
+    tasks = session.query(Task).filter(Task.id.in_(task_ids)).all()
+    tasks_by_id = dict((task.id, task) for task in tasks)
+    return [tasks_by_id[task_id] for task_id in task_ids
+            if task_id in tasks_by_id]
+
+
+def get_calibration_tasks(project_id, user_id=None, user_ip=None, limit=1):
+    """Get up to limit random calibration tasks not answered by the user."""
+    n_draws = limit + N_CALIBRATION_DRAWS
+    task_ids = calibration.sample_task_ids(project_id, n_draws)
+    if task_ids is None:
+        # No calibration tasks for this request, while the pool is rebuilt
+        calibration.enqueue_rebuild(project_id)
+        return []
+    answered = set(get_answered_task_ids(project_id, task_ids, user_id,
+                                         user_ip))
+    return get_tasks([task_id for task_id in task_ids
+                      if task_id not in answered][:limit])
+
+
+def get_leased_task(sched, project_id, user_id=None, user_ip=None,
+                    offset=0, lease=60):
+    """Get a new task from a scheduler and lease it to the user.
+
+    The next MAX_LEASE_ATTEMPTS tasks are tried in order. If all of them are
+    leased to other users, the first one is returned anyway: an extra answer
+    is better than a volunteer without a task.
+
+    The candidates are read with a single scheduler query for the schedulers
+    with get_task_ids. The others are called once per attempt.
+    """
+    if get_scheduler(sched)['get_task_ids'] is not None:
+        tasks = _new_scheduled_tasks(project_id, sched, user_id, user_ip,
+                                     offset, 1, lease)
+        return tasks[0] if tasks else None
+    scheduler = get_scheduler(sched)['get_task']
+    first_task = None
+    for attempt in range(MAX_LEASE_ATTEMPTS):
+        task = scheduler(project_id, user_id, user_ip, offset=offset + attempt)
+        if task is None:
+            break
+        if task_leases.acquire(task, lease, user_id, user_ip):
+            return task
+        first_task = first_task or task
+    return first_task
 
 
 def get_breadth_first_task(project_id, user_id=None, user_ip=None, offset=0):
@@ -50,69 +294,163 @@ def get_breadth_first_task(project_id, user_id=None, user_ip=None, offset=0):
 
     It excludes the current user.
 
+    The number of task runs of every task is kept in task.n_task_runs (it is
+    updated on every task run insert), so the least answered tasks are read
+    from the (project_id, n_task_runs, id) index instead of counting the task
+    runs of the whole project.
+
     Note that it **ignores** the number of answers limit for efficiency reasons
     (this is not a big issue as all it means is that you may end up with some
     tasks run more than is strictly needed!)
     """
-    print "get_breadth_first_task is called"
+    task_ids = get_breadth_first_task_ids(project_id, user_id, user_ip)
+    total_remaining = len(task_ids) - offset
+    if total_remaining <= 0:
+        return None
+    return session.query(Task).get(task_ids[offset])
 
-    if user_id:
+
+def get_breadth_first_task_ids(project_id, user_id=None, user_ip=None,
+                               limit=10):
+    """Get the ids of the least answered tasks not answered by the user."""
+    answered = answered_tasks.get(project_id, user_id, user_ip)
+    if _can_filter_in_memory(answered):
         sql = text('''
-                   SELECT task.id, COUNT(task_run.task_id) AS taskcount
-                   FROM task
-                   LEFT JOIN task_run ON (task.id = task_run.task_id)
+                   SELECT id FROM task
+                   WHERE project_id=:project_id AND state !='completed'
+                   ORDER BY n_task_runs, id ASC LIMIT :limit;
+                   ''')
+        rows = session.execute(sql, dict(project_id=project_id,
+                                         limit=len(answered) + limit))
+    elif user_id:
+        sql = text('''
+                   SELECT id FROM task
                    WHERE NOT EXISTS
                    (SELECT 1 FROM task_run WHERE project_id=:project_id AND
                    user_id=:user_id AND task_id=task.id)
-                   AND task.project_id=:project_id AND task.state !='completed'
-                   group by task.id ORDER BY taskcount, id ASC LIMIT 10;
+                   AND project_id=:project_id AND state !='completed'
+                   ORDER BY n_task_runs, id ASC LIMIT :limit;
                    ''')
         rows = session.execute(sql,
-                               dict(project_id=project_id, user_id=user_id))
+                               dict(project_id=project_id, user_id=user_id,
+                                    limit=limit))
     else:
         if not user_ip:  # pragma: no cover
             user_ip = '127.0.0.1'
         sql = text('''
-                   SELECT task.id, COUNT(task_run.task_id) AS taskcount
-                   FROM task
-                   LEFT JOIN task_run ON (task.id = task_run.task_id)
+                   SELECT id FROM task
                    WHERE NOT EXISTS
                    (SELECT 1 FROM task_run WHERE project_id=:project_id AND
                    user_ip=:user_ip AND task_id=task.id)
-                   AND task.project_id=:project_id AND task.state !='completed'
-                   group by task.id ORDER BY taskcount, id ASC LIMIT 10;
+                   AND project_id=:project_id AND state !='completed'
+                   ORDER BY n_task_runs, id ASC LIMIT :limit;
                    ''')
-
-        print "get_breadth_first_task sql: ", sql
-
         rows = session.execute(sql,
-                               dict(project_id=project_id, user_ip=user_ip))
+                               dict(project_id=project_id, user_ip=user_ip,
+                                    limit=limit))
+    return _filter_answered([x[0] for x in rows], answered, limit)
 
 
-        print "get_breadth_first_task tasks: ", rows
-
-
-    task_ids = [x[0] for x in rows]
-
+def get_depth_first_task(project_id, user_id=None, user_ip=None, offset=0):
+    """Get a new task for a given project."""
+    print "get_depth_first_task is called"
+    candidate_task_ids = get_candidate_task_ids(project_id, user_id, user_ip)
+    total_remaining = len(candidate_task_ids) - offset
+    if total_remaining <= 0:
+        return None
+    return session.query(Task).get(candidate_task_ids[offset])
 
-    total_remaining = len(task_ids) - offset
 
+def get_depth_first_queue_task(project_id, user_id=None, user_ip=None,
+                               offset=0):
+    """Get a new task for a given project from its precomputed queue.
 
+    It falls back to the SQL depth first scheduler when the queue is cold
+    (it is rebuilt in the background) or has nothing left for the user.
+    """
+    candidate_task_ids = get_depth_first_queue_task_ids(project_id, user_id,
+                                                        user_ip,
+                                                        limit=offset + 1)
+    total_remaining = len(candidate_task_ids) - offset
     if total_remaining <= 0:
         return None
-    return session.query(Task).get(task_ids[offset])
+    return session.query(Task).get(candidate_task_ids[offset])
 
 
-def get_depth_first_task(project_id, user_id=None, user_ip=None, offset=0):
-    """Get a new task for a given project."""
-    print "get_depth_first_task is called"
-    candidate_task_ids = get_candidate_task_ids(project_id, user_id, user_ip)
+def get_depth_first_queue_task_ids(project_id, user_id=None, user_ip=None,
+                                   limit=10):
+    """Get the ids of the next open tasks of the project queue.
+
+    The queue only has open tasks (they are removed as they are completed),
+    so only the tasks answered by the user are skipped.
+    """
+    answered = answered_tasks.get(project_id, user_id, user_ip)
+
+    def exclude(task_ids):
+        if answered is None:
+            return get_answered_task_ids(project_id, task_ids, user_id,
+                                         user_ip)
+        return [task_id for task_id in task_ids if task_id in answered]
+
+    candidate_task_ids = task_queue.get_candidate_task_ids(project_id, exclude,
+                                                           limit=limit)
+    if candidate_task_ids is None:
+        task_queue.enqueue_rebuild(project_id)
+    if not candidate_task_ids or len(candidate_task_ids) < limit:
+        return get_candidate_task_ids(project_id, user_id, user_ip, limit)
+    return candidate_task_ids
+
+
+def get_weighted_random_task(project_id, user_id=None, user_ip=None,
+                             offset=0):
+    """Get a random task, with a probability proportional to its priority.
+
+    The tasks are drawn from a precomputed alias table of the project (see
+    pybossa.task_sampler), so volunteers are spread over all the open tasks
+    instead of all of them getting the top priority one.
+    """
+    candidate_task_ids = get_weighted_random_task_ids(project_id, user_id,
+                                                      user_ip,
+                                                      limit=offset + 1)
     total_remaining = len(candidate_task_ids) - offset
     if total_remaining <= 0:
         return None
     return session.query(Task).get(candidate_task_ids[offset])
 
 
+def get_weighted_random_task_ids(project_id, user_id=None, user_ip=None,
+                                 limit=10):
+    """Get the ids of limit random open tasks not answered by the user.
+
+    It falls back to the depth first scheduler while the alias table of the
+    project is being built, or when the draws find nothing for the user.
+    """
+    sampled = task_sampler.sample_task_ids(project_id,
+                                           N_WEIGHTED_DRAWS + limit)
+    if sampled is None:
+        task_sampler.enqueue_rebuild(project_id)
+        return get_candidate_task_ids(project_id, user_id, user_ip, limit)
+    task_ids = []
+    for task_id in sampled:
+        if task_id not in task_ids:
+            task_ids.append(task_id)
+    open_task_ids = set()
+    if task_ids:
+        query = session.query(Task.id).filter(Task.id.in_(task_ids))\
+            .filter(Task.state != u'completed')
+        open_task_ids = set(row.id for row in query)
+    if len(task_ids) - len(open_task_ids) > len(task_ids) * MAX_STALE_DRAWS:
+        task_sampler.enqueue_rebuild(project_id)
+    answered = set(get_answered_task_ids(project_id, list(open_task_ids),
+                                         user_id, user_ip))
+    candidate_task_ids = [task_id for task_id in task_ids
+                          if task_id in open_task_ids
+                          and task_id not in answered]
+    if not candidate_task_ids:
+        return get_candidate_task_ids(project_id, user_id, user_ip, limit)
+    return candidate_task_ids[:limit]
+
+
 def get_incremental_task(project_id, user_id=None, user_ip=None, offset=0):
     """Get a new task for a given project with its last given answer.
 
@@ -134,15 +472,24 @@ def get_incremental_task(project_id, user_id=None, user_ip=None, offset=0):
     last_task_run = q.first()
     if last_task_run:
         task.info['last_answer'] = last_task_run.info
-        # TODO: As discussed in GitHub #53
-        # it is necessary to create a lock in the task!
+        # As discussed in GitHub #53, enable the project task leases
+        # (info['sched_lease']) to lock the task while it is being answered.
     return task
 
 
-def get_candidate_task_ids(project_id, user_id=None, user_ip=None):
+def get_candidate_task_ids(project_id, user_id=None, user_ip=None, limit=10):
     """Get all available tasks for a given project and user."""
     rows = None
     print "get_candidate_task_ids is called"
+    answered = answered_tasks.get(project_id, user_id, user_ip)
+    if _can_filter_in_memory(answered):
+        query = text('''
+                     SELECT id FROM task
+                     WHERE project_id=:project_id AND state !='completed'
+                     ORDER BY priority_0 DESC, id ASC LIMIT :limit''')
+        rows = session.execute(query, dict(project_id=project_id,
+                                           limit=len(answered) + limit))
+        return _filter_answered([t.id for t in rows], answered, limit)
     if user_id:
         query = text('''
                      SELECT id FROM task WHERE NOT EXISTS
@@ -150,9 +497,9 @@ def get_candidate_task_ids(project_id, user_id=None, user_ip=None):
                      project_id=:project_id AND user_id=:user_id
                         AND task_id=task.id)
                      AND project_id=:project_id AND state !='completed'
-                     ORDER BY priority_0 DESC, id ASC LIMIT 10''')
+                     ORDER BY priority_0 DESC, id ASC LIMIT :limit''')
         rows = session.execute(query, dict(project_id=project_id,
-                                           user_id=user_id))
+                                           user_id=user_id, limit=limit))
     else:
         if not user_ip:
             user_ip = '127.0.0.1'
@@ -162,13 +509,55 @@ def get_candidate_task_ids(project_id, user_id=None, user_ip=None):
                      project_id=:project_id AND user_ip=:user_ip
                         AND task_id=task.id)
                      AND project_id=:project_id AND state !='completed'
-                     ORDER BY priority_0 DESC, id ASC LIMIT 10''')
+                     ORDER BY priority_0 DESC, id ASC LIMIT :limit''')
         rows = session.execute(query, dict(project_id=project_id,
-                                           user_ip=user_ip))
+                                           user_ip=user_ip, limit=limit))
 
     return [t.id for t in rows]
 
 
+def get_answered_task_ids(project_id, task_ids, user_id=None, user_ip=None):
+    """Return the subset of task_ids already answered by the user."""
+    if not task_ids:
+        return []
+    answered = answered_tasks.get(project_id, user_id, user_ip)
+    if answered is not None:
+        return [task_id for task_id in task_ids if task_id in answered]
+    query = session.query(TaskRun.task_id)\
+        .filter(TaskRun.project_id == project_id)\
+        .filter(TaskRun.task_id.in_(task_ids))
+    if user_id:
+        query = query.filter(TaskRun.user_id == user_id)
+    else:
+        query = query.filter(TaskRun.user_ip == (user_ip or '127.0.0.1'))
+    return [row.task_id for row in query]
+
+
+def _can_filter_in_memory(answered):
+    return answered is not None and len(answered) <= MAX_ANSWERED_IN_MEMORY
+
+
+def _filter_answered(task_ids, answered, limit=10):
+    if answered is None:
+        return task_ids
+    return [task_id for task_id in task_ids if task_id not in answered][:limit]
+
+
 def sched_variants():
-    return [('default', 'Default'), ('breadth_first', 'Breadth First'),
-            ('depth_first', 'Depth First')]
+    return [(name, scheduler['label'])
+            for name, scheduler in _schedulers.items() if scheduler['label']]
+
+
+register_scheduler('default', get_depth_first_task, 'Default',
+                   get_candidate_task_ids)
+register_scheduler('breadth_first', get_breadth_first_task, 'Breadth First',
+                   get_breadth_first_task_ids)
+register_scheduler('depth_first', get_depth_first_task, 'Depth First',
+                   get_candidate_task_ids)
+register_scheduler('depth_first_queue', get_depth_first_queue_task,
+                   'Depth First (precomputed queue)',
+                   get_depth_first_queue_task_ids)
+register_scheduler('weighted_random', get_weighted_random_task,
+                   'Weighted Random (by priority)',
+                   get_weighted_random_task_ids)
+register_scheduler('incremental', get_incremental_task)
@@ -16,3 +16,27 @@ class Sentinel(object):
         redis_db = app.config.get('REDIS_DB') or 0
         self.master = self.connection.master_for('mymaster', db=redis_db)
         self.slave = self.connection.slave_for('mymaster', db=redis_db)
+
+    def register_script(self, script):
+        """Return a Lua script that is only loaded in Redis on first use."""
+        return Script(self, script)
+
+
+class Script(object):
+
+    """Lua script run on the master (or the given client or pipeline).
+
+    redis-py loads a script every time it is registered, so the modules
+    register their scripts once, and the first call loads them.
+    """
+
+    def __init__(self, sentinel, script):
+        self.sentinel = sentinel
+        self.script = script
+        self._script = None
+
+    def __call__(self, keys=[], args=[], client=None):
+        if self._script is None:
+            self._script = self.sentinel.master.register_script(self.script)
+        client = self.sentinel.master if client is None else client
+        return self._script(keys=keys, args=args, client=client)
@@ -0,0 +1,207 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Side effects of the model changes, sent once they are committed.
+
+The model event listeners run inside the SQLAlchemy flush, once per row. So
+instead of updating Redis or enqueueing jobs straight away, they buffer those
+side effects in the session of the target, and they are sent after commit:
+
+    * Redis writes (functions with a pipeline argument) in a single pipeline.
+    * Batches (e.g. the task queue updates), once per batch function.
+    * Other calls (e.g. enqueueing jobs), in order.
+
+The buffer is dropped if the transaction is rolled back, and restored to its
+state at the start of a savepoint if the savepoint is rolled back. Targets
+that do not belong to a session run their side effects straight away, unless
+they are handled within buffered_in (e.g. rows inserted with a multi-row
+INSERT). The transaction is already committed when they are sent, so their
+errors are logged and not raised (the Redis indexes can be rebuilt from the
+DB).
+
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.exc import UnmappedInstanceError
+from pybossa.core import sentinel
+
+
+BUFFER_KEY = 'pybossa_side_effects'
+COMMITTED_KEY = 'pybossa_side_effects_committed'
+SAVEPOINTS_KEY = 'pybossa_side_effects_savepoints'
+_context = threading.local()
+
+
+def _get_buffer(target):
+    try:
+        session = object_session(target)
+    except UnmappedInstanceError:
+        session = None
+    if session is None:
+        session = getattr(_context, 'session', None)
+    if session is None:
+        return None
+    if BUFFER_KEY not in session.info:
+        session.info[BUFFER_KEY] = dict(writes=[], batches=OrderedDict(),
+                                        calls=[], once=set(), memo={})
+    return session.info[BUFFER_KEY]
+
+
+@contextmanager
+def buffered_in(session):
+    """Buffer in session the side effects of the targets that do not belong
+    to any session."""
+    _context.session = session
+    try:
+        yield
+    finally:
+        _context.session = None
+
+
+def defer_write(target, func, *args, **kwargs):
+    """Add func(*args, pipeline=pipeline, **kwargs) to the after commit
+    pipeline."""
+    buf = _get_buffer(target)
+    if buf is None:
+        return func(*args, **kwargs)
+    buf['writes'].append((func, args, kwargs))
+
+
+def defer_call(target, func, *args, **kwargs):
+    """Call func(*args, **kwargs) after commit."""
+    buf = _get_buffer(target)
+    if buf is None:
+        return func(*args, **kwargs)
+    buf['calls'].append((func, args, kwargs))
+
+
+def defer_call_once(target, func, *args):
+    """Call func(*args) after commit, once per transaction."""
+    buf = _get_buffer(target)
+    if buf is None:
+        return func(*args)
+    if (func, args) not in buf['once']:
+        buf['once'].add((func, args))
+        buf['calls'].append((func, args, {}))
+
+
+def batch(target, func):
+    """Return a dict that is passed to func after commit.
+
+    Returns None if the target does not belong to a session, so the caller
+    has to send its side effect straight away.
+    """
+    buf = _get_buffer(target)
+    if buf is None:
+        return None
+    return buf['batches'].setdefault(func, OrderedDict())
+
+
+def memo(target):
+    """Return a dict to keep values (e.g. rows read by the listeners) until
+    the end of the transaction."""
+    buf = _get_buffer(target)
+    if buf is None:
+        return {}
+    return buf['memo']
+
+
+@event.listens_for(Session, 'after_commit')
+def mark_committed(session):
+    """Record the commit (of the transaction or of a savepoint, which
+    after_transaction_end tells apart)."""
+    session.info[COMMITTED_KEY] = True
+
+
+@event.listens_for(Session, 'after_rollback')
+def mark_rolled_back(session):
+    session.info[COMMITTED_KEY] = False
+
+
+def _copy(buf):
+    # The memo values are rows or dicts of counts
+    return dict(writes=list(buf['writes']),
+                batches=OrderedDict((func, OrderedDict(items))
+                                    for func, items in buf['batches'].items()),
+                calls=list(buf['calls']), once=set(buf['once']),
+                memo=dict((key, dict(value) if isinstance(value, dict)
+                           else value)
+                          for key, value in buf['memo'].items()))
+
+
+@event.listens_for(Session, 'after_transaction_create')
+def snapshot_savepoint(session, transaction):
+    """Keep a copy of the buffer at the start of a savepoint."""
+    if transaction.nested:
+        buf = session.info.get(BUFFER_KEY)
+        savepoints = session.info.setdefault(SAVEPOINTS_KEY, {})
+        savepoints[transaction] = None if buf is None else _copy(buf)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def restore_savepoint(session, previous_transaction):
+    """Drop the side effects buffered since the start of a savepoint that was
+    rolled back (after_rollback is not called for savepoints)."""
+    savepoints = session.info.get(SAVEPOINTS_KEY, {})
+    if previous_transaction not in savepoints:
+        return
+    buf = savepoints.pop(previous_transaction)
+    if buf is None:
+        session.info.pop(BUFFER_KEY, None)
+    else:
+        session.info[BUFFER_KEY] = buf
+
+
+def _send(description, func, *args, **kwargs):
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        current_app.logger.exception('Side effect %s failed' % description)
+
+
+def _execute(writes):
+    pipeline = sentinel.master.pipeline()
+    for func, args, kwargs in writes:
+        func(*args, pipeline=pipeline, **kwargs)
+    pipeline.execute()
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def send(session, transaction):
+    """Send the side effects of a committed transaction, or forget them if
+    it was rolled back."""
+    # SQLAlchemy 1.0.5 has no public accessor for the parent transaction
+    if transaction._parent is not None:
+        # A savepoint or a subtransaction: the changes may still be rolled
+        # back
+        return
+    session.info.pop(SAVEPOINTS_KEY, None)
+    committed = session.info.pop(COMMITTED_KEY, False)
+    buf = session.info.pop(BUFFER_KEY, None)
+    if buf is None or not committed:
+        return
+    if buf['writes']:
+        _send('writes', _execute, buf['writes'])
+    for func, items in buf['batches'].items():
+        _send(func.__name__, func, items)
+    for func, args, kwargs in buf['calls']:
+        _send(getattr(func, '__name__', repr(func)), func, *args, **kwargs)
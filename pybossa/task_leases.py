@@ -0,0 +1,89 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Short lived task reservations (leases) for the schedulers.
+
+When a project enables them (see ``project.info['sched_lease']``), every task
+handed out to a volunteer is leased to that volunteer for a few seconds. A
+task can only have as many active leases as answers it still needs, so
+volunteers arriving at the same time get different tasks instead of all of
+them answering the same top priority one.
+
+The leases of a task are a Redis sorted set of volunteers scored by the lease
+expiry time. They are acquired with a Lua script, so checking the free slots
+and taking one is atomic, and released when the volunteer task run arrives.
+
+"""
+import time
+from pybossa.core import sentinel
+
+
+LEASE_KEY = 'pybossa:sched:lease:%s'
+
+# KEYS[1]: lease key of the task
+# ARGV: volunteer, now, ttl, slots
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) or
+   redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[4]) then
+    redis.call('ZADD', KEYS[1], now + ttl, ARGV[1])
+    redis.call('EXPIRE', KEYS[1], ttl)
+    return 1
+end
+return 0
+"""
+
+_acquire_script = sentinel.register_script(ACQUIRE_SCRIPT)
+
+
+def _volunteer(user_id=None, user_ip=None):
+    if user_id:
+        return 'user:%s' % user_id
+    return 'ip:%s' % (user_ip or '127.0.0.1')
+
+
+def acquire(task, ttl, user_id=None, user_ip=None):
+    """Lease a task to a volunteer for ttl seconds.
+
+    Returns True if the volunteer got (or already had) a lease, and False if
+    all the answers the task still needs are leased to other volunteers.
+    """
+    ttl = int(ttl)
+    slots = max((task.n_answers or 1) - (task.n_task_runs or 0), 1)
+    acquired = _acquire_script(keys=[LEASE_KEY % task.id],
+                               args=[_volunteer(user_id, user_ip),
+                                     time.time(), ttl, slots])
+    return bool(acquired)
+
+
+def release(task_id, user_id=None, user_ip=None, pipeline=None):
+    """Release the lease of a volunteer on a task.
+
+    A task run can have both a user_id and a user_ip, so both leases are
+    released. If a pipeline is given, the command is only added to it.
+    """
+    volunteers = []
+    if user_id is not None:
+        volunteers.append(_volunteer(user_id=user_id))
+    if user_ip is not None:
+        volunteers.append(_volunteer(user_ip=user_ip))
+    if volunteers:
+        redis = sentinel.master if pipeline is None else pipeline
+        redis.zrem(LEASE_KEY % task_id, *volunteers)
@@ -0,0 +1,211 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Precomputed queue of open tasks for the depth first scheduler.
+
+Every project gets a Redis sorted set with the ids of its open (not completed)
+tasks. The score is the negated task priority, and members are zero padded so
+that ZRANGE returns the tasks in the same order as
+``ORDER BY priority_0 DESC, id ASC``.
+
+The queue is only maintained once it has been built (it is "warm"). While it
+is cold or being rebuilt, the scheduler falls back to the SQL path. The tasks
+removed while it is being rebuilt are recorded, and removed again from the
+rebuilt queue, as the snapshot it is built from may still have them.
+
+"""
+from pybossa.core import sentinel
+
+
+QUEUE_KEY = 'pybossa:sched:queue:%s'
+READY_KEY = 'pybossa:sched:queue:%s:ready'
+BUILDING_KEY = 'pybossa:sched:queue:%s:building'
+TMP_QUEUE_KEY = 'pybossa:sched:queue:%s:tmp'
+REMOVED_KEY = 'pybossa:sched:queue:%s:removed'
+BUILD_TIMEOUT = 10 * 60
+PAGE_SIZE = 50
+# Pages read per request, at most. Volunteers who answered most of the queue
+# get their tasks from SQL instead.
+MAX_PAGES = 4
+CHUNK_SIZE = 1000
+
+
+def _member(task_id):
+    return '%010d' % int(task_id)
+
+
+def _task_id(member):
+    return int(member)
+
+
+def _status(project_id):
+    """Return (ready, building) for the queue of a project."""
+    ready, building = sentinel.master.mget(READY_KEY % project_id,
+                                           BUILDING_KEY % project_id)
+    return bool(ready), bool(building)
+
+
+def is_ready(project_id):
+    """Return True if the queue of the project is warm."""
+    ready, building = _status(project_id)
+    return ready and not building
+
+
+def push(project_id, task_id, priority=0):
+    """Add (or re-score) an open task in the project queue."""
+    ready, building = _status(project_id)
+    if not (ready or building):
+        return False
+    pipeline = sentinel.master.pipeline()
+    pipeline.zadd(QUEUE_KEY % project_id, -float(priority or 0),
+                  _member(task_id))
+    if building:
+        pipeline.zadd(TMP_QUEUE_KEY % project_id, -float(priority or 0),
+                      _member(task_id))
+        pipeline.srem(REMOVED_KEY % project_id, _member(task_id))
+    pipeline.execute()
+    return True
+
+
+def remove(project_id, task_id):
+    """Remove a task (completed or deleted) from the project queue."""
+    ready, building = _status(project_id)
+    if not (ready or building):
+        return False
+    pipeline = sentinel.master.pipeline()
+    pipeline.zrem(QUEUE_KEY % project_id, _member(task_id))
+    if building:
+        pipeline.zrem(TMP_QUEUE_KEY % project_id, _member(task_id))
+        _record_removal(pipeline, project_id, task_id)
+    pipeline.execute()
+    return True
+
+
+def _record_removal(pipeline, project_id, task_id):
+    key = REMOVED_KEY % project_id
+    pipeline.sadd(key, _member(task_id))
+    pipeline.expire(key, BUILD_TIMEOUT)
+
+
+def update_many(updates):
+    """Push or remove many tasks with two round trips to Redis.
+
+    The updates argument maps (project_id, task_id) to the task priority, or
+    to None if the task must be removed from the queue.
+    """
+    project_ids = list(set(project_id for project_id, _ in updates))
+    if not project_ids:
+        return
+    pipeline = sentinel.master.pipeline()
+    for project_id in project_ids:
+        pipeline.mget(READY_KEY % project_id, BUILDING_KEY % project_id)
+    statuses = dict(zip(project_ids, pipeline.execute()))
+    for (project_id, task_id), priority in updates.items():
+        ready, building = statuses[project_id]
+        if not (ready or building):
+            continue
+        keys = [QUEUE_KEY % project_id]
+        if building:
+            keys.append(TMP_QUEUE_KEY % project_id)
+        for key in keys:
+            if priority is None:
+                pipeline.zrem(key, _member(task_id))
+            else:
+                pipeline.zadd(key, -float(priority or 0), _member(task_id))
+        if building and priority is None:
+            _record_removal(pipeline, project_id, task_id)
+        elif building:
+            pipeline.srem(REMOVED_KEY % project_id, _member(task_id))
+    pipeline.execute()
+
+
+def invalidate(project_id):
+    """Mark the queue as cold, so the scheduler uses SQL until rebuilt."""
+    sentinel.master.delete(READY_KEY % project_id, QUEUE_KEY % project_id)
+
+
+def enqueue_rebuild(project_id):
+    """Enqueue a background rebuild of the queue, unless one is running."""
+    from rq import Queue
+    if not sentinel.master.set(BUILDING_KEY % project_id, 1,
+                               ex=BUILD_TIMEOUT, nx=True):
+        return False
+    queue = Queue('high', connection=sentinel.master)
+    queue.enqueue_call(func=rebuild, args=(project_id,),
+                       timeout=BUILD_TIMEOUT)
+    return True
+
+
+def rebuild(project_id):
+    """Rebuild the queue of a project from the DB."""
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    sentinel.master.set(BUILDING_KEY % project_id, 1, ex=BUILD_TIMEOUT)
+    tmp_key = TMP_QUEUE_KEY % project_id
+    removed_key = REMOVED_KEY % project_id
+    sentinel.master.delete(tmp_key, removed_key)
+    sql = text('''SELECT id, priority_0 FROM task
+               WHERE project_id=:project_id AND state !='completed';''')
+    results = db.slave_session.execute(sql, dict(project_id=project_id))
+    pipeline = sentinel.master.pipeline()
+    n_tasks = 0
+    for row in results:
+        pipeline.zadd(tmp_key, -float(row.priority_0 or 0), _member(row.id))
+        n_tasks += 1
+        if n_tasks % CHUNK_SIZE == 0:
+            pipeline.execute()
+    pipeline.execute()
+    # The snapshot may have tasks completed or deleted during the build.
+    # Removals from now on are applied to the tmp queue straight away.
+    removed = sentinel.master.smembers(removed_key)
+    if removed:
+        pipeline.zrem(tmp_key, *removed)
+    pipeline.delete(removed_key)
+    # Unlike RENAME, it works when the tmp queue is empty (and missing)
+    pipeline.zunionstore(QUEUE_KEY % project_id, [tmp_key])
+    pipeline.delete(tmp_key)
+    pipeline.set(READY_KEY % project_id, 1)
+    pipeline.delete(BUILDING_KEY % project_id)
+    pipeline.execute()
+    return n_tasks
+
+
+def get_candidate_task_ids(project_id, exclude, limit=10):
+    """Return up to limit open task ids, highest priority first.
+
+    The exclude argument is a function that receives a list of task ids and
+    returns the subset of them that must be skipped (e.g. the ones already
+    answered by the user).
+
+    Returns None if the queue is cold, so the caller can fall back to SQL.
+    It returns less than limit ids if MAX_PAGES pages do not have them.
+    """
+    if not is_ready(project_id):
+        return None
+    key = QUEUE_KEY % project_id
+    candidates = []
+    start = 0
+    while len(candidates) < limit and start < MAX_PAGES * PAGE_SIZE:
+        members = sentinel.master.zrange(key, start, start + PAGE_SIZE - 1)
+        if not members:
+            break
+        task_ids = [_task_id(m) for m in members]
+        excluded = set(exclude(task_ids))
+        candidates.extend(t for t in task_ids if t not in excluded)
+        start += PAGE_SIZE
+    return candidates[:limit]
@@ -0,0 +1,160 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Priority weighted sampling of the open tasks of a project.
+
+Every project using the weighted random scheduler gets an alias table (see
+Vose's alias method) of its open tasks, weighted by priority_0, stored in a
+Redis hash:
+
+    * n: number of tasks in the table.
+    * p:<i>: probability of keeping the i-th task when drawn.
+    * t:<i>: id of the i-th task.
+    * a:<i>: id of the task returned instead of the i-th one (its alias).
+
+A draw picks a random slot and reads its three fields with a single HMGET,
+so sampling costs the same no matter how many tasks the project has.
+
+Tables are rebuilt in the background when tasks are added, when the project
+priorities change or when too many draws return tasks that are no longer
+open.
+
+"""
+import random
+from pybossa.core import sentinel
+
+
+TABLE_KEY = 'pybossa:sched:alias:%s'
+TMP_TABLE_KEY = 'pybossa:sched:alias:%s:tmp'
+BUILDING_KEY = 'pybossa:sched:alias:%s:building'
+STALE_KEY = 'pybossa:sched:alias:%s:stale'
+BUILD_TIMEOUT = 10 * 60
+CHUNK_SIZE = 1000
+# Tasks with priority 0 are still sent, just less often.
+MIN_WEIGHT = 0.01
+
+
+def build_alias_table(weights):
+    """Return the (probabilities, aliases) of Vose's alias method."""
+    n = len(weights)
+    total = float(sum(weights))
+    scaled = [weight * n / total for weight in weights]
+    probabilities = [1.0] * n
+    aliases = range(n)
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        probabilities[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] = scaled[more] + scaled[less] - 1.0
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+    return probabilities, aliases
+
+
+def exists(project_id):
+    """Return True if the project has an alias table."""
+    return bool(sentinel.master.exists(TABLE_KEY % project_id))
+
+
+def enqueue_rebuild(project_id):
+    """Enqueue a background rebuild of the table, unless one is running."""
+    from rq import Queue
+    if not sentinel.master.set(BUILDING_KEY % project_id, 1,
+                               ex=BUILD_TIMEOUT, nx=True):
+        return False
+    queue = Queue('high', connection=sentinel.master)
+    queue.enqueue_call(func=rebuild, args=(project_id,),
+                       timeout=BUILD_TIMEOUT)
+    return True
+
+
+def mark_as_stale(project_id):
+    """Rebuild the table of a project, if it has one, as it is outdated.
+
+    If a rebuild is already running, it will run again once finished.
+    """
+    if not exists(project_id):
+        return False
+    sentinel.master.set(STALE_KEY % project_id, 1)
+    return enqueue_rebuild(project_id)
+
+
+def rebuild(project_id):
+    """Rebuild the alias table of the open tasks of a project."""
+    from sqlalchemy.sql import text
+    from pybossa.core import db
+    sentinel.master.set(BUILDING_KEY % project_id, 1, ex=BUILD_TIMEOUT)
+    sentinel.master.delete(STALE_KEY % project_id)
+    sql = text('''SELECT id, priority_0 FROM task
+               WHERE project_id=:project_id AND state !='completed'
+               ORDER BY id;''')
+    rows = db.slave_session.execute(sql, dict(project_id=project_id))
+    task_ids = []
+    weights = []
+    for row in rows:
+        task_ids.append(row.id)
+        weights.append(max(row.priority_0 or 0, MIN_WEIGHT))
+    probabilities, aliases = build_alias_table(weights)
+    tmp_key = TMP_TABLE_KEY % project_id
+    pipeline = sentinel.master.pipeline()
+    pipeline.delete(tmp_key)
+    pipeline.hset(tmp_key, 'n', len(task_ids))
+    for i, task_id in enumerate(task_ids):
+        pipeline.hmset(tmp_key, {'p:%s' % i: repr(probabilities[i]),
+                                 't:%s' % i: task_id,
+                                 'a:%s' % i: task_ids[aliases[i]]})
+        if (i + 1) % CHUNK_SIZE == 0:
+            pipeline.execute()
+    pipeline.rename(tmp_key, TABLE_KEY % project_id)
+    pipeline.delete(BUILDING_KEY % project_id)
+    pipeline.execute()
+    if sentinel.master.get(STALE_KEY % project_id):
+        enqueue_rebuild(project_id)
+    return len(task_ids)
+
+
+def sample_task_ids(project_id, n_draws=10):
+    """Draw n_draws task ids, with replacement, weighted by priority.
+
+    Returns None if the project has no alias table yet, and an empty list
+    if the project has no open tasks.
+    """
+    key = TABLE_KEY % project_id
+    n = sentinel.master.hget(key, 'n')
+    if n is None:
+        return None
+    n = int(n)
+    if n == 0:
+        return []
+    pipeline = sentinel.master.pipeline()
+    for _ in range(n_draws):
+        i = random.randrange(n)
+        pipeline.hmget(key, 'p:%s' % i, 't:%s' % i, 'a:%s' % i)
+    task_ids = []
+    for probability, task_id, alias in pipeline.execute():
+        if task_id is None:  # pragma: no cover
+            continue  # The table was replaced while sampling
+        if random.random() < float(probability):
+            task_ids.append(int(task_id))
+        else:
+            task_ids.append(int(alias))
+    return task_ids
@@ -358,25 +358,32 @@ def get_port():
         return current_app.config['PORT']
 
 
-def get_user_id_or_ip():
-    """Return the id of the current user if is authenticated.
-    Otherwise returns its IP address (defaults to 127.0.0.1).
+def get_user_ip():
+    """Return the IP address of the current user.
+
+    It is the address given by the remote_mobile_addr header (only for
+    anonymous users) or the last one of the X-Forwarded-For header if they
+    are set, or the remote address of anonymous users (defaults to
+    127.0.0.1).
     """
-    user_id = current_user.id if current_user.is_authenticated() else None
     user_ip = request.remote_addr or "127.0.0.1" \
         if current_user.is_anonymous() else None
-
-    if request.headers.get('remote_mobile_addr') is not None :
-            user_ip = request.headers.get('remote_mobile_addr') if current_user.is_anonymous() else None
-    else:
-            if request.headers.getlist("X-Forwarded-For"):
-                user_ip = request.headers.getlist("X-Forwarded-For")[0]
+    if request.headers.get('remote_mobile_addr') is not None:
+        user_ip = request.headers.get('remote_mobile_addr') \
+            if current_user.is_anonymous() else None
+    elif request.headers.getlist("X-Forwarded-For"):
+        user_ip = request.headers.getlist("X-Forwarded-For")[0]
+    if user_ip and ',' in user_ip:
+        user_ip = user_ip.split(",")[-1]
+    return user_ip
 
 
-    if ',' in user_ip:
-            ips = user_ip.split(",")
-            for ip in ips:
-                user_ip = ip
+def get_user_id_or_ip():
+    """Return the id of the current user if is authenticated.
+    Otherwise returns its IP address (defaults to 127.0.0.1).
+    """
+    user_id = current_user.id if current_user.is_authenticated() else None
+    user_ip = get_user_ip()
 
     print "get_user_id_or_ip : userid %s." % user_id
     print "get_user_id_or_ip : user_ip %s." % user_ip
@@ -385,22 +392,15 @@ def get_user_id_or_ip():
 
 
 def with_cache_disabled(f):
-    """Decorator that disables the cache for the execution of a function.
-    It enables it back when the function call is done.
+    """Decorator that refreshes the cache during the execution of a function:
+    the cached functions it calls compute their values and store them.
+    Only the current thread is affected.
     """
-    import os
-
     @wraps(f)
     def wrapper(*args, **kwargs):
-        env_cache_disabled = os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED')
-        if env_cache_disabled is None or env_cache_disabled is '0':
-            os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = '1'
-        return_value = f(*args, **kwargs)
-        if env_cache_disabled is None:
-            del os.environ['PYBOSSA_REDIS_CACHE_DISABLED']
-        else:
-            os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = env_cache_disabled
-        return return_value
+        from pybossa.cache import refreshing
+        with refreshing():
+            return f(*args, **kwargs)
     return wrapper
 
 
@@ -35,6 +35,7 @@ from pybossa.model.category import Category
 from pybossa.util import admin_required, UnicodeWriter
 from pybossa.cache import projects as cached_projects
 from pybossa.cache import categories as cached_cat
+from pybossa.cache import metrics, cached_functions, local_cache, warm
 from pybossa.auth import ensure_authorized_to
 from pybossa.core import project_repo, user_repo, sentinel
 from pybossa.feed import get_update_feed
@@ -403,3 +404,23 @@ def dashboard():
     except Exception as e:  # pragma: no cover
         current_app.logger.error(e)
         return abort(500)
+
+
+@blueprint.route('/cache')
+@login_required
+@admin_required
+def cache_metrics():
+    """Show the metrics of the cached functions, as JSON with format=json."""
+    functions = metrics.get_all(sentinel.master)
+    for function in functions:
+        cached = cached_functions.get(function['name'])
+        function['timeout'] = cached.timeout if cached else None
+    warm_report = warm.last_report()
+    if request.args.get('format') == 'json':
+        data = dict(functions=functions, local_cache=local_cache.stats(),
+                    warm=warm_report)
+        return Response(json.dumps(data), mimetype='application/json')
+    return render_template('admin/cache.html', title=gettext('Cache'),
+                           functions=functions,
+                           local_cache=local_cache.stats(),
+                           warm_report=warm_report)
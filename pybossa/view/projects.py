@@ -77,6 +77,7 @@ def project_title(project, page_name):
 def project_by_shortname(short_name):
     project = cached_projects.get_project(short_name)
     if project:
+        cached_projects.accessed(project.id)
         # Get owner
         owner = user_repo.get(project.owner_id)
         # Populate CACHE with the data of the project
@@ -1253,6 +1254,8 @@ def task_scheduler(short_name):
                 if project.info['sched'] == s[0]:
                     form.sched.data = s[0]
                     break
+        form.sched_lease.data = project.info.get('sched_lease')
+        form.calibration_frac.data = project.calibration_frac
         return respond()
 
     if request.method == 'POST' and form.validate():
@@ -1263,6 +1266,11 @@ def task_scheduler(short_name):
             old_sched = 'default'
         if form.sched.data:
             project.info['sched'] = form.sched.data
+        if form.sched_lease.data:
+            project.info['sched_lease'] = form.sched_lease.data
+        else:
+            project.info.pop('sched_lease', None)
+        project.calibration_frac = float(form.calibration_frac.data or 0)
         project_repo.save(project)
         # Log it
         if old_sched != project.info['sched']:
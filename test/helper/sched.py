@@ -17,6 +17,7 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 from helper import web
 from default import model, db
+import pybossa.answered_tasks as answered_tasks
 
 
 class Helper(web.Helper):
@@ -47,8 +48,10 @@ class Helper(web.Helper):
         """Deletes all TaskRuns for a given project_id"""
         db.session.query(model.task_run.TaskRun).filter_by(project_id=project_id).delete()
         db.session.commit()
+        # Bulk deletes skip the ORM events that maintain the answered index
+        answered_tasks.invalidate(project_id)
         # Update task.state
         db.session.query(model.task.Task).filter_by(project_id=project_id)\
-                  .update({"state": "ongoing"})
+                  .update({"state": "ongoing", "n_task_runs": 0})
         db.session.commit()
         db.session.remove()
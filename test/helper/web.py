@@ -22,6 +22,7 @@ from default import Test, db, Fixtures, with_context
 from pybossa.model.category import Category
 from pybossa.model.task import Task
 from pybossa.model.task_run import TaskRun
+import pybossa.answered_tasks as answered_tasks
 
 
 class Helper(Test):
@@ -127,7 +128,11 @@ class Helper(Test):
     def delete_task_runs(self, project_id=1):
         """Deletes all TaskRuns for a given project_id"""
         db.session.query(TaskRun).filter_by(project_id=1).delete()
+        db.session.query(Task).filter_by(project_id=1)\
+                  .update({"n_task_runs": 0})
         db.session.commit()
+        # Bulk deletes skip the ORM events that maintain the answered index
+        answered_tasks.invalidate(1)
 
     def task_settings_scheduler(self, method="POST", short_name='sampleapp',
                                 sched="default"):
@@ -769,3 +769,27 @@ class TestAdmin(web.Helper):
         assert "No data" not in res.data, res.data
         assert "New Users" in res.data, res.data
         assert mock.enqueue.called
+
+    @with_context
+    def test_admin_cache_metrics_auth_user(self):
+        """Test ADMIN cache metrics require admin"""
+        url = '/admin/cache'
+        self.register()
+        self.signout()
+        self.register(fullname="juan", name="juan")
+        res = self.app.get(url, follow_redirects=True)
+        err_msg = "It should return 403"
+        assert res.status_code == 403, err_msg
+
+    @with_context
+    @patch('pybossa.view.admin.metrics')
+    def test_admin_cache_metrics_json(self, metrics):
+        """Test ADMIN cache metrics are returned as JSON with format=json"""
+        metrics.get_all.return_value = [dict(name='n_tasks', hits=3)]
+        self.register()
+        res = self.app.get('/admin/cache?format=json', follow_redirects=True)
+        data = json.loads(res.data)
+
+        assert data['functions'][0]['name'] == 'n_tasks', data
+        assert data['functions'][0]['timeout'] is not None, data
+        assert 'local_cache' in data, data
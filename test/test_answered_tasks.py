@@ -0,0 +1,164 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from default import Test, db, with_context
+from factories import (ProjectFactory, TaskFactory, TaskRunFactory,
+                       AnonymousTaskRunFactory, UserFactory)
+from pybossa.core import task_repo, project_repo, sentinel
+from pybossa.cache.helpers import n_available_tasks
+import pybossa.answered_tasks as answered_tasks
+import pybossa.sched as sched
+
+
+class TestAnsweredTasks(Test):
+
+    @with_context
+    def test_new_projects_are_ready(self):
+        """Test ANSWERED_TASKS index is ready for new projects"""
+        project = ProjectFactory.create()
+
+        assert answered_tasks.is_ready(project.id)
+        assert answered_tasks.get(project.id, user_id=1) == set()
+
+    @with_context
+    def test_get_returns_none_if_not_ready(self):
+        """Test ANSWERED_TASKS get returns None when the index is not ready"""
+        project = ProjectFactory.create()
+        answered_tasks.invalidate(project.id)
+
+        assert answered_tasks.get(project.id, user_id=1) is None
+
+    @with_context
+    def test_task_runs_are_indexed(self):
+        """Test ANSWERED_TASKS task run inserts and deletes update the index"""
+        project = ProjectFactory.create()
+        user = UserFactory.create()
+        task = TaskFactory.create(project=project)
+        taskrun = TaskRunFactory.create(task=task, user=user)
+        AnonymousTaskRunFactory.create(task=task, user_ip='10.0.0.1')
+
+        assert answered_tasks.get(project.id, user_id=user.id) == set([task.id])
+        assert answered_tasks.get(project.id, user_ip='10.0.0.1') == set([task.id])
+
+        task_repo.delete(taskrun)
+        assert answered_tasks.get(project.id, user_id=user.id) == set()
+
+    @with_context
+    def test_is_answered(self):
+        """Test ANSWERED_TASKS is_answered checks a single task"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(2, project=project)
+        AnonymousTaskRunFactory.create(task=tasks[0], user_ip='10.0.0.1')
+
+        assert answered_tasks.is_answered(project.id, tasks[0].id,
+                                          user_ip='10.0.0.1') is True
+        assert answered_tasks.is_answered(project.id, tasks[1].id,
+                                          user_ip='10.0.0.1') is False
+        answered_tasks.invalidate(project.id)
+        assert answered_tasks.is_answered(project.id, tasks[0].id,
+                                          user_ip='10.0.0.1') is None
+
+    @with_context
+    def test_rebuild(self):
+        """Test ANSWERED_TASKS rebuild indexes existing task runs"""
+        project = ProjectFactory.create()
+        user = UserFactory.create()
+        tasks = TaskFactory.create_batch(2, project=project)
+        TaskRunFactory.create(task=tasks[0], user=user)
+        answered_tasks.invalidate(project.id)
+        self.redis_flushall()
+
+        n_task_runs = answered_tasks.rebuild(project.id)
+
+        assert n_task_runs == 1, n_task_runs
+        assert answered_tasks.get(project.id, user_id=user.id) == set([tasks[0].id])
+
+    @with_context
+    def test_rebuild_drops_deleted_answers(self):
+        """Test ANSWERED_TASKS rebuild drops the answers no longer in the DB"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+        AnonymousTaskRunFactory.create(task=task, user_ip='10.0.0.1')
+        answered_tasks.add(project.id, 12345, user_ip='10.0.0.1')
+        answered_tasks.add(project.id, 12345, user_id=42)
+
+        answered_tasks.rebuild(project.id)
+
+        assert answered_tasks.get(project.id, user_ip='10.0.0.1') == set([task.id])
+        assert answered_tasks.get(project.id, user_id=42) == set()
+        assert sentinel.master.keys('*%s' % answered_tasks.TMP_SUFFIX) == []
+
+    @with_context
+    def test_project_delete_drops_the_index(self):
+        """Test ANSWERED_TASKS the index of a deleted project is dropped"""
+        project = ProjectFactory.create()
+        answered_tasks.add(project.id, 1, user_id=42)
+
+        project_repo.delete(project)
+
+        pattern = answered_tasks.ANSWERED_KEY % (project.id, '*')
+        assert sentinel.master.keys(pattern) == []
+
+
+class TestSchedWithAnsweredTasks(Test):
+
+    @with_context
+    def test_depth_first_filters_answered_tasks_in_memory(self):
+        """Test SCHED depth first skips the tasks in the answered index"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project)
+        answered_tasks.add(project.id, tasks[0].id, user_id=42)
+
+        out = sched.get_depth_first_task(project.id, user_id=42)
+
+        assert out.id == tasks[1].id, out
+
+    @with_context
+    def test_breadth_first_filters_answered_tasks_in_memory(self):
+        """Test SCHED breadth first skips the tasks in the answered index"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project)
+        answered_tasks.add(project.id, tasks[0].id, user_ip='10.0.0.1')
+
+        out = sched.get_breadth_first_task(project.id, user_ip='10.0.0.1')
+
+        assert out.id == tasks[1].id, out
+
+    @with_context
+    def test_n_available_tasks_uses_index(self):
+        """Test n_available_tasks discounts the tasks in the answered index"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project)
+        answered_tasks.add(project.id, tasks[0].id, user_id=42)
+
+        assert n_available_tasks(project.id, user_id=42) == 2
+
+    @with_context
+    @patch('pybossa.cache.helpers.MAX_ANSWERED_IN_QUERY', 0)
+    @patch('pybossa.cache.helpers._n_available_tasks_from_index')
+    def test_n_available_tasks_uses_sql_for_large_indexes(self, from_index):
+        """Test n_available_tasks does not send large answered sets to the
+        DB"""
+        project = ProjectFactory.create()
+        user = UserFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project)
+        TaskRunFactory.create(task=tasks[0], user=user)
+
+        assert n_available_tasks(project.id, user_id=user.id) == 2
+        assert not from_index.called
@@ -18,6 +18,7 @@
 import json
 from mock import patch, call
 from default import db, with_context
+from pybossa.core import sentinel
 from nose.tools import assert_equal, assert_raises
 from test_api import TestAPI
 
@@ -462,10 +463,10 @@ class TestProjectAPI(TestAPI):
         """Test API userprogress as anonymous works"""
         user = UserFactory.create()
         project = ProjectFactory.create(owner=user)
-        tasks = TaskFactory.create_batch(2, project=project)
+        tasks = TaskFactory.create_batch(3, project=project)
         taskruns = []
-        for task in tasks:
-            taskruns.extend(AnonymousTaskRunFactory.create_batch(2, task=task))
+        for task in tasks[:2]:
+            taskruns.append(AnonymousTaskRunFactory.create(task=task))
 
         res = self.app.get('/api/project/1/userprogress', follow_redirects=True)
         data = json.loads(res.data)
@@ -477,7 +478,7 @@ class TestProjectAPI(TestAPI):
         assert len(taskruns) == data['done'], data
 
         # Add a new TaskRun and check again
-        taskrun = AnonymousTaskRunFactory.create(task=tasks[0], info={'answer': u'hello'})
+        taskrun = AnonymousTaskRunFactory.create(task=tasks[2], info={'answer': u'hello'})
 
         res = self.app.get('/api/project/1/userprogress', follow_redirects=True)
         data = json.loads(res.data)
@@ -495,7 +496,7 @@ class TestProjectAPI(TestAPI):
         tasks = TaskFactory.create_batch(2, project=project)
         taskruns = []
         for task in tasks:
-            taskruns.extend(TaskRunFactory.create_batch(2, task=task, user=user))
+            taskruns.append(TaskRunFactory.create(task=task, user=user))
 
         url = '/api/project/1/userprogress?api_key=%s' % user.api_key
         res = self.app.get(url, follow_redirects=True)
@@ -647,6 +648,45 @@ class TestProjectAPI(TestAPI):
         assert res.data == '{}', res.data
 
 
+    @with_context
+    def test_newtasks(self):
+        """Test API project new_tasks returns limit distinct tasks and marks
+        all of them as requested"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project)
+
+        res = self.app.get('/api/project/%s/newtasks?limit=2' % project.id)
+        data = json.loads(res.data)
+
+        assert res.mimetype == 'application/json', res
+        assert [t['id'] for t in data] == [tasks[0].id, tasks[1].id], data
+        for task in tasks[:2]:
+            key = 'pybossa:task_requested:user:127.0.0.1:task:%s' % task.id
+            assert sentinel.master.get(key), key
+
+        # Get an empty list
+        url = '/api/project/%s/newtasks?limit=2&offset=1000' % project.id
+        res = self.app.get(url)
+        assert json.loads(res.data) == [], res.data
+
+
+    @with_context
+    def test_newtask_does_not_expose_gold_answer(self):
+        """Test API project newtask and newtasks do not return the gold answer
+        of calibration tasks"""
+        project = ProjectFactory.create()
+        TaskFactory.create(project=project, calibration=1,
+                           info={'question': 'q', 'gold_answer': 'yes'})
+
+        res = self.app.get('/api/project/%s/newtask' % project.id)
+        task = json.loads(res.data)
+        assert task['info'] == {'question': 'q'}, task
+
+        res = self.app.get('/api/project/%s/newtasks?limit=2' % project.id)
+        tasks = json.loads(res.data)
+        assert [t['info'] for t in tasks] == [{'question': 'q'}], tasks
+
+
     @patch('pybossa.repositories.project_repository.uploader')
     def test_project_delete_deletes_zip_files(self, uploader):
         """Test API project delete deletes also zip files of tasks and taskruns"""
@@ -45,6 +45,23 @@ class TestTaskAPI(TestAPI):
         assert res.mimetype == 'application/json', res
 
 
+    @with_context
+    def test_task_query_hides_gold_answer_from_non_owners(self):
+        """Test API Task query only returns the gold answer of calibration
+        tasks to the project owner"""
+        owner = UserFactory.create()
+        project = ProjectFactory.create(owner=owner)
+        TaskFactory.create(project=project, calibration=1,
+                           info={'question': 'q', 'gold_answer': 'yes'})
+
+        tasks = json.loads(self.app.get('/api/task').data)
+        assert tasks[0]['info'] == {'question': 'q'}, tasks
+
+        res = self.app.get('/api/task?api_key=%s' % owner.api_key)
+        tasks = json.loads(res.data)
+        assert tasks[0]['info']['gold_answer'] == 'yes', tasks
+
+
     @with_context
     def test_task_query_with_params(self):
         """Test API query for task with params works"""
@@ -16,12 +16,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 import json
-from default import with_context
+from default import db, with_context
 from nose.tools import assert_equal
 from test_api import TestAPI
 from mock import patch
 from factories import (ProjectFactory, TaskFactory, TaskRunFactory,
                         AnonymousTaskRunFactory, UserFactory)
+from pybossa.core import task_repo
+import pybossa.answered_tasks as answered_tasks
 
 
 
@@ -196,6 +198,30 @@ class TestTaskrunAPI(TestAPI):
         assert tmp.status_code == 403, tmp.data
 
 
+    @with_context
+    @patch('pybossa.api.task_run._check_task_requested_by_user')
+    def test_taskrun_repeated_post_is_forbidden_by_the_db(self, requested):
+        """Test API TaskRun repeated answers missed by the answered index
+        are still forbidden"""
+        requested.return_value = True
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+        url = '/api/taskrun?api_key=%s' % project.owner.api_key
+        datajson = json.dumps(dict(project_id=project.id, task_id=task.id,
+                                   info='my task result'))
+        headers = {'X-Forwarded-For': '10.0.0.1'}
+        tmp = self.app.post(url, data=datajson, headers=headers)
+        assert tmp.status_code == 200, tmp.data
+        answered_tasks.invalidate(project.id)
+
+        tmp = self.app.post(url, data=datajson, headers=headers)
+
+        err = json.loads(tmp.data)
+        assert tmp.status_code == 403, tmp.data
+        assert err['exception_cls'] == 'Forbidden', err
+        assert task_repo.count_task_runs_with(task_id=task.id) == 1
+
+
     def test_taskrun_post_requires_newtask_first_anonymous(self):
         """Test API TaskRun post fails if task was not previously requested for
         anonymous user"""
@@ -475,3 +501,91 @@ class TestTaskrunAPI(TestAPI):
         assert resp.status_code == 400, resp.status_code
         error = json.loads(resp.data)
         assert error['exception_msg'] == "Reserved keys in payload", error
+
+    @with_context
+    def test_taskrun_bulk_post(self):
+        """Test API TaskRun bulk creation returns the status of every item"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(2, project=project, n_answers=1)
+        not_requested = TaskFactory.create(project=project)
+        self.app.get('/api/project/%s/newtasks?limit=2' % project.id)
+        data = [dict(project_id=project.id, task_id=tasks[0].id, info='a'),
+                dict(project_id=project.id, task_id=tasks[1].id, info='b'),
+                dict(project_id=project.id, task_id=tasks[0].id, info='c'),
+                dict(project_id=project.id, task_id=not_requested.id),
+                dict(project_id=project.id, task_id=tasks[1].id, id=1)]
+
+        res = self.app.post('/api/taskrun/bulk', data=json.dumps(data))
+        statuses = json.loads(res.data)
+
+        assert res.status_code == 200, res.data
+        assert [s['status'] for s in statuses] == ['ok', 'ok', 'failed',
+                                                   'failed', 'failed']
+        assert [s['status_code'] for s in statuses[2:]] == [403, 403, 400]
+        for task in tasks:
+            db.session.refresh(task)
+            assert task.n_task_runs == 1, task.n_task_runs
+            assert task.state == 'completed', task.state
+
+    @with_context
+    @patch('pybossa.api.task_run.task_repo.get_answered_task_ids')
+    def test_taskrun_bulk_post_concurrent_answer(self, get_answered_task_ids):
+        """Test API TaskRun bulk creation only fails the items answered
+        concurrently"""
+        get_answered_task_ids.return_value = set()
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(2, project=project)
+        self.app.get('/api/project/%s/newtasks?limit=2' % project.id)
+        AnonymousTaskRunFactory.create(task=tasks[0], user_ip='127.0.0.1')
+        data = [dict(project_id=project.id, task_id=task.id, info='a')
+                for task in tasks]
+
+        res = self.app.post('/api/taskrun/bulk', data=json.dumps(data))
+        statuses = json.loads(res.data)
+
+        assert res.status_code == 200, res.data
+        assert [s['status'] for s in statuses] == ['failed', 'ok'], statuses
+        assert statuses[0]['status_code'] == 403, statuses
+        db.session.refresh(tasks[1])
+        assert tasks[1].n_task_runs == 1, tasks[1].n_task_runs
+
+    @with_context
+    def test_taskrun_bulk_post_forwarded_ip(self):
+        """Test API TaskRun bulk creation records the forwarded IP, as the
+        single task run creation does"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+        headers = {'X-Forwarded-For': '10.0.0.1'}
+        self.app.get('/api/project/%s/newtask' % project.id, headers=headers)
+        data = [dict(project_id=project.id, task_id=task.id, info='a')]
+
+        res = self.app.post('/api/taskrun/bulk', data=json.dumps(data),
+                            headers=headers)
+
+        assert json.loads(res.data)[0]['status'] == 'ok', res.data
+        task_run = task_repo.filter_task_runs_by(task_id=task.id)[0]
+        assert task_run.user_ip == '10.0.0.1', task_run.user_ip
+
+    @with_context
+    def test_taskrun_bulk_post_invalid_value(self):
+        """Test API TaskRun bulk creation only fails the items rejected by
+        the DB"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(2, project=project)
+        self.app.get('/api/project/%s/newtasks?limit=2' % project.id)
+        data = [dict(project_id=project.id, task_id=tasks[0].id, info='a',
+                     timeout='never'),
+                dict(project_id=project.id, task_id=tasks[1].id, info='b')]
+
+        res = self.app.post('/api/taskrun/bulk', data=json.dumps(data))
+        statuses = json.loads(res.data)
+
+        assert res.status_code == 200, res.data
+        assert [s['status'] for s in statuses] == ['failed', 'ok'], statuses
+
+    @with_context
+    def test_taskrun_bulk_post_requires_a_list(self):
+        """Test API TaskRun bulk creation only accepts lists"""
+        res = self.app.post('/api/taskrun/bulk', data=json.dumps({}))
+
+        assert res.status_code == 400, res.status_code
@@ -17,9 +17,11 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 
 import hashlib
+import cPickle as pickle
 from mock import patch
 from pybossa.cache import (get_key_to_hash, get_hash_key, cache, memoize,
-                           delete_cached, delete_memoized)
+                           delete_cached, delete_memoized, delete_tagged,
+                           refreshing, _encode, _decode)
 from pybossa.sentinel import Sentinel
 from settings_test import REDIS_SENTINEL, REDIS_KEYPREFIX
 
@@ -69,25 +71,16 @@ class FakeApp(object):
 
 test_sentinel = Sentinel(app=FakeApp())
 
+
+def memoized_keys():
+    """Return the keys of the memoized values (but not of their tags)."""
+    return test_sentinel.master.keys('%s:*_args:*' % REDIS_KEYPREFIX)
+
+# Enable the cache for tests within this class
+@patch('pybossa.cache.disabled', new=False)
 @patch('pybossa.cache.sentinel', new=test_sentinel)
 class TestCacheMemoizeFunctions(object):
 
-    @classmethod
-    def setup_class(cls):
-        # Enable the cache for tests within this class
-        import os
-        cls.cache = None
-        if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED'):
-            cls.cache = os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED')
-            del os.environ['PYBOSSA_REDIS_CACHE_DISABLED']
-
-    @classmethod
-    def teardown_class(cls):
-        # Restore the environment variables to its previous state
-        if cls.cache:
-            import os
-            os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = cls.cache
-
     def setUp(self):
         test_sentinel.master.flushall()
 
@@ -246,11 +239,11 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(memoized_keys()) == 1
 
         delete_succedeed = delete_memoized(my_func, 'arg', kwarg='kwarg')
         assert delete_succedeed is True, delete_succedeed
-        assert test_sentinel.master.keys() == [], 'Key was not deleted!'
+        assert memoized_keys() == [], 'Key was not deleted!'
 
 
     def test_delete_memoized_returns_false_when_delete_fails(self):
@@ -260,11 +253,11 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(memoized_keys()) == 1
 
         delete_succedeed = delete_memoized(my_func, 'badarg', kwarg='barkwarg')
         assert delete_succedeed is False, delete_succedeed
-        assert len(test_sentinel.master.keys()) == 1, 'Key was unexpectedly deleted'
+        assert len(memoized_keys()) == 1, 'Key was unexpectedly deleted'
 
 
     def test_delete_memoized_deletes_only_requested(self):
@@ -276,11 +269,11 @@ class TestCacheMemoizeFunctions(object):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='other')
-        assert len(test_sentinel.master.keys()) == 2
+        assert len(memoized_keys()) == 2
 
         delete_succedeed = delete_memoized(my_func, 'arg', kwarg='kwarg')
         assert delete_succedeed is True, delete_succedeed
-        assert len(test_sentinel.master.keys()) == 1, 'Everything was deleted!'
+        assert len(memoized_keys()) == 1, 'Everything was deleted!'
 
 
     def test_delete_memoized_deletes_all_function_calls(self):
@@ -296,8 +289,207 @@ class TestCacheMemoizeFunctions(object):
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='other')
         my_other_func('arg', kwarg='kwarg')
-        assert len(test_sentinel.master.keys()) == 3
+        assert len(memoized_keys()) == 3
 
         delete_succedeed = delete_memoized(my_func)
         assert delete_succedeed is True, delete_succedeed
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(memoized_keys()) == 1
+
+
+    def test_delete_memoized_does_not_scan_the_keys(self):
+        """Test CACHE delete_memoized deletes the function values from its
+        tag, without a KEYS command"""
+
+        @memoize()
+        def my_func(*args, **kwargs):
+            return [args, kwargs]
+        my_func('arg')
+        my_func('other')
+
+        with patch.object(test_sentinel.slave, 'keys') as keys:
+            delete_succedeed = delete_memoized(my_func)
+
+        assert delete_succedeed is True, delete_succedeed
+        assert not keys.called
+        assert memoized_keys() == [], memoized_keys()
+
+
+    def test_delete_tagged_deletes_only_the_tagged_values(self):
+        """Test CACHE delete_tagged deletes the values with a given tag of
+        every function"""
+
+        @memoize(tag=lambda project_id: 'project:%s' % project_id)
+        def my_func(project_id):
+            return project_id
+        @memoize(tag=lambda project_id: 'project:%s' % project_id)
+        def my_other_func(project_id):
+            return project_id
+        my_func(1)
+        my_other_func(1)
+        my_func(2)
+
+        delete_succedeed = delete_tagged('project:1')
+
+        assert delete_succedeed is True, delete_succedeed
+        assert len(memoized_keys()) == 1, memoized_keys()
+        assert delete_tagged('project:1') is False
+
+
+    def test_expensive_cache_stores_the_computation_time(self):
+        """Test CACHE expensive values are stored with the time they took to
+        compute"""
+
+        @cache(key_prefix='my_cached_func', expensive=True)
+        def my_func(call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+        key = "%s::%s" % (REDIS_KEYPREFIX, 'my_cached_func')
+
+        assert my_func() == 1
+        assert my_func() == 1
+        output, delta = _decode(test_sentinel.master.get(key))
+        assert output == 1 and delta is not None, delta
+
+
+    def test_expensive_cache_waits_for_the_lock_holder(self):
+        """Test CACHE expensive values are not computed by a caller while
+        another one is computing them"""
+
+        @cache(key_prefix='my_cached_func', expensive=True)
+        def my_func():
+            return 'computed here'
+        key = "%s::%s" % (REDIS_KEYPREFIX, 'my_cached_func')
+        test_sentinel.master.set(key + ':lock', 'other')
+
+        def computed_elsewhere(seconds):
+            test_sentinel.master.setex(key, 60, _encode('elsewhere'))
+
+        with patch('pybossa.cache.time.sleep', side_effect=computed_elsewhere):
+            assert my_func() == 'elsewhere'
+
+
+    @patch('pybossa.cache._refresh_early', return_value=True)
+    def test_expensive_cache_refreshes_early_once(self, refresh_early):
+        """Test CACHE expensive values are refreshed before they expire, but
+        not while somebody else is refreshing them"""
+
+        @memoize(expensive=True)
+        def my_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+
+        assert my_func('arg') == 1
+        assert my_func('arg') == 2
+        key = memoized_keys()[0]
+        test_sentinel.master.set(key + ':lock', 'other')
+        assert my_func('arg') == 2
+
+
+    @patch('rq.Queue')
+    def test_stale_values_are_served_while_refreshed_once(self, Queue):
+        """Test CACHE stale values are returned while a single job refreshes
+        them"""
+
+        @memoize(timeout=300, stale_ttl=60)
+        def my_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+
+        assert my_func('arg') == 1
+        key = memoized_keys()[0]
+        assert test_sentinel.master.ttl(key) > 300
+        test_sentinel.master.expire(key, 30)
+
+        assert my_func('arg') == 1
+        assert my_func('arg') == 1
+        assert Queue.return_value.enqueue_call.call_count == 1
+
+
+    def test_refresh_recomputes_the_cached_value(self):
+        """Test CACHE refresh recomputes and stores the value"""
+
+        @memoize(stale_ttl=60)
+        def my_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+
+        assert my_func('arg') == 1
+        assert my_func.refresh('arg') == 2
+        assert my_func('arg') == 2
+
+
+    def test_falsy_values_are_cached(self):
+        """Test CACHE falsy values are returned from the cache too"""
+
+        calls = []
+        @memoize()
+        def my_func(arg):
+            calls.append(arg)
+            return None
+
+        for value in range(3):
+            assert my_func('arg') is None
+        assert len(calls) == 1, calls
+
+
+    def test_values_of_other_versions_are_ignored(self):
+        """Test CACHE values cached by another version of the code, or before
+        there was an envelope, are not returned"""
+
+        @cache(key_prefix='my_cached_func')
+        def my_func():
+            return 'current'
+        key = "%s::%s" % (REDIS_KEYPREFIX, 'my_cached_func')
+
+        test_sentinel.master.setex(key, 60, pickle.dumps('raw'))
+        assert my_func() == 'current'
+        with patch('pybossa.cache.CACHE_VERSION', 'other'):
+            test_sentinel.master.setex(key, 60, _encode('other'))
+        assert my_func() == 'current'
+
+
+    def test_large_values_are_compressed(self):
+        """Test CACHE large values of compressed functions are stored
+        compressed"""
+
+        @cache(key_prefix='my_cached_func', compress=True)
+        def my_func():
+            return ['task'] * 1000
+        key = "%s::%s" % (REDIS_KEYPREFIX, 'my_cached_func')
+
+        assert my_func() == ['task'] * 1000
+        assert len(test_sentinel.master.get(key)) < 1000
+        assert my_func() == ['task'] * 1000
+
+
+    def test_get_many_reads_cached_values_and_computes_the_missing(self):
+        """Test CACHE get_many returns the cached values and computes the
+        missing ones at once"""
+        calls = []
+        def my_func_many(args_list):
+            calls.append(args_list)
+            return [arg * 2 for arg, in args_list]
+
+        @memoize(many=my_func_many)
+        def my_func(arg):
+            return arg * 2
+
+        assert my_func(1) == 2
+        assert my_func.get_many([1, 2, 3]) == [2, 4, 6]
+        assert calls == [[(2,), (3,)]], calls
+        assert my_func.get_many([3, 2]) == [6, 4]
+        assert len(calls) == 1, calls
+
+
+    def test_refreshing_recomputes_and_stores_the_values(self):
+        """Test CACHE values are recomputed and stored within refreshing"""
+
+        @memoize()
+        def my_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+
+        assert my_func('arg') == 1
+        with refreshing():
+            assert my_func('arg') == 2
+        assert my_func('arg') == 2
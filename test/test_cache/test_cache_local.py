@@ -0,0 +1,115 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch, MagicMock
+from nose.tools import assert_raises
+from pybossa.cache import memoize, delete_memoized, local_cache
+from pybossa.cache.local import LocalCache, Invalidator
+from test_cache import test_sentinel
+
+
+class TestLocalCache(object):
+
+    def test_get_returns_stored_values(self):
+        """Test CACHE LOCAL get returns the stored values and counts hits and
+        misses"""
+        local_cache = LocalCache(10)
+        local_cache.set('key', 'value', 10)
+
+        assert local_cache.get('key') == 'value'
+        assert local_cache.get('other') is None
+        stats = local_cache.stats()
+        assert stats['hits'] == 1 and stats['misses'] == 1, stats
+
+    @patch('pybossa.cache.local.time')
+    def test_entries_expire(self, time):
+        """Test CACHE LOCAL entries expire after their TTL"""
+        local_cache = LocalCache(10)
+        time.time.return_value = 100
+        local_cache.set('key', 'value', 10)
+
+        time.time.return_value = 110
+        assert local_cache.get('key') is None
+
+    def test_least_recently_used_entries_are_evicted(self):
+        """Test CACHE LOCAL evicts the least recently used entry when full"""
+        local_cache = LocalCache(2)
+        local_cache.set('a', 1, 10)
+        local_cache.set('b', 2, 10)
+        local_cache.get('a')
+        local_cache.set('c', 3, 10)
+
+        assert local_cache.get('b') is None
+        assert local_cache.get('a') == 1
+        assert local_cache.stats()['evictions'] == 1
+
+    def test_invalidator_handles_keys_and_prefixes(self):
+        """Test CACHE LOCAL published keys and prefixes are dropped"""
+        local_cache = LocalCache(10)
+        invalidator = Invalidator(local_cache, 'channel')
+        for key in ('f:1', 'f:2', 'g:1'):
+            local_cache.set(key, key, 10)
+
+        invalidator.handle('g:1')
+        invalidator.handle('f:*')
+
+        assert local_cache.stats()['size'] == 0
+
+    @patch('pybossa.cache.local.time.sleep', side_effect=KeyboardInterrupt)
+    @patch('pybossa.cache.local.log')
+    def test_invalidator_logs_listener_errors(self, log, sleep):
+        """Test CACHE LOCAL listener errors are logged before retrying"""
+        local_cache = LocalCache(10)
+        local_cache.set('a', 1, 10)
+        invalidator = Invalidator(local_cache, 'channel')
+        redis = MagicMock()
+        redis.pubsub.side_effect = ValueError('connection lost')
+
+        assert_raises(KeyboardInterrupt, invalidator._listen, redis)
+
+        assert log.exception.called
+        assert local_cache.stats()['size'] == 0
+
+
+@patch('pybossa.cache.disabled', new=False)
+@patch('pybossa.cache.sentinel', new=test_sentinel)
+@patch('pybossa.cache.invalidator.ensure_listening')
+class TestMemoizeWithLocalCache(object):
+
+    def setUp(self):
+        test_sentinel.master.flushall()
+        local_cache.clear()
+
+    def tearDown(self):
+        local_cache.clear()
+
+    def test_memoize_reads_the_local_cache_first(self, ensure_listening):
+        """Test CACHE LOCAL memoized values are served from memory and
+        deleted by delete_memoized"""
+        @memoize()
+        def my_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+
+        with patch.object(local_cache, 'max_size', 10):
+            assert my_func('arg') == 1
+            test_sentinel.master.flushall()
+            assert my_func('arg') == 1
+
+            delete_memoized(my_func)
+            assert my_func('arg') == 2
@@ -0,0 +1,95 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from pybossa.cache import memoize, delete_memoized, metrics
+from pybossa.cache.metrics import Metrics
+from test_cache import test_sentinel
+
+
+class TestMetrics(object):
+
+    def setUp(self):
+        test_sentinel.master.flushall()
+
+    def test_counters_are_added_to_redis(self):
+        """Test CACHE METRICS counters of every process are added up"""
+        for i in range(2):
+            process_metrics = Metrics('metrics')
+            process_metrics.hits('f', 3)
+            process_metrics.misses('f')
+            process_metrics.computed('f', 0.5, 100)
+            process_metrics.flush(test_sentinel.master)
+
+        function = Metrics('metrics').get_all(test_sentinel.master)[0]
+
+        assert function['name'] == 'f'
+        assert function['hits'] == 6 and function['misses'] == 2, function
+        assert function['hit_rate'] == 0.75, function
+        assert function['avg_compute_time'] == 500, function
+        assert function['avg_size'] == 100, function
+
+    def test_disabled_metrics_count_nothing(self):
+        """Test CACHE METRICS nothing is counted with a 0 flush interval"""
+        disabled = Metrics('metrics', flush_interval=0)
+        disabled.hits('f')
+        disabled.flush(test_sentinel.master)
+
+        assert disabled.get_all(test_sentinel.master) == []
+
+    def test_accesses_are_ranked_and_decay(self):
+        """Test CACHE METRICS accesses are ranked and halved by decay"""
+        process_metrics = Metrics('metrics')
+        for i in range(4):
+            process_metrics.accessed('project:1')
+        process_metrics.accessed('project:2')
+        process_metrics.flush(test_sentinel.master)
+        process_metrics.decay_accesses(test_sentinel.master)
+
+        most_accessed = process_metrics.most_accessed(test_sentinel.master, 1)
+
+        assert most_accessed == [('project:1', 2.0)], most_accessed
+
+
+@patch('pybossa.cache.disabled', new=False)
+@patch('pybossa.cache.sentinel', new=test_sentinel)
+class TestMemoizeMetrics(object):
+
+    def setUp(self):
+        test_sentinel.master.flushall()
+        metrics.reset(test_sentinel.master)
+
+    def test_memoize_counts_hits_misses_and_invalidations(self):
+        """Test CACHE METRICS memoized functions count their hits, misses and
+        invalidations"""
+        @memoize()
+        def my_metered_func(arg):
+            return arg
+
+        my_metered_func(1)
+        my_metered_func(1)
+        my_metered_func(2)
+        delete_memoized(my_metered_func)
+
+        function = [function for function in
+                    metrics.get_all(test_sentinel.master)
+                    if function['name'] == 'my_metered_func'][0]
+        assert function['hits'] == 1 and function['misses'] == 2, function
+        assert function['computations'] == 2, function
+        assert function['size'] > 0, function
+        assert function['invalidations'] == 2, function
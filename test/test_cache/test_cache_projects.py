@@ -587,6 +587,26 @@ class TestProjectsCache(Test):
         assert activity == last_task_run.finish_time, last_task_run
 
 
+    def test_get_stats_many_returns_the_stats_of_every_project(self):
+        """Test CACHE PROJECTS get_stats_many returns the same stats as the
+        functions for a single project"""
+        project = self.create_project_with_contributors(anonymous=2,
+                                                        registered=3)
+        other_project = self.create_project_with_tasks(completed_tasks=1,
+                                                       ongoing_tasks=3)
+        empty_project = ProjectFactory.create()
+        project_ids = [project.id, other_project.id, empty_project.id]
+        fields = ('n_tasks', 'n_completed_tasks', 'n_volunteers',
+                  'overall_progress', 'last_activity')
+
+        stats = cached_projects.get_stats_many(project_ids, fields)
+
+        for project_id, project_stats in zip(project_ids, stats):
+            for field in fields:
+                expected = getattr(cached_projects, field)(project_id)
+                assert project_stats[field] == expected, (field, project_stats)
+
+
     def test_n_published_counts_projects_with_presenter_tasks_and_not_hidden(self):
         published_project = ProjectFactory.create()
         TaskFactory.create(project=published_project)
@@ -65,7 +65,8 @@ class TestUsersCache(Test):
         users = UserFactory.create_batch(4)
         for user in users:
             i += 1
-            taskruns = TaskRunFactory.create_batch(i, user=user, task=tasks[i-1])
+            for task in tasks[:i]:
+                TaskRunFactory.create(user=user, task=task)
 
         first_in_rank = cached_users.rank_and_score(users[3].id)
         last_in_rank = cached_users.rank_and_score(users[0].id)
@@ -299,7 +300,8 @@ class TestUsersCache(Test):
         tasks = TaskFactory.create_batch(3, project=project)
         i = 3
         for user in [leader, second, third]:
-            TaskRunFactory.create_batch(i, user=user, task=tasks[i-1])
+            for task in tasks[:i]:
+                TaskRunFactory.create(user=user, task=task)
             i -= 1
 
         leaderboard = cached_users.get_leaderboard(3)
@@ -317,7 +319,8 @@ class TestUsersCache(Test):
         tasks = TaskFactory.create_batch(3, project=project)
         i = 3
         for user in [leader, second, third]:
-            TaskRunFactory.create_batch(i, user=user, task=tasks[i-1])
+            for task in tasks[:i]:
+                TaskRunFactory.create(user=user, task=task)
             i -= 1
         user_out_of_top = UserFactory.create()
 
@@ -0,0 +1,110 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from default import Test, with_context
+from pybossa.cache import warm, metrics
+from pybossa.cache.projects import get_project, project_tag
+from factories import (ProjectFactory, TaskFactory, TaskRunFactory,
+                       AnonymousTaskRunFactory)
+from mock import patch, MagicMock
+from test_cache import test_sentinel
+
+
+def _function(timeout=60):
+    function = MagicMock()
+    function.cached.timeout = timeout
+    return function
+
+
+@patch('pybossa.cache.warm.sentinel', new=test_sentinel)
+class TestCacheWarm(Test):
+
+    def setUp(self):
+        super(TestCacheWarm, self).setUp()
+        test_sentinel.master.flushall()
+
+    @with_context
+    def test_get_calls_warms_the_most_accessed_projects_first(self):
+        """Test CACHE WARM the most accessed projects are warmed first"""
+        rare, popular = ProjectFactory.create_batch(2)
+        test_sentinel.master.zincrby(metrics.accesses_key,
+                                     project_tag(rare.id), 1)
+        test_sentinel.master.zincrby(metrics.accesses_key,
+                                     project_tag(popular.id), 5)
+
+        calls = warm.get_calls()
+
+        projects = [args[0] for function, args, kwargs in calls
+                    if function is get_project]
+        assert projects.index(popular.short_name) < \
+            projects.index(rare.short_name), projects
+
+    @with_context
+    def test_projects_counts_the_task_runs_of_their_tasks(self):
+        """Test CACHE WARM projects are counted from task.n_task_runs"""
+        busy, idle = ProjectFactory.create_batch(2)
+        task = TaskFactory.create(project=busy, n_answers=5)
+        TaskRunFactory.create(task=task)
+        AnonymousTaskRunFactory.create(task=task)
+
+        projects = warm._projects([busy.id, idle.id])
+
+        assert projects[busy.id].n_task_runs == 2, projects[busy.id]
+        assert projects[idle.id].n_task_runs == 0, projects[idle.id]
+
+    @with_context
+    @patch('pybossa.cache.warm.ttl_left')
+    @patch('pybossa.cache.warm.get_calls')
+    def test_warm_skips_fresh_calls(self, get_calls, ttl_left):
+        """Test CACHE WARM calls with more than half their timeout left are
+        skipped"""
+        fresh, expiring, missing = _function(), _function(), _function()
+        get_calls.return_value = [(fresh, (1,), {}), (expiring, (2,), {}),
+                                  (missing, (3,), {})]
+        ttl_left.return_value = [50, 10, -1]
+
+        report = warm.warm(enqueue=False)
+
+        assert not fresh.called
+        expiring.assert_called_with(2)
+        missing.assert_called_with(3)
+        assert report['fresh'] == 1 and report['warmed'] == 2, report
+        assert report['pending'] == 0 and report['coverage'] == 1, report
+        assert report['duration'] is not None, report
+
+    @with_context
+    @patch('pybossa.cache.warm.Queue')
+    @patch('pybossa.cache.warm.ttl_left')
+    @patch('pybossa.cache.warm.get_calls')
+    def test_warm_enqueues_chunks(self, get_calls, ttl_left, Queue):
+        """Test CACHE WARM the calls to warm are enqueued in chunks"""
+        function = _function()
+        calls = [(function, (i,), {}) for i in range(warm.CHUNK_SIZE + 1)]
+        get_calls.return_value = calls
+        ttl_left.return_value = [-1] * len(calls)
+
+        report = warm.warm()
+
+        enqueue_call = Queue.return_value.enqueue_call
+        assert enqueue_call.call_count == 2, enqueue_call.call_args_list
+        chunk = enqueue_call.call_args[1]['args'][0]
+        assert chunk == calls[warm.CHUNK_SIZE:], chunk
+        assert not function.called
+        assert report['pending'] == len(calls), report
+        assert report['duration'] is None, report
@@ -0,0 +1,165 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from default import Test, db, with_context
+from factories import ProjectFactory, TaskFactory, TaskRunFactory, UserFactory
+from pybossa.core import task_repo
+import pybossa.calibration as calibration
+import pybossa.sched as sched
+
+
+class TestCalibration(Test):
+
+    @with_context
+    def test_pool_is_maintained(self):
+        """Test CALIBRATION pool has the calibration tasks of the project"""
+        project = ProjectFactory.create()
+        gold = TaskFactory.create(project=project, calibration=1)
+        TaskFactory.create(project=project)
+
+        assert calibration.sample_task_ids(project.id, 5) == [gold.id]
+
+        gold.calibration = 0
+        task_repo.update(gold)
+        assert calibration.sample_task_ids(project.id, 5) == []
+
+    @with_context
+    def test_rebuild(self):
+        """Test CALIBRATION rebuild adds the calibration tasks to the pool"""
+        project = ProjectFactory.create()
+        gold = TaskFactory.create(project=project, calibration=1)
+        self.redis_flushall()
+        assert calibration.sample_task_ids(project.id) is None
+
+        assert calibration.rebuild(project.id) == 1
+        assert calibration.sample_task_ids(project.id) == [gold.id]
+
+    @with_context
+    def test_completed_tasks_leave_the_pool(self):
+        """Test CALIBRATION completed calibration tasks leave the pool"""
+        project = ProjectFactory.create()
+        gold = TaskFactory.create(project=project, calibration=1, n_answers=1)
+        TaskRunFactory.create(task=gold)
+
+        assert calibration.sample_task_ids(project.id, 5) == []
+        calibration.add_task(project.id, gold.id)
+        calibration.rebuild(project.id)
+        assert calibration.sample_task_ids(project.id, 5) == []
+
+    def test_is_correct(self):
+        """Test CALIBRATION is_correct only compares the gold answer keys"""
+        gold = {'answer': 'yes'}
+
+        assert calibration.is_correct({'answer': 'yes', 'time': 3}, gold)
+        assert not calibration.is_correct({'answer': 'no'}, gold)
+        assert calibration.is_correct('yes', 'yes')
+
+    @with_context
+    def test_accuracy_is_tracked(self):
+        """Test CALIBRATION task runs of calibration tasks update the accuracy
+        of the volunteer"""
+        project = ProjectFactory.create()
+        user = UserFactory.create()
+        golds = TaskFactory.create_batch(2, project=project, calibration=1,
+                                         info={'gold_answer': 'yes'})
+        TaskRunFactory.create(task=golds[0], user=user, calibration=1,
+                              info='yes')
+        TaskRunFactory.create(task=golds[1], user=user, calibration=1,
+                              info='no')
+
+        accuracy = calibration.get_accuracy(project.id, user_id=user.id)
+
+        assert accuracy == dict(seen=2, correct=1), accuracy
+
+
+class TestCalibrationSched(Test):
+
+    @with_context
+    def test_calibration_tasks_are_mixed(self):
+        """Test SCHED sends calibration tasks when calibration_frac is set"""
+        project = ProjectFactory.create()
+        TaskFactory.create(project=project)
+        gold = TaskFactory.create(project=project, calibration=1)
+
+        out = sched.new_task(project.id, 'default', user_id=1,
+                             calibration_frac=1)
+
+        assert out.id == gold.id, out
+
+    @with_context
+    @patch('pybossa.sched.calibration.enqueue_rebuild')
+    def test_cold_pool_is_rebuilt_in_the_background(self, enqueue_rebuild):
+        """Test SCHED enqueues the rebuild of a cold calibration pool and
+        sends a regular task meanwhile"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+        TaskFactory.create(project=project, calibration=1)
+        self.redis_flushall()
+
+        out = sched.new_task(project.id, 'default', user_id=1,
+                             calibration_frac=1)
+
+        assert out.id == task.id, out
+        enqueue_rebuild.assert_called_with(project.id)
+
+    @with_context
+    def test_answered_calibration_tasks_are_skipped(self):
+        """Test SCHED does not send answered calibration tasks"""
+        project = ProjectFactory.create()
+        user = UserFactory.create()
+        task = TaskFactory.create(project=project)
+        gold = TaskFactory.create(project=project, calibration=1)
+        TaskRunFactory.create(task=gold, user=user)
+
+        out = sched.new_task(project.id, 'default', user_id=user.id,
+                             calibration_frac=1)
+
+        assert out.id == task.id, out
+
+    @with_context
+    def test_new_tasks_mixes_calibration_tasks(self):
+        """Test SCHED new_tasks fills with regular tasks when there are not
+        enough calibration tasks"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project)
+        gold = TaskFactory.create(project=project, calibration=1)
+
+        out = sched.new_tasks(project.id, 'breadth_first', user_id=1,
+                              limit=3, calibration_frac=1)
+
+        out_ids = sorted(t.id for t in out)
+        assert out_ids == [tasks[0].id, tasks[1].id, gold.id], out_ids
+
+    @with_context
+    @patch('pybossa.sched.random.random')
+    def test_scheduler_does_not_send_calibration_tasks(self, random):
+        """Test SCHED regular draws skip the calibration tasks, so they are
+        only sent at calibration_frac"""
+        random.return_value = 0.9
+        project = ProjectFactory.create()
+        TaskFactory.create(project=project, calibration=1)
+        task = TaskFactory.create(project=project)
+
+        out = sched.new_task(project.id, 'default', user_id=1,
+                             calibration_frac=0.5)
+        assert out.id == task.id, out
+
+        out = sched.new_tasks(project.id, 'breadth_first', user_id=1,
+                              limit=2, calibration_frac=0.5)
+        assert [t.id for t in out] == [task.id], out
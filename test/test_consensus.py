@@ -0,0 +1,152 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from default import Test, db, with_context
+from factories import ProjectFactory, TaskFactory, TaskRunFactory
+from pybossa.core import task_repo
+import pybossa.consensus as consensus
+
+
+class TestConsensusPolicy(object):
+
+    def test_get_policy(self):
+        """Test CONSENSUS get_policy ignores incomplete policies"""
+        assert consensus.get_policy({}) is None
+        assert consensus.get_policy({'completion': {'field': 'a'}}) is None
+        policy = {'field': 'a', 'k': 2}
+        assert consensus.get_policy({'completion': policy}) == policy
+
+    def test_is_reached_k(self):
+        """Test CONSENSUS k identical answers"""
+        policy = {'k': 3}
+
+        assert consensus.is_reached(policy, 3, 3)
+        assert not consensus.is_reached(policy, 2, 5)
+
+    def test_is_reached_agreement(self):
+        """Test CONSENSUS agreement share after min_answers"""
+        policy = {'agreement': 0.75, 'min_answers': 4}
+
+        assert not consensus.is_reached(policy, 3, 3)
+        assert consensus.is_reached(policy, 3, 4)
+        assert not consensus.is_reached(policy, 3, 5)
+
+    def test_answers_without_the_field_are_not_tallied(self):
+        """Test CONSENSUS answers without the policy field have no tally
+        field"""
+        policy = {'field': 'answer', 'k': 2}
+
+        assert consensus.answer_field(policy, {'other': 1}) is None
+        assert consensus.answer_field(policy, 'yes') is None
+        assert consensus.answer_field(policy, {'answer': None}) is not None
+
+
+class TestConsensusCompletion(Test):
+
+    @with_context
+    def test_task_is_completed_on_agreement(self):
+        """Test CONSENSUS tasks are completed once k answers agree"""
+        policy = {'field': 'answer', 'k': 2}
+        project = ProjectFactory.create(info={'completion': policy})
+        task = TaskFactory.create(project=project, n_answers=10)
+
+        TaskRunFactory.create(task=task, info={'answer': 'yes'})
+        TaskRunFactory.create(task=task, info={'answer': 'no'})
+        db.session.refresh(task)
+        assert task.state != 'completed', task.state
+
+        TaskRunFactory.create(task=task, info={'answer': 'yes'})
+        db.session.refresh(task)
+        assert task.state == 'completed', task.state
+
+    @with_context
+    def test_malformed_answers_do_not_agree(self):
+        """Test CONSENSUS answers without the field do not complete tasks"""
+        policy = {'field': 'answer', 'k': 2}
+        project = ProjectFactory.create(info={'completion': policy})
+        task = TaskFactory.create(project=project, n_answers=10)
+
+        TaskRunFactory.create(task=task, info={'other': 'yes'})
+        TaskRunFactory.create(task=task, info='yes')
+
+        db.session.refresh(task)
+        assert task.state != 'completed', task.state
+
+    @with_context
+    def test_rolled_back_answers_are_not_tallied(self):
+        """Test CONSENSUS the tally is only updated on commit"""
+        policy = {'field': 'answer', 'k': 2}
+        project = ProjectFactory.create(info={'completion': policy})
+        task = TaskFactory.create(project=project, n_answers=10)
+        answer = consensus.answer_field(policy, {'answer': 'yes'})
+
+        db.session.add(TaskRunFactory.build(task=task, info={'answer': 'yes'}))
+        db.session.flush()
+        db.session.rollback()
+        assert consensus.get_counts(task.id, answer) == (0, 0)
+
+        TaskRunFactory.create(task=task, info={'answer': 'yes'})
+        assert consensus.get_counts(task.id, answer) == (1, 1)
+
+    @with_context
+    def test_without_policy_tasks_need_all_answers(self):
+        """Test CONSENSUS tasks without policy need n_answers answers"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project, n_answers=10)
+
+        TaskRunFactory.create_batch(3, task=task, info={'answer': 'yes'})
+
+        db.session.refresh(task)
+        assert task.state != 'completed', task.state
+
+    @with_context
+    def test_rebuild_recomputes_the_tallies(self):
+        """Test CONSENSUS rebuild tallies the answers in the DB"""
+        policy = {'field': 'answer', 'k': 3}
+        project = ProjectFactory.create(info={'completion': policy})
+        task = TaskFactory.create(project=project, n_answers=10)
+        answer = consensus.answer_field(policy, {'answer': 'yes'})
+        TaskRunFactory.create(task=task, info={'answer': 'yes'})
+        consensus.add_answer(task.id, answer)
+        assert consensus.get_counts(task.id, answer) == (2, 2)
+
+        assert consensus.rebuild(project.id) == 1
+
+        assert consensus.get_counts(task.id, answer) == (1, 1)
+
+    @with_context
+    def test_redundancy_update_keeps_agreed_tasks_completed(self):
+        """Test CONSENSUS tasks completed by agreement stay completed when the
+        redundancy changes, and the reopened ones get their tallies back"""
+        policy = {'field': 'answer', 'k': 2}
+        project = ProjectFactory.create(info={'completion': policy})
+        agreed, full = TaskFactory.create_batch(2, project=project,
+                                                n_answers=3)
+        answer = consensus.answer_field(policy, {'answer': 'yes'})
+        TaskRunFactory.create_batch(2, task=agreed, info={'answer': 'yes'})
+        TaskRunFactory.create(task=full, info={'answer': 'yes'})
+        TaskRunFactory.create(task=full, info={'answer': 'no'})
+        TaskRunFactory.create(task=full, info={'answer': 'maybe'})
+
+        task_repo.update_tasks_redundancy(project, 5)
+
+        db.session.refresh(agreed)
+        db.session.refresh(full)
+        assert agreed.state == 'completed', agreed.state
+        assert full.state == 'ongoing', full.state
+        assert consensus.get_counts(full.id, answer) == (1, 3)
@@ -0,0 +1,167 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from mock import patch
+from nose.tools import assert_raises
+from default import Test, db, with_context
+from factories import ProjectFactory, TaskFactory, UserFactory
+from pybossa.core import sentinel, task_repo
+from pybossa.model.task_run import TaskRun
+import pybossa.ingestion as ingestion
+
+
+class TestIngestion(Test):
+
+    def task_run(self, task, user_ip='10.0.0.1'):
+        return TaskRun(project_id=task.project_id, task_id=task.id,
+                       user_ip=user_ip, info={'answer': 'yes'})
+
+    @with_context
+    @patch('pybossa.ingestion.enqueue_drain')
+    def test_push_is_idempotent(self, enqueue_drain):
+        """Test INGESTION the same submission is only queued once"""
+        task = TaskFactory.create()
+
+        key = ingestion.push(self.task_run(task), 'abc')
+        assert ingestion.push(self.task_run(task), 'abc') == key
+
+        assert ingestion.get_status()['pending'] == 1
+        assert ingestion.get_state(key) == ingestion.PENDING
+
+    @with_context
+    @patch('pybossa.ingestion.enqueue_drain')
+    def test_drain_saves_task_runs(self, enqueue_drain):
+        """Test INGESTION drain saves the queued task runs"""
+        task = TaskFactory.create(n_answers=2)
+        keys = [ingestion.push(self.task_run(task, ip))
+                for ip in ('10.0.0.1', '10.0.0.2')]
+
+        assert ingestion.drain() == 2
+
+        db.session.refresh(task)
+        assert task.state == 'completed', task.state
+        assert ingestion.get_status() == dict(pending=0, processing=0,
+                                              dead=0, lag=0)
+        for key in keys:
+            assert task_repo.get_task_run(ingestion.get_state(key)) is not None
+
+    @with_context
+    @patch('pybossa.ingestion.enqueue_drain')
+    def test_drain_recovers_processing_batch(self, enqueue_drain):
+        """Test INGESTION a batch left by a dead job is not saved twice"""
+        task = TaskFactory.create()
+        key = ingestion.push(self.task_run(task))
+        ingestion.drain()
+        # As if the job died before clearing the batch
+        item = dict(key=key, accepted=0,
+                    task_run=dict(project_id=task.project_id,
+                                  task_id=task.id, user_ip='10.0.0.1'))
+        sentinel.master.rpush(ingestion.PROCESSING_KEY, json.dumps(item))
+
+        assert ingestion.drain() == 0
+        assert task_repo.count_task_runs_with(task_id=task.id) == 1
+
+    @with_context
+    @patch('pybossa.ingestion.enqueue_drain')
+    @patch('pybossa.ingestion._save_batch')
+    def test_failing_batches_are_dead_lettered(self, save_batch,
+                                               enqueue_drain):
+        """Test INGESTION a batch that keeps failing is moved to the dead
+        letter list, and the next ones are saved"""
+        tasks = TaskFactory.create_batch(2)
+        poisoned = ingestion.push(self.task_run(tasks[0]))
+        save_batch.side_effect = ValueError('Bad JSON')
+        for attempt in range(ingestion.MAX_ATTEMPTS):
+            assert_raises(ValueError, ingestion.drain, 1)
+        key = ingestion.push(self.task_run(tasks[1]))
+
+        def save(items):
+            sentinel.master.delete(ingestion.PROCESSING_KEY)
+            return len(items)
+
+        save_batch.side_effect = save
+
+        assert ingestion.drain(1) == 1
+        saved = save_batch.call_args[0][0]
+        assert [item['key'] for item in saved] == [key], saved
+        assert ingestion.get_state(poisoned) == ingestion.FAILED
+        assert ingestion.get_status()['dead'] == 1
+
+        assert ingestion.requeue_dead() == 1
+        assert ingestion.get_state(poisoned) == ingestion.PENDING
+        assert ingestion.get_status()['pending'] == 1
+
+    @with_context
+    @patch('pybossa.ingestion.enqueue_drain')
+    def test_push_is_queued_with_its_key(self, enqueue_drain):
+        """Test INGESTION the idempotency key is only set if the task run is
+        queued"""
+        task = TaskFactory.create()
+
+        with patch('pybossa.ingestion._push_script') as push_script:
+            push_script.side_effect = Exception('Redis is down')
+            assert_raises(Exception, ingestion.push, self.task_run(task))
+
+        assert ingestion.get_status()['pending'] == 0
+        assert ingestion.push(self.task_run(task)) is not None
+        assert ingestion.get_status()['pending'] == 1
+
+
+class TestIngestionAPI(Test):
+
+    @with_context
+    @patch('pybossa.ingestion.enqueue_drain')
+    @patch('pybossa.api.task_run._check_task_requested_by_user')
+    def test_post_is_accepted(self, requested, enqueue_drain):
+        """Test API TaskRun post returns 202 with write-behind enabled"""
+        requested.return_value = True
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+        data = dict(project_id=project.id, task_id=task.id, info='yes')
+
+        with patch.dict(self.flask_app.config,
+                        {'TASK_RUN_WRITE_BEHIND': True}):
+            res = self.app.post('/api/taskrun', data=json.dumps(data),
+                                headers={'X-Forwarded-For': '10.0.0.1'})
+
+        assert res.status_code == 202, res.data
+        key = json.loads(res.data)['key']
+        res = self.app.get('/api/taskrun/ingestion?key=%s' % key,
+                           headers={'X-Forwarded-For': '10.0.0.1'})
+        assert json.loads(res.data)['state'] == 'pending', res.data
+        assert task_repo.count_task_runs_with(task_id=task.id) == 0
+
+    @with_context
+    @patch('pybossa.ingestion.enqueue_drain')
+    def test_state_is_only_given_to_the_volunteer(self, enqueue_drain):
+        """Test API TaskRun ingestion only returns the state of a submission
+        to its volunteer and the admins"""
+        admin, user = UserFactory.create_batch(2)
+        task = TaskFactory.create()
+        key = ingestion.push(TaskRun(project_id=task.project_id,
+                                     task_id=task.id, user_id=user.id))
+        url = '/api/taskrun/ingestion?key=%s' % key
+
+        assert self.app.get(url).status_code == 401
+        res = self.app.get(url + '&api_key=%s' % user.api_key)
+        assert json.loads(res.data)['state'] == 'pending', res.data
+        res = self.app.get(url + '&api_key=%s' % admin.api_key)
+        assert json.loads(res.data)['state'] == 'pending', res.data
+        res = self.app.get('/api/taskrun/ingestion')
+        assert json.loads(res.data)['pending'] == 1, res.data
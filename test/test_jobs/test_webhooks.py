@@ -95,3 +95,17 @@ class TestWebHooks(Test):
         assert queue.enqueue.called
         assert queue.called_with(webhook, url, payload)
         queue.reset_mock()
+
+    @with_context
+    @patch('pybossa.model.event_listeners.webhook_queue', new=queue)
+    def test_trigger_webhook_only_once(self):
+        """Test WEBHOOK is not triggered again for completed tasks."""
+        url = 'http://server.com'
+        project = ProjectFactory.create(webhook=url,)
+        task = TaskFactory.create(project=project, n_answers=1)
+        TaskRunFactory.create(project=project, task=task)
+        assert queue.enqueue.call_count == 1, queue.enqueue.call_count
+
+        TaskRunFactory.create(project=project, task=task)
+        assert queue.enqueue.call_count == 1, queue.enqueue.call_count
+        queue.reset_mock()
@@ -0,0 +1,127 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from default import Test, with_context
+from factories import (ProjectFactory, TaskFactory, TaskRunFactory,
+                       AnonymousTaskRunFactory)
+import pybossa.cache.projects as cached_projects
+import pybossa.project_counters as project_counters
+
+
+class TestProjectCounters(Test):
+
+    def setUp(self):
+        super(TestProjectCounters, self).setUp()
+        self.flask_app.config['PROJECT_COUNTERS_MAINTAINED'] = True
+
+    def tearDown(self):
+        self.flask_app.config['PROJECT_COUNTERS_MAINTAINED'] = False
+        super(TestProjectCounters, self).tearDown()
+
+    @with_context
+    @patch('pybossa.project_counters.enqueue_rebuild')
+    def test_get_returns_none_until_rebuilt(self, enqueue_rebuild):
+        """Test PROJECT_COUNTERS are not trusted until they are rebuilt"""
+        project = ProjectFactory.create()
+        TaskFactory.create(project=project)
+
+        assert project_counters.get(project.id) is None
+        enqueue_rebuild.assert_called_with(project.id)
+
+        project_counters.rebuild(project.id)
+        assert project_counters.get(project.id)['n_tasks'] == 1
+
+    @with_context
+    def test_counters_are_maintained(self):
+        """Test PROJECT_COUNTERS new tasks and task runs update the counters"""
+        project = ProjectFactory.create()
+        project_counters.rebuild(project.id)
+        task = TaskFactory.create(project=project, n_answers=2)
+        TaskFactory.create(project=project)
+
+        TaskRunFactory.create(task=task)
+        task_run = AnonymousTaskRunFactory.create(task=task)
+
+        counters = project_counters.get(project.id)
+        assert counters['n_tasks'] == 2, counters
+        assert counters['n_completed_tasks'] == 1, counters
+        assert counters['n_task_runs'] == 2, counters
+        assert counters['n_registered_volunteers'] == 1, counters
+        assert counters['n_anonymous_volunteers'] == 1, counters
+        assert counters['last_activity'] == task_run.finish_time, counters
+
+    @with_context
+    def test_cache_getters_read_the_counters(self):
+        """Test PROJECT_COUNTERS are used by the project cache getters"""
+        project = ProjectFactory.create()
+        TaskFactory.create_batch(4, project=project, n_answers=1)
+        project_counters.rebuild(project.id)
+        task = TaskFactory.create(project=project, n_answers=1)
+        TaskRunFactory.create(task=task)
+
+        with patch('pybossa.cache.projects.session') as session:
+            assert cached_projects.n_tasks(project.id) == 5
+            assert cached_projects.n_task_runs(project.id) == 1
+            assert cached_projects.overall_progress(project.id) == 20
+            assert cached_projects.n_volunteers(project.id) == 1
+            assert not session.execute.called
+
+    @with_context
+    def test_rebuild_replays_the_deltas_applied_meanwhile(self):
+        """Test PROJECT_COUNTERS deltas applied during a rebuild are kept"""
+        from pybossa.core import db
+        project = ProjectFactory.create()
+        TaskFactory.create(project=project)
+        execute = db.slave_session.execute
+
+        def read_and_count(*args, **kwargs):
+            result = execute(*args, **kwargs)
+            if not read_and_count.done:
+                read_and_count.done = True
+                project_counters.add_tasks(project.id, 1)
+                project_counters.add_task_run(project.id, user_ip='1.2.3.4')
+            return result
+        read_and_count.done = False
+
+        with patch.object(db.slave_session, 'execute',
+                          side_effect=read_and_count):
+            project_counters.rebuild(project.id)
+
+        counters = project_counters.get(project.id)
+        assert counters['n_tasks'] == 2, counters
+        assert counters['n_task_runs'] == 1, counters
+        assert counters['n_anonymous_volunteers'] == 1, counters
+
+        project_counters.add_tasks(project.id, 1)
+        assert project_counters.get(project.id)['n_tasks'] == 3
+
+    @with_context
+    @patch('pybossa.project_counters.enqueue_rebuild')
+    def test_invalidate_cleans_the_memoized_fallbacks(self, enqueue_rebuild):
+        """Test PROJECT_COUNTERS fallbacks memoized while the counters were
+        not ready are not returned once they are not ready again"""
+        project = ProjectFactory.create()
+        TaskFactory.create(project=project)
+        assert cached_projects.n_tasks(project.id) == 1
+        project_counters.rebuild(project.id)
+        TaskFactory.create(project=project)
+
+        project_counters.invalidate(project.id)
+
+        assert cached_projects.n_tasks(project.id) == 2
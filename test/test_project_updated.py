@@ -0,0 +1,57 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from default import Test, db, with_context
+from factories import ProjectFactory, TaskFactory, TaskRunFactory
+from pybossa.model.project import Project
+import pybossa.project_updated as project_updated
+
+
+class TestProjectUpdated(Test):
+
+    def get_updated(self, project_id):
+        return db.session.query(Project.updated).filter_by(
+            id=project_id).scalar()
+
+    @with_context
+    def test_task_runs_update_project_by_default(self):
+        """Test PROJECT_UPDATED task runs update the project right away"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+        updated = self.get_updated(project.id)
+
+        TaskRunFactory.create(task=task)
+
+        assert self.get_updated(project.id) > updated
+
+    @with_context
+    def test_coalesced_updates_are_written_on_flush(self):
+        """Test PROJECT_UPDATED coalesced updates are written by flush"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+        updated = self.get_updated(project.id)
+
+        with patch.dict(self.flask_app.config,
+                        {'PROJECT_UPDATED_INTERVAL': 60}):
+            TaskRunFactory.create_batch(3, task=task)
+            assert self.get_updated(project.id) == updated
+
+            assert project_updated.flush() == 1
+            assert self.get_updated(project.id) > updated
+            assert project_updated.flush() == 0
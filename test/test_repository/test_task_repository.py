@@ -17,10 +17,12 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 # Cache global variables for timeouts
 
+from sqlalchemy import event
 from default import Test, db
 from nose.tools import assert_raises
 from factories import TaskFactory, TaskRunFactory, ProjectFactory
 from pybossa.repositories import TaskRepository
+from pybossa.model.task_run import TaskRun
 from pybossa.exc import WrongObjectError, DBIntegrityError
 
 
@@ -348,6 +350,55 @@ class TestTaskRepositorySaveDeleteUpdate(Test):
         assert self.task_repo.get_task_run(taskrun.id) == taskrun, "TaskRun not saved"
 
 
+    def test_save_task_runs_matches_the_ids_by_task_and_volunteer(self):
+        """Test save_task_runs assigns every task run its own id"""
+        tasks = TaskFactory.create_batch(3)
+        task_runs = [TaskRun(project_id=task.project_id, task_id=task.id,
+                             user_ip='10.0.0.1', info=task.id)
+                     for task in reversed(tasks)]
+
+        self.task_repo.save_task_runs(task_runs)
+
+        for task_run in task_runs:
+            saved = self.task_repo.get_task_run(task_run.id)
+            assert saved.task_id == task_run.task_id, saved
+            assert saved.info == task_run.task_id, saved
+
+
+    def test_get_task_run_ids_by_volunteer_only_returns_the_volunteers(self):
+        """Test get_task_run_ids_by_volunteer only returns the task runs of
+        the given tasks and volunteers"""
+        task = TaskFactory.create()
+        task_runs = [TaskRun(project_id=task.project_id, task_id=task.id,
+                             user_ip=ip) for ip in ('10.0.0.1', '10.0.0.2')]
+        self.task_repo.save_task_runs(task_runs)
+
+        ids = self.task_repo.get_task_run_ids_by_volunteer(
+            [(task.id, None, '10.0.0.1'), (task.id, None, '10.0.0.3')])
+
+        assert ids == {(task.id, None, '10.0.0.1'): task_runs[0].id}, ids
+
+
+    def test_save_task_runs_runs_every_insert_listener(self):
+        """Test save_task_runs runs the TaskRun after_insert listeners
+        registered anywhere"""
+        tasks = TaskFactory.create_batch(2)
+        inserted = []
+
+        def listener(mapper, conn, target):
+            inserted.append(target.task_id)
+
+        event.listen(TaskRun, 'after_insert', listener)
+        try:
+            self.task_repo.save_task_runs([
+                TaskRun(project_id=task.project_id, task_id=task.id,
+                        user_ip='10.0.0.1') for task in tasks])
+        finally:
+            event.remove(TaskRun, 'after_insert', listener)
+
+        assert sorted(inserted) == sorted(task.id for task in tasks), inserted
+
+
     def test_save_fails_if_integrity_error(self):
         """Test save raises a DBIntegrityError if the instance to be saved lacks
         a required value"""
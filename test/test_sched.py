@@ -30,6 +30,7 @@ from pybossa.model.task_run import TaskRun
 from pybossa.model.category import Category
 from factories import TaskFactory, ProjectFactory, TaskRunFactory, AnonymousTaskRunFactory, UserFactory
 import pybossa
+import pybossa.answered_tasks as answered_tasks
 
 
 class TestSched(sched.Helper):
@@ -414,7 +415,11 @@ class TestGetBreadthFirst(Test):
     def del_task_runs(self, project_id=1):
         """Deletes all TaskRuns for a given project_id"""
         db.session.query(TaskRun).filter_by(project_id=1).delete()
+        db.session.query(Task).filter_by(project_id=1)\
+                  .update({"n_task_runs": 0})
         db.session.commit()
+        # Bulk deletes skip the ORM events that maintain the answered index
+        answered_tasks.invalidate(1)
         db.session.remove()
 
     @with_context
@@ -482,7 +487,124 @@ class TestGetBreadthFirst(Test):
         out = pybossa.sched.get_breadth_first_task(projectid)
         assert out.id == task2.id, out
 
+    @with_context
+    def test_n_task_runs_is_maintained(self):
+        """Test SCHED task.n_task_runs is updated on task run insert and
+        delete"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+        taskruns = TaskRunFactory.create_batch(3, task=task)
+
+        db.session.refresh(task)
+        assert task.n_task_runs == 3, task.n_task_runs
+
+        db.session.delete(taskruns[0])
+        db.session.commit()
+        db.session.refresh(task)
+        assert task.n_task_runs == 2, task.n_task_runs
+
+    @with_context
+    def test_get_breadth_first_task_uses_n_task_runs(self):
+        """Test SCHED breadth first sorts tasks by task.n_task_runs"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project)
+        tasks[0].n_task_runs = 5
+        tasks[1].n_task_runs = 1
+        tasks[2].n_task_runs = 3
+        db.session.commit()
+
+        out = pybossa.sched.get_breadth_first_task(project.id,
+                                                   user_ip='10.0.0.1')
+
+        assert out.id == tasks[1].id, out
+
     def _add_task_run(self, project, task, user=None):
         tr = TaskRun(project=project, task=task, user=user)
         db.session.add(tr)
         db.session.commit()
+
+
+class TestSchedRegistry(Test):
+
+    def tearDown(self):
+        pybossa.sched._schedulers.pop('custom', None)
+        super(TestSchedRegistry, self).tearDown()
+
+    @with_context
+    def test_registered_scheduler_is_used(self):
+        """Test SCHED new_task uses a registered scheduler"""
+        project = ProjectFactory.create()
+        custom = lambda project_id, user_id, user_ip, offset=0: 'task'
+        pybossa.sched.register_scheduler('custom', custom, 'Custom')
+
+        out = pybossa.sched.new_task(project.id, 'custom')
+
+        assert out == 'task', out
+        assert ('custom', 'Custom') in pybossa.sched.sched_variants()
+
+    @with_context
+    def test_unlabeled_schedulers_are_not_offered(self):
+        """Test SCHED sched_variants skips schedulers without a label"""
+        variants = [name for name, label in pybossa.sched.sched_variants()]
+
+        assert 'incremental' not in variants, variants
+        assert 'default' in variants, variants
+
+    @with_context
+    @patch('pkg_resources.iter_entry_points')
+    def test_load_scheduler_plugins(self, iter_entry_points):
+        """Test SCHED schedulers are registered from entry points"""
+        custom = lambda project_id, user_id, user_ip, offset=0: 'task'
+        custom.label = 'Custom'
+        entry_point = type('EntryPoint', (object, ),
+                           dict(name='custom', load=lambda self: custom))()
+        iter_entry_points.return_value = [entry_point]
+
+        pybossa.sched.load_scheduler_plugins()
+
+        iter_entry_points.assert_called_with('pybossa.schedulers')
+        assert pybossa.sched.get_scheduler('custom')['get_task'] is custom
+        assert ('custom', 'Custom') in pybossa.sched.sched_variants()
+
+    @with_context
+    def test_project_config_is_cached_and_invalidated(self):
+        """Test SCHED project scheduling settings are cached until the project
+        is updated"""
+        project = ProjectFactory.create(info={'sched': 'breadth_first'})
+
+        config = pybossa.sched.get_project_config(project.id)
+        assert config['sched'] == 'breadth_first', config
+
+        with patch.object(pybossa.sched.session, 'query') as query:
+            pybossa.sched.get_project_config(project.id)
+            assert not query.called
+
+        project.info['sched'] = 'depth_first'
+        project.allow_anonymous_contributors = False
+        db.session.commit()
+
+        config = pybossa.sched.get_project_config(project.id)
+        assert config['sched'] == 'depth_first', config
+        assert config['allow_anonymous_contributors'] is False, config
+
+    @with_context
+    def test_project_config_of_missing_project(self):
+        """Test SCHED get_project_config returns None for missing projects"""
+        assert pybossa.sched.get_project_config(5000) is None
+
+    @with_context
+    def test_project_config_invalidation_is_published(self):
+        """Test SCHED project updates are published to the other processes,
+        which drop their cached config"""
+        project = ProjectFactory.create(info={'sched': 'breadth_first'})
+        invalidator = pybossa.sched._project_config_invalidator
+        pybossa.sched.get_project_config(project.id)
+
+        with patch.object(invalidator, 'publish') as publish:
+            project.info = dict(project.info, sched='depth_first')
+            db.session.commit()
+            assert publish.call_args[0][1] == str(project.id), publish
+
+        pybossa.sched.get_project_config(project.id)
+        invalidator.handle(str(project.id))
+        assert pybossa.sched._project_configs.get(str(project.id)) is None
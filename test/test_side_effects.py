@@ -0,0 +1,124 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from default import Test, db, with_context
+from factories import ProjectFactory, TaskFactory
+from pybossa.feed import get_update_feed
+from pybossa.model.task import Task
+import pybossa.task_queue as task_queue
+
+
+def no_tasks(task_ids):
+    return []
+
+
+class TestSideEffects(Test):
+
+    def add_tasks(self, project, n):
+        for i in range(n):
+            db.session.add(Task(project_id=project.id, info={'i': i}))
+        db.session.flush()
+
+    @with_context
+    def test_side_effects_are_sent_after_commit(self):
+        """Test SIDE_EFFECTS the feed is updated on commit, not on flush"""
+        project = ProjectFactory.create()
+        task_queue.rebuild(project.id)
+
+        self.add_tasks(project, 3)
+        assert get_update_feed()[0]['action_updated'] == 'Project'
+        assert task_queue.get_candidate_task_ids(project.id, no_tasks) == []
+
+        db.session.commit()
+        assert get_update_feed()[0]['action_updated'] == 'Task'
+        task_ids = task_queue.get_candidate_task_ids(project.id, no_tasks)
+        assert len(task_ids) == 3, task_ids
+
+    @with_context
+    def test_side_effects_are_dropped_on_rollback(self):
+        """Test SIDE_EFFECTS rolled back changes do not update Redis"""
+        project = ProjectFactory.create()
+        task_queue.rebuild(project.id)
+
+        self.add_tasks(project, 3)
+        db.session.rollback()
+        TaskFactory.create(project=ProjectFactory.create())
+
+        assert task_queue.get_candidate_task_ids(project.id, no_tasks) == []
+
+    @with_context
+    def test_savepoint_commits_wait_for_the_transaction(self):
+        """Test SIDE_EFFECTS changes committed in a savepoint are not sent if
+        the transaction is rolled back"""
+        project = ProjectFactory.create()
+        task_queue.rebuild(project.id)
+
+        db.session.begin_nested()
+        self.add_tasks(project, 3)
+        db.session.commit()
+        assert task_queue.get_candidate_task_ids(project.id, no_tasks) == []
+        db.session.rollback()
+
+        assert task_queue.get_candidate_task_ids(project.id, no_tasks) == []
+
+    @with_context
+    def test_savepoint_rollbacks_drop_their_side_effects(self):
+        """Test SIDE_EFFECTS changes rolled back to a savepoint are not sent
+        when the transaction is committed"""
+        project = ProjectFactory.create()
+        task_queue.rebuild(project.id)
+
+        self.add_tasks(project, 1)
+        db.session.begin_nested()
+        self.add_tasks(project, 3)
+        db.session.rollback()
+        db.session.commit()
+
+        task_ids = task_queue.get_candidate_task_ids(project.id, no_tasks)
+        assert len(task_ids) == 1, task_ids
+
+    @with_context
+    @patch('pybossa.side_effects.current_app')
+    def test_errors_are_logged_after_commit(self, current_app):
+        """Test SIDE_EFFECTS Redis errors do not make the commit fail"""
+        project = ProjectFactory.create()
+
+        with patch('pybossa.side_effects.sentinel') as mock_sentinel:
+            mock_sentinel.master.pipeline.return_value.execute.side_effect = \
+                Exception('Redis is down')
+            self.add_tasks(project, 1)
+            db.session.commit()
+
+        assert current_app.logger.exception.called
+        assert db.session.query(Task).filter_by(project_id=project.id).count() == 1
+
+    @with_context
+    def test_bulk_inserts_are_batched(self):
+        """Test SIDE_EFFECTS bulk task inserts send one pipeline and one
+        task queue batch"""
+        project = ProjectFactory.create()
+
+        with patch('pybossa.side_effects.sentinel') as mock_sentinel:
+            with patch('pybossa.task_queue.update_many') as update_many:
+                self.add_tasks(project, 10)
+                db.session.commit()
+
+        assert mock_sentinel.master.pipeline.call_count == 1
+        assert update_many.call_count == 1
+        assert len(update_many.call_args[0][0]) == 10
@@ -0,0 +1,109 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch, MagicMock
+from default import Test, db, with_context
+from factories import ProjectFactory, TaskFactory, TaskRunFactory, UserFactory
+from pybossa.core import sentinel
+import pybossa.task_leases as task_leases
+import pybossa.sched as sched
+
+
+class TestTaskLeases(Test):
+
+    @with_context
+    def test_acquire_respects_remaining_answers(self):
+        """Test TASK_LEASES a task is leased to as many volunteers as answers
+        it still needs"""
+        task = TaskFactory.create(n_answers=2)
+
+        assert task_leases.acquire(task, 60, user_id=1)
+        assert task_leases.acquire(task, 60, user_id=2)
+        assert task_leases.acquire(task, 60, user_id=3) is False
+
+    @with_context
+    def test_acquire_is_reentrant(self):
+        """Test TASK_LEASES a volunteer can renew its own lease"""
+        task = TaskFactory.create(n_answers=1)
+
+        assert task_leases.acquire(task, 60, user_ip='10.0.0.1')
+        assert task_leases.acquire(task, 60, user_ip='10.0.0.1')
+
+    @with_context
+    def test_expired_leases_are_ignored(self):
+        """Test TASK_LEASES expired leases do not take a slot"""
+        task = TaskFactory.create(n_answers=1)
+        sentinel.master.zadd(task_leases.LEASE_KEY % task.id, 1, 'user:1')
+
+        assert task_leases.acquire(task, 60, user_id=2)
+
+    @with_context
+    def test_task_run_releases_lease(self):
+        """Test TASK_LEASES a task run releases the lease of the volunteer"""
+        user = UserFactory.create()
+        task = TaskFactory.create(n_answers=2)
+        task_leases.acquire(task, 60, user_id=user.id)
+
+        TaskRunFactory.create(task=task, user=user)
+
+        key = task_leases.LEASE_KEY % task.id
+        assert sentinel.master.zscore(key, 'user:%s' % user.id) is None
+
+
+class TestLeasedSched(Test):
+
+    @with_context
+    def test_leased_tasks_are_skipped(self):
+        """Test SCHED with leases skips tasks leased to other users"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(2, project=project, n_answers=1)
+
+        first = sched.new_task(project.id, 'default', user_id=1, lease=60)
+        second = sched.new_task(project.id, 'default', user_id=2, lease=60)
+
+        assert first.id == tasks[0].id, first
+        assert second.id == tasks[1].id, second
+
+    @with_context
+    def test_fully_leased_project_returns_first_task(self):
+        """Test SCHED with leases returns the first task when all of them are
+        leased"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project, n_answers=1)
+        sched.new_task(project.id, 'default', user_id=1, lease=60)
+
+        out = sched.new_task(project.id, 'default', user_id=2, lease=60)
+
+        assert out.id == task.id, out
+
+    @with_context
+    def test_scheduler_query_runs_once(self):
+        """Test SCHED with leases reads all the candidates with one scheduler
+        query"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project, n_answers=1)
+        for user_id in (1, 2):
+            sched.new_task(project.id, 'default', user_id=user_id, lease=60)
+        get_task_ids = MagicMock(wraps=sched.get_candidate_task_ids)
+
+        with patch.dict(sched.get_scheduler('default'),
+                        get_task_ids=get_task_ids):
+            out = sched.new_task(project.id, 'default', user_id=3, lease=60)
+
+        assert out.id == tasks[2].id, out
+        assert get_task_ids.call_count == 1, get_task_ids.call_args_list
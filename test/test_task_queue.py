@@ -0,0 +1,159 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from default import Test, db, with_context
+from factories import ProjectFactory, TaskFactory, TaskRunFactory, UserFactory
+from pybossa.core import task_repo
+import pybossa.task_queue as task_queue
+import pybossa.sched as sched
+
+
+class TestTaskQueue(Test):
+
+    @with_context
+    def test_push_does_nothing_when_queue_is_cold(self):
+        """Test TASK_QUEUE push does not create a queue for a cold project"""
+        project = ProjectFactory.create()
+        TaskFactory.create(project=project)
+
+        assert task_queue.is_ready(project.id) is False
+        assert task_queue.get_candidate_task_ids(project.id,
+                                                 lambda ids: []) is None
+
+    @with_context
+    def test_rebuild_sorts_by_priority_and_id(self):
+        """Test TASK_QUEUE rebuild sorts by priority desc and id asc"""
+        project = ProjectFactory.create()
+        low = TaskFactory.create(project=project, priority_0=0.1)
+        high = TaskFactory.create(project=project, priority_0=0.9)
+        other_low = TaskFactory.create(project=project, priority_0=0.1)
+        TaskFactory.create(project=project, state=u'completed')
+
+        n_tasks = task_queue.rebuild(project.id)
+        candidates = task_queue.get_candidate_task_ids(project.id,
+                                                       lambda ids: [])
+
+        assert n_tasks == 3, n_tasks
+        assert candidates == [high.id, low.id, other_low.id], candidates
+
+    @with_context
+    def test_queue_is_maintained_once_warm(self):
+        """Test TASK_QUEUE adds new tasks, priority changes and removes
+        completed tasks once the queue is warm"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project, n_answers=1)
+        task_queue.rebuild(project.id)
+
+        new_task = TaskFactory.create(project=project)
+        task.priority_0 = 0.5
+        task_repo.update(task)
+        candidates = task_queue.get_candidate_task_ids(project.id,
+                                                       lambda ids: [])
+        assert candidates == [task.id, new_task.id], candidates
+
+        TaskRunFactory.create(task=task)
+        candidates = task_queue.get_candidate_task_ids(project.id,
+                                                       lambda ids: [])
+        assert candidates == [new_task.id], candidates
+
+    @with_context
+    def test_get_candidate_task_ids_excludes(self):
+        """Test TASK_QUEUE get_candidate_task_ids skips excluded tasks"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project)
+        task_queue.rebuild(project.id)
+
+        exclude = lambda ids: [tasks[0].id]
+        candidates = task_queue.get_candidate_task_ids(project.id, exclude,
+                                                       limit=1)
+        assert candidates == [tasks[1].id], candidates
+
+    @with_context
+    def test_rebuild_drops_tasks_removed_during_the_build(self):
+        """Test TASK_QUEUE rebuild drops the tasks removed after the snapshot
+        was read"""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(2, project=project)
+        slave_session = db.slave_session
+
+        def execute(*args, **kwargs):
+            rows = slave_session.execute(*args, **kwargs).fetchall()
+            task_queue.remove(project.id, tasks[0].id)
+            return rows
+
+        with patch.object(db, 'slave_session') as mock_session:
+            mock_session.execute.side_effect = execute
+            task_queue.rebuild(project.id)
+
+        candidates = task_queue.get_candidate_task_ids(project.id,
+                                                       lambda ids: [])
+        assert candidates == [tasks[1].id], candidates
+
+
+class TestDepthFirstQueueSched(Test):
+
+    @with_context
+    @patch('pybossa.sched.task_queue.enqueue_rebuild')
+    def test_falls_back_to_sql_when_cold(self, enqueue_rebuild):
+        """Test SCHED depth_first_queue uses SQL and enqueues a rebuild when
+        the queue is cold"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+
+        out = sched.get_depth_first_queue_task(project.id, user_ip='127.0.0.1')
+
+        assert out.id == task.id, out
+        enqueue_rebuild.assert_called_with(project.id)
+
+    @with_context
+    @patch('pybossa.sched.get_depth_first_task')
+    def test_uses_queue_when_warm(self, sql_sched):
+        """Test SCHED depth_first_queue does not use SQL when warm and skips
+        the tasks answered by the user"""
+        project = ProjectFactory.create()
+        user = UserFactory.create()
+        tasks = TaskFactory.create_batch(2, project=project)
+        TaskRunFactory.create(task=tasks[0], user=user)
+        task_queue.rebuild(project.id)
+
+        out = sched.get_depth_first_queue_task(project.id, user_id=user.id)
+
+        assert out.id == tasks[1].id, out
+        assert not sql_sched.called
+
+    @with_context
+    @patch('pybossa.sched.task_queue.MAX_PAGES', 1)
+    @patch('pybossa.sched.task_queue.PAGE_SIZE', 2)
+    def test_falls_back_to_sql_after_max_pages(self):
+        """Test SCHED depth_first_queue uses SQL when the first pages of the
+        queue were answered by the user"""
+        project = ProjectFactory.create()
+        user = UserFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project)
+        task_queue.rebuild(project.id)
+        for task in tasks[:2]:
+            TaskRunFactory.create(task=task, user=user)
+
+        with patch('pybossa.sched.get_candidate_task_ids') as sql_sched:
+            sql_sched.return_value = [tasks[2].id]
+            out = sched.get_depth_first_queue_task(project.id,
+                                                   user_id=user.id)
+
+        assert out.id == tasks[2].id, out
+        sql_sched.assert_called_with(project.id, user.id, None, 1)
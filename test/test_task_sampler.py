@@ -0,0 +1,125 @@
+# -*- coding: utf8 -*-
+# This file is part of PyBossa.
+#
+# Copyright (C) 2015 SF Isle of Man Limited
+#
+# PyBossa is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyBossa is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import patch
+from default import Test, db, with_context
+from factories import ProjectFactory, TaskFactory, TaskRunFactory, UserFactory
+from pybossa.core import task_repo
+import pybossa.task_sampler as task_sampler
+import pybossa.sched as sched
+
+
+class TestAliasTable(object):
+
+    def test_build_alias_table_keeps_weights(self):
+        """Test TASK_SAMPLER alias table gives every slot its weight"""
+        weights = [1.0, 2.0, 3.0, 4.0]
+        probabilities, aliases = task_sampler.build_alias_table(weights)
+
+        n = len(weights)
+        shares = [0.0] * n
+        for i in range(n):
+            shares[i] += probabilities[i] / n
+            shares[aliases[i]] += (1 - probabilities[i]) / n
+        for share, weight in zip(shares, weights):
+            assert abs(share - weight / sum(weights)) < 1e-9, shares
+
+    def test_build_alias_table_empty(self):
+        """Test TASK_SAMPLER alias table of no tasks is empty"""
+        assert task_sampler.build_alias_table([]) == ([], [])
+
+
+class TestTaskSampler(Test):
+
+    @with_context
+    def test_sample_returns_none_without_table(self):
+        """Test TASK_SAMPLER sample_task_ids returns None without a table"""
+        project = ProjectFactory.create()
+
+        assert task_sampler.sample_task_ids(project.id) is None
+
+    @with_context
+    def test_rebuild_only_samples_open_tasks(self):
+        """Test TASK_SAMPLER rebuild only includes the open tasks"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project, priority_0=0.5)
+        TaskFactory.create(project=project, state=u'completed')
+
+        n_tasks = task_sampler.rebuild(project.id)
+
+        assert n_tasks == 1, n_tasks
+        assert task_sampler.sample_task_ids(project.id, 5) == [task.id] * 5
+
+    @with_context
+    @patch('pybossa.task_sampler.enqueue_rebuild')
+    def test_new_tasks_mark_table_as_stale(self, enqueue_rebuild):
+        """Test TASK_SAMPLER new tasks trigger a rebuild of existing tables"""
+        project = ProjectFactory.create()
+        TaskFactory.create(project=project)
+        assert not enqueue_rebuild.called
+
+        task_sampler.rebuild(project.id)
+        TaskFactory.create(project=project)
+
+        enqueue_rebuild.assert_called_with(project.id)
+
+    @with_context
+    @patch('pybossa.task_sampler.enqueue_rebuild')
+    def test_priority_changes_mark_table_as_stale(self, enqueue_rebuild):
+        """Test TASK_SAMPLER priority updates trigger a rebuild, and other
+        updates do not"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project, priority_0=0.5)
+        task_sampler.rebuild(project.id)
+
+        task.info = {'question': 'new'}
+        task_repo.update(task)
+        assert not enqueue_rebuild.called
+
+        task.priority_0 = 0.9
+        task_repo.update(task)
+        enqueue_rebuild.assert_called_with(project.id)
+
+
+class TestWeightedRandomSched(Test):
+
+    @with_context
+    @patch('pybossa.sched.task_sampler.enqueue_rebuild')
+    def test_falls_back_to_depth_first_without_table(self, enqueue_rebuild):
+        """Test SCHED weighted_random uses depth first and enqueues a rebuild
+        while the table does not exist"""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+
+        out = sched.get_weighted_random_task(project.id, user_ip='10.0.0.1')
+
+        assert out.id == task.id, out
+        enqueue_rebuild.assert_called_with(project.id)
+
+    @with_context
+    def test_skips_answered_tasks(self):
+        """Test SCHED weighted_random does not send answered tasks"""
+        project = ProjectFactory.create()
+        user = UserFactory.create()
+        tasks = TaskFactory.create_batch(2, project=project)
+        TaskRunFactory.create(task=tasks[0], user=user)
+        task_sampler.rebuild(project.id)
+
+        for i in range(10):
+            out = sched.get_weighted_random_task(project.id, user_id=user.id)
+            assert out.id == tasks[1].id, out
@@ -16,13 +16,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 import pybossa.util as util
+from pybossa.cache import refreshing, is_refreshing
 from mock import patch
 from datetime import datetime, timedelta
 import calendar
 import time
 import csv
 import tempfile
-import os
 
 
 class TestPybossaUtil(object):
@@ -229,13 +229,6 @@ class TestIsReservedName(object):
 
 class TestWithCacheDisabledDecorator(object):
 
-    def setUp(self):
-        os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = '0'
-
-    def tearDown(self):
-        os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = '1'
-
-
     def test_it_returns_same_as_original_function(self):
         def original_func(first_value, second_value='world'):
             return 'first_value' + second_value
@@ -248,37 +241,42 @@ class TestWithCacheDisabledDecorator(object):
         assert call_with_kwargs == original_func('Hello, ', second_value='there')
 
 
-    def test_it_executes_function_with_cache_disabled(self):
+    def test_it_executes_function_refreshing_the_cache(self):
         def original_func():
-            return os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED')
+            return is_refreshing()
 
         decorated_func = util.with_cache_disabled(original_func)
 
-        assert original_func() == '0', original_func()
-        assert decorated_func() == '1', decorated_func()
+        assert original_func() is False, original_func()
+        assert decorated_func() is True, decorated_func()
 
 
-    def test_it_executes_function_with_cache_disabled_triangulation(self):
-        def original_func():
-            return os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED')
+    def test_it_leaves_the_cache_as_it_was_before(self):
+        @util.with_cache_disabled
+        def decorated_func():
+            return
 
-        del os.environ['PYBOSSA_REDIS_CACHE_DISABLED']
-        decorated_func = util.with_cache_disabled(original_func)
+        decorated_func()
+        assert is_refreshing() is False
+        with refreshing():
+            decorated_func()
+            assert is_refreshing() is True
+        assert is_refreshing() is False
 
-        assert original_func() == None, original_func()
-        assert decorated_func() == '1', decorated_func()
 
+    def test_it_only_refreshes_the_cache_in_the_current_thread(self):
+        from threading import Thread
+        other_thread = []
 
-    def test_it_leaves_environment_as_it_was_before(self):
         @util.with_cache_disabled
         def decorated_func():
-            return
+            thread = Thread(target=lambda: other_thread.append(is_refreshing()))
+            thread.start()
+            thread.join()
 
-        original_value = os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED')
         decorated_func()
-        left_value = os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED')
 
-        assert left_value == original_value, left_value
+        assert other_thread == [False], other_thread
 
 
 class TestUsernameFromFullnameFunction(object):
@@ -96,13 +96,11 @@ class TestWeb(web.Helper):
         res = self.app.get(url)
         assert "Sorry" in res.data, res.data
 
-        # We use a string here to check that it works too
-        task = Task(project_id=project.id, n_answers=10)
-        db.session.add(task)
-        db.session.commit()
-
         for i in range(10):
-            task_run = TaskRun(project_id=project.id, task_id=1,
+            task = Task(project_id=project.id, n_answers=10)
+            db.session.add(task)
+            db.session.commit()
+            task_run = TaskRun(project_id=project.id, task_id=task.id,
                                      user_id=user.id,
                                      info={'answer': 1})
             db.session.add(task_run)
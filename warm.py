@@ -30,52 +30,11 @@ app = create_app()
 
 def warm_cache():
     '''Warm cache'''
-    # Disable cache, so we can refresh the data in Redis
-    os.environ['PYBOSSA_REDIS_CACHE_DISABLED'] = '1'
-    # Cache 3 pages
-    apps_cached = []
-    pages = range(1, 4)
     with app.app_context():
-        import pybossa.cache.projects as cached_apps
-        import pybossa.cache.categories as cached_cat
-        import pybossa.cache.users as cached_users
-        import pybossa.cache.project_stats  as stats
-
-        def warm_app(id, short_name, featured=False):
-            if id not in apps_cached:
-                cached_apps.get_app(short_name)
-                cached_apps.n_tasks(id)
-                n_task_runs = cached_apps.n_task_runs(id)
-                cached_apps.overall_progress(id)
-                cached_apps.last_activity(id)
-                cached_apps.n_completed_tasks(id)
-                cached_apps.n_volunteers(id)
-                if n_task_runs >= 1000 or featured:
-                    print "Getting stats for %s as it has %s task runs" % (short_name, n_task_runs)
-                    stats.get_stats(id, app.config.get('GEO'))
-                apps_cached.append(id)
-
-        # Cache top projects
-        apps = cached_apps.get_top()
-        for a in apps:
-            warm_app(a['id'], a['short_name'])
-        for page in pages:
-            apps = cached_apps.get_featured('featured', page,
-                                            app.config['APPS_PER_PAGE'])
-            for a in apps:
-                warm_app(a['id'], a['short_name'], featured=True)
-
-        # Categories
-        categories = cached_cat.get_used()
-        for c in categories:
-            for page in pages:
-                 apps = cached_apps.get(c['short_name'],
-                                        page,
-                                        app.config['APPS_PER_PAGE'])
-                 for a in apps:
-                     warm_app(a['id'], a['short_name'])
-        # Users
-        cached_users.get_leaderboard(app.config['LEADERBOARD'])
+        from pybossa.cache import warm
+        report = warm.warm(enqueue=False)
+        print "Warmed %(warmed)s of %(calls)s calls (%(fresh)s were fresh, " \
+              "%(failed)s failed) in %(duration).1f seconds" % report
 
 
 ## ==================================================